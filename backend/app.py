@@ -1,16 +1,17 @@
 import os
 import time
 import mysql.connector
-from flask import Flask, request, jsonify, make_response, url_for
+from flask import Flask, Response, request, jsonify, make_response, url_for, g, has_request_context
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.http import http_date
 import jwt
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, date, timedelta, timezone
 from functools import wraps
 from flask_cors import CORS
 from flask_mail import Mail, Message
 from itsdangerous import URLSafeTimedSerializer, SignatureExpired, BadSignature
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 import requests
 from bs4 import BeautifulSoup
 from io import BytesIO
@@ -22,13 +23,84 @@ from reportlab.lib.units import inch
 from flask import send_file
 import json
 from datetime import timedelta
+import threading
+import atexit
+import heapq
+import hashlib
+from decimal import Decimal
+from flask.json.provider import DefaultJSONProvider
+from flask.logging import default_handler as flask_default_log_handler
+
+import zlib
+import base64
+import queue
+import itertools
+import click
+import mimetypes
+import re
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import zipfile
+import bisect
+import math
+import copy
+import hmac
+
+try:
+    import orjson  # Optional C-backed encoder
+except ImportError:
+    orjson = None
+
+try:
+    import brotli  # Optional, enables Content-Encoding: br
+except ImportError:
+    brotli = None
 
 # Ensure the required directories exist
 os.makedirs('logs', exist_ok=True)
 os.makedirs('offline_content', exist_ok=True)
 
+# JSON Serialization
+def json_default(value):
+    """Encode the non-JSON types that database rows contain"""
+    if isinstance(value, datetime):
+        # ISO 8601 everywhere. Views that returned raw rows used to send
+        # Flask's HTTP-date here; the frontend parses both with new Date()
+        return value.isoformat()
+    if isinstance(value, date):
+        # Plain dates keep Flask's HTTP-date format, as before
+        return http_date(value)
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode('utf-8')
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, timedelta):
+        return str(value)
+    return DefaultJSONProvider.default(value)
+
+class AppJSONProvider(DefaultJSONProvider):
+    """Serialize responses, database values included, in a single pass.
+
+    Uses orjson when it is installed and the standard library otherwise;
+    both produce the same output.
+    """
+    default = staticmethod(json_default)
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None:
+            return super().dumps(obj, **kwargs)
+        # Dates and datetimes go through json_default, like the stdlib path
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=json_default, option=option).decode('utf-8')
+
 # Initialize Flask app
 app = Flask(__name__)
+app.json = AppJSONProvider(app)
 
 # Configure CORS with proper security settings
 CORS(app)
@@ -70,6 +142,88 @@ app.config['SECURITY_PASSWORD_SALT'] = 'pwyt mwfm ifwh poox'
 # Offline Content Configuration
 app.config['OFFLINE_CONTENT_DIR'] = 'offline_content'
 app.config['MAX_OFFLINE_CONTENT_SIZE'] = 500 * 1024 * 1024  # 500MB
+app.config['CONTENT_FILES_DIR'] = 'content_files'  # module_content.file_path is relative to this
+# Internal nginx locations for the directories above, e.g.
+# {'OFFLINE_CONTENT_DIR': '/protected/offline/'}; files are then sent by
+# nginx through X-Accel-Redirect instead of the WSGI server
+app.config['X_ACCEL_REDIRECT_LOCATIONS'] = {}
+# Evict the user's least recently accessed copies instead of refusing a
+# download over MAX_OFFLINE_CONTENT_SIZE (clients can pass ?evict=true|false)
+app.config['OFFLINE_EVICT_LRU'] = False
+# Bytes of blob storage across all users at which least recently accessed
+# blobs are evicted until usage is back under the low-water mark
+# (None disables server-wide eviction)
+app.config['OFFLINE_DISK_HIGH_WATER'] = None
+app.config['OFFLINE_DISK_LOW_WATER'] = None  # defaults to 90% of the high-water mark
+app.config['OFFLINE_ACCESS_RESOLUTION'] = 3600  # seconds; last access is not rewritten more often
+app.config['OFFLINE_LOCK_TIMEOUT'] = 30  # seconds to wait for the blob store lock
+app.config['SOURCE_CHECKSUM_CACHE_SIZE'] = 4096  # content file checksums kept in memory
+
+# Progress Heartbeat Configuration
+app.config['PROGRESS_FLUSH_INTERVAL'] = 10  # seconds between buffered position writes
+app.config['PROGRESS_FLUSH_MAX_FAILURES'] = 3  # failed writes before a buffered position is dropped
+app.config['PROGRESS_BATCH_MAX_EVENTS'] = 500  # events accepted per offline sync request
+
+# Module Catalogue Cache Configuration
+app.config['CATALOGUE_CHECK_INTERVAL'] = 5  # seconds between catalogue version checks
+# Seconds before the whole catalogue is reloaded regardless of versions, so
+# rows changed by direct SQL (which never bumps catalogue_versions) show up
+app.config['CATALOGUE_MAX_AGE'] = 300
+
+# Response Compression Configuration
+app.config['COMPRESS_MIN_SIZE'] = 1024  # bytes; smaller bodies are sent uncompressed
+app.config['COMPRESS_GZIP_LEVEL'] = 6
+app.config['COMPRESS_BROTLI_QUALITY'] = 4
+app.config['COMPRESS_MIMETYPES'] = {
+    'application/json', 'text/html', 'text/plain', 'text/css', 'text/csv',
+    'application/javascript', 'image/svg+xml'
+}
+
+# Pagination Configuration
+# Rows returned when ?limit= is absent; None returns every row, as before
+# pagination, so clients that do not follow X-Next-Cursor lose nothing
+app.config['PAGE_SIZE_DEFAULT'] = None
+app.config['PAGE_SIZE_MAX'] = 500
+
+# Event Stream Configuration
+app.config['EVENT_STREAM_HEARTBEAT'] = 15  # seconds between keep-alive comments
+app.config['EVENT_STREAM_RETRY'] = 5000  # milliseconds before the browser reconnects
+app.config['EVENT_QUEUE_SIZE'] = 100  # undelivered events kept per open stream
+
+# YouTube Metadata Configuration
+app.config['YOUTUBE_OEMBED_URL'] = 'https://www.youtube.com/oembed'
+app.config['YOUTUBE_TIMEOUT'] = (3.05, 5)  # connect and read timeouts in seconds
+app.config['YOUTUBE_CACHE_TTL'] = 24 * 3600  # seconds an available video is trusted
+app.config['YOUTUBE_NEGATIVE_CACHE_TTL'] = 600  # seconds a missing/unembeddable video is trusted
+app.config['YOUTUBE_CACHE_SIZE'] = 10000  # videos kept in the in-process cache
+# Callable(video_id) -> metadata dict used instead of oEmbed, e.g. a local stub in tests
+app.config['YOUTUBE_METADATA_FETCHER'] = None
+# Background revalidation of every youtube_videos row; rows checked within
+# the interval are skipped (None disables the in-process scheduler, the
+# 'flask refresh-youtube' command still works)
+app.config['YOUTUBE_REFRESH_INTERVAL'] = 6 * 3600
+app.config['YOUTUBE_REFRESH_WORKERS'] = 4
+app.config['YOUTUBE_REFRESH_RATE'] = 5  # oEmbed requests per second across workers
+
+# Query Instrumentation Configuration
+app.config['QUERY_BUDGET'] = 25  # queries per request before a warning is logged
+app.config['QUERY_REPEAT_LIMIT'] = 5  # executions of one statement per request before an N+1 warning
+app.config['QUERY_STATS_HEADERS'] = False  # add X-Query-Count / X-Query-Time to responses
+
+# Slow Query Log Configuration
+app.config['SLOW_QUERY_THRESHOLD'] = 0.25  # seconds; slower statements are logged (None disables)
+app.config['SLOW_QUERY_EXPLAIN'] = True  # capture EXPLAIN the first time a statement is slow
+app.config['SLOW_QUERY_BUFFER_SIZE'] = 100  # distinct slow statements kept for /admin/slow-queries
+
+# Metrics Configuration
+# Clients allowed to scrape /metrics (None allows everyone). Behind a proxy
+# listed in METRICS_TRUSTED_PROXIES the address it appended to
+# X-Forwarded-For is checked instead of the proxy's own.
+app.config['METRICS_ALLOWED_ADDRESSES'] = {'127.0.0.1', '::1'}
+app.config['METRICS_TRUSTED_PROXIES'] = {'127.0.0.1', '::1'}
+# Scrapers sending "Authorization: Bearer <token>" are let in from anywhere (None disables)
+app.config['METRICS_TOKEN'] = None
+app.config['METRICS_RETIRE_INTERVAL'] = 60  # seconds between folding finished threads' shards
 
 # Gamification Configuration
 app.config['POINTS_FOR_COMPLETION'] = 100
@@ -82,26 +236,119 @@ app.config['BADGE_THRESHOLDS'] = {
     'platinum': 5000
 }
 
+# Logging Configuration
+app.config['LOG_FILE'] = 'logs/app.log'
+app.config['LOG_MAX_BYTES'] = 10 * 1024 * 1024  # rotate at 10MB
+app.config['LOG_BACKUP_COUNT'] = 10
+app.config['LOG_FORMAT'] = 'json'  # 'json' (one object per line) or 'text' for the log file
+app.config['LOG_LEVEL'] = 'INFO'
+# Levels of the child loggers, e.g. {'app.db': 'DEBUG'}
+app.config['LOG_LEVELS'] = {
+    'app.leaderboard': 'WARNING',
+    'app.content': 'WARNING'
+}
+app.config['LOG_QUEUE_SIZE'] = 10000  # records waiting to be written; further records are dropped
+
 # Initialize extensions
 mail = Mail(app)
 serializer = URLSafeTimedSerializer(app.config['SECRET_KEY'])
 
-# Set up logging
-file_handler = RotatingFileHandler(
-    'logs/app.log',
-    maxBytes=10240,
-    backupCount=10,
-    delay=True  # Delay file opening until the first write
-)
-file_handler.setFormatter(logging.Formatter(
-    '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
-))
-file_handler.setLevel(logging.INFO)
-app.logger.addHandler(file_handler)
-app.logger.setLevel(logging.INFO)
-
-# Ensure the logs directory exists
-os.makedirs('logs', exist_ok=True)
+# Set up logging: request threads only put records on a queue; a listener
+# thread formats them and writes the log file and the console
+class RequestContextFilter(logging.Filter):
+    """Attach the current request to records while still in the request thread"""
+    def filter(self, record):
+        if has_request_context():
+            record.method = request.method
+            record.path = request.path
+            record.remote_addr = request.remote_addr
+        return True
+
+class JSONLogFormatter(logging.Formatter):
+    """Format records as one JSON object per line"""
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'module': record.module,
+            'function': record.funcName,
+            'line': record.lineno,
+            'thread': record.threadName
+        }
+        for key in ('method', 'path', 'remote_addr'):
+            if hasattr(record, key):
+                entry[key] = getattr(record, key)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class DroppingQueueHandler(QueueHandler):
+    """Queue records without ever blocking; count the ones that do not fit"""
+    dropped = 0
+
+    def prepare(self, record):
+        """Merge the arguments into the message like QueueHandler does, but
+        keep the traceback in exc_text instead of folding it into the
+        message, so the listener's formatters can still emit it"""
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            # Tracebacks cannot be pickled or safely shared across threads
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
+
+def setup_logging():
+    os.makedirs(os.path.dirname(app.config['LOG_FILE']) or '.', exist_ok=True)
+    text_formatter = logging.Formatter(
+        '%(asctime)s %(levelname)s %(name)s: %(message)s [in %(pathname)s:%(lineno)d]'
+    )
+    file_handler = RotatingFileHandler(
+        app.config['LOG_FILE'],
+        maxBytes=app.config['LOG_MAX_BYTES'],
+        backupCount=app.config['LOG_BACKUP_COUNT'],
+        delay=True  # Delay file opening until the first write
+    )
+    if app.config['LOG_FORMAT'] == 'json':
+        file_handler.setFormatter(JSONLogFormatter())
+    else:
+        file_handler.setFormatter(text_formatter)
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(text_formatter)
+
+    log_queue = queue.Queue(maxsize=app.config['LOG_QUEUE_SIZE'])
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(RequestContextFilter())
+    listener = QueueListener(log_queue, file_handler, console_handler)
+
+    # Replace Flask's synchronous console handler
+    app.logger.removeHandler(flask_default_log_handler)
+    app.logger.addHandler(queue_handler)
+    app.logger.setLevel(app.config['LOG_LEVEL'])
+    for name, level in app.config['LOG_LEVELS'].items():
+        logging.getLogger(name).setLevel(level)
+
+    listener.start()
+    # Write out queued records on shutdown
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging()
+leaderboard_logger = app.logger.getChild('leaderboard')
+content_logger = app.logger.getChild('content')
+db_logger = app.logger.getChild('db')
 # Database Helper Functions
 def get_db_connection():
     max_retries = 3
@@ -120,7 +367,11 @@ def get_db_connection():
             retry_delay *= 2  # Exponential backoff
 
 def dict_to_json_serializable(data):
-    """Convert dictionary with datetime objects to JSON serializable format"""
+    """Convert dictionary with datetime objects to JSON serializable format.
+
+    Responses no longer need this, AppJSONProvider encodes these types
+    directly; it is kept for normalising user rows.
+    """
     if isinstance(data, dict):
         return {k: dict_to_json_serializable(v) for k, v in data.items()}
     elif isinstance(data, list):
@@ -136,25 +387,489 @@ def safe_get(result, key, default=None):
     """Safely get a value from a dictionary result, returning default if result is None"""
     return result.get(key, default) if result is not None else default
 
+# Keyset pagination: list endpoints take ?limit=&after=, where after is the
+# opaque cursor returned in the X-Next-Cursor header of the previous page.
+# The cursor holds the sort key of the last row, so a page is an index range
+# scan instead of an OFFSET over a full sort.
+def get_page_args():
+    """Read limit (None for all rows) and the decoded after cursor, a list
+    of str/int/float values; raises ValueError if either is malformed.
+    keyset_after checks the cursor's length against the sort keys."""
+    limit = request.args.get('limit')
+    if limit is None:
+        limit = app.config['PAGE_SIZE_DEFAULT']
+    else:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise ValueError('limit must be a positive integer')
+        if limit < 1:
+            raise ValueError('limit must be a positive integer')
+        limit = min(limit, app.config['PAGE_SIZE_MAX'])
+
+    after = request.args.get('after')
+    if after:
+        try:
+            padded = after + '=' * (-len(after) % 4)
+            after = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        except (ValueError, UnicodeError):
+            raise ValueError('Invalid cursor')
+        # Cursor values are bound as query parameters, so only scalars pass
+        if not isinstance(after, list) or not after or not all(
+                isinstance(value, (str, int, float)) and not isinstance(value, bool)
+                and (not isinstance(value, float) or math.isfinite(value))
+                for value in after):
+            raise ValueError('Invalid cursor')
+    else:
+        after = None
+    return limit, after
+
+def keyset_after(columns, after, descending=False):
+    """Build a WHERE fragment selecting the rows that sort after the cursor.
+
+    (a, b) > (x, y) is expanded to a > x OR (a = x AND b > y) so MySQL can
+    use an index on the columns.
+    """
+    if len(after) != len(columns):
+        raise ValueError('Invalid cursor')
+    operator = '<' if descending else '>'
+    clauses = []
+    params = []
+    for i, column in enumerate(columns):
+        parts = [f"{previous} = %s" for previous in columns[:i]] + [f"{column} {operator} %s"]
+        clauses.append("(" + " AND ".join(parts) + ")")
+        params.extend(after[:i + 1])
+    return "(" + " OR ".join(clauses) + ")", params
+
+def page_fetch_limit(limit):
+    """Rows to SELECT for a page: one look-ahead row, or all of them"""
+    # MySQL's documented way of saying "no limit" in a LIMIT clause
+    return 18446744073709551615 if limit is None else limit + 1
+
+def split_page(rows, limit, key):
+    """Drop the look-ahead row and return (rows, next cursor or None)"""
+    rows = rows or []
+    if limit is None or len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    # str() renders dates the way MySQL parses them back
+    cursor = json.dumps(key(rows[-1]), default=str)
+    return rows, base64.urlsafe_b64encode(cursor.encode('utf-8')).decode('ascii').rstrip('=')
+
+def page_response(body, next_cursor):
+    response = jsonify(body)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
+# Metrics in the Prometheus text format, served at /metrics. Every thread
+# records into its own shard, so observing never takes a lock (only a
+# thread's first observation briefly does, to register its shard); a scrape
+# sums the shards. Shards of finished threads are folded into one on scrape
+# and every METRICS_RETIRE_INTERVAL, so they stay bounded without scrapes.
+METRICS = []
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        for _, value in pairs
+    )
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+class ShardedMetric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.local = threading.local()
+        self.shards = []
+        self.retired = {}
+        self.shards_lock = threading.Lock()
+        METRICS.append(self)
+
+    def shard(self):
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = self.local.shard = {}
+            with self.shards_lock:
+                self.shards.append((threading.current_thread(), shard))
+            start_metrics_retirer()
+        return shard
+
+    def retire_finished(self):
+        """Fold the shards of finished threads into retired; needs shards_lock"""
+        live = []
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                self.add_into(self.retired, shard)
+        self.shards = live
+
+    def merged(self):
+        """Sum the series of all shards"""
+        with self.shards_lock:
+            self.retire_finished()
+            totals = {}
+            self.add_into(totals, self.retired)
+            for _, shard in self.shards:
+                self.add_into(totals, shard)
+        return totals
+
+    def add_into(self, totals, shard):
+        for labels, series in list(shard.items()):
+            target = totals.setdefault(labels, self.new_series())
+            for index, value in enumerate(list(series)):
+                target[index] += value
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for labels, series in sorted(self.merged().items()):
+            lines.extend(self.series_lines(labels, series))
+        return lines
+
+class MetricCounter(ShardedMetric):
+    kind = 'counter'
+
+    def new_series(self):
+        return [0]
+
+    def inc(self, *labels, amount=1):
+        shard = self.shard()
+        series = shard.get(labels)
+        if series is None:
+            series = shard[labels] = self.new_series()
+        series[0] += amount
+
+    def series_lines(self, labels, series):
+        return [f"{self.name}{format_labels(self.labelnames, labels)} {series[0]}"]
+
+class MetricHistogram(ShardedMetric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def new_series(self):
+        # One count per bucket, then +Inf, then the sum
+        return [0] * (len(self.buckets) + 1) + [0.0]
+
+    def observe(self, value, *labels):
+        shard = self.shard()
+        series = shard.get(labels)
+        if series is None:
+            series = shard[labels] = self.new_series()
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def series_lines(self, labels, series):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), series):
+            cumulative += count
+            le = format_labels(self.labelnames, labels, [('le', bound)])
+            lines.append(f"{self.name}_bucket{le} {cumulative}")
+        label_text = format_labels(self.labelnames, labels)
+        lines.append(f"{self.name}_sum{label_text} {series[-1]}")
+        lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+metrics_retirer = None
+metrics_retirer_lock = threading.Lock()
+
+def run_metrics_retirer():
+    while True:
+        time.sleep(app.config['METRICS_RETIRE_INTERVAL'])
+        for metric in METRICS:
+            with metric.shards_lock:
+                metric.retire_finished()
+
+def start_metrics_retirer():
+    """Start the background retire thread once per process"""
+    global metrics_retirer
+    if metrics_retirer is not None:
+        return
+    with metrics_retirer_lock:
+        if metrics_retirer is None:
+            metrics_retirer = threading.Thread(
+                target=run_metrics_retirer,
+                name='metrics-retirer',
+                daemon=True
+            )
+            metrics_retirer.start()
+
+def observe_duration(histogram, *labels):
+    """Decorator recording how long each call of the function takes"""
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, *labels)
+        return decorated
+    return decorator
+
+REQUEST_LATENCY = MetricHistogram(
+    'http_request_duration_seconds', 'Time spent handling HTTP requests',
+    ('method', 'route', 'status')
+)
+REQUEST_QUERIES = MetricHistogram(
+    'http_request_db_queries', 'Database queries run per HTTP request',
+    ('route',), buckets=(1, 2, 5, 10, 20, 50, 100, 200)
+)
+DB_QUERY_LATENCY = MetricHistogram(
+    'db_query_duration_seconds', 'Time spent executing database statements',
+    ('operation',)
+)
+EMAIL_LATENCY = MetricHistogram('email_send_duration_seconds', 'Time spent sending emails')
+EMAIL_FAILURES = MetricCounter('email_send_failures_total', 'Emails that could not be sent')
+PDF_RENDER_LATENCY = MetricHistogram(
+    'pdf_render_duration_seconds', 'Time spent rendering PDF documents', ('document',)
+)
+YOUTUBE_LATENCY = MetricHistogram(
+    'youtube_request_duration_seconds', 'Time spent on YouTube oEmbed requests', ('outcome',)
+)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get('request_started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_LATENCY.observe(time.perf_counter() - started, request.method, route, response.status_code)
+        stats = g.get('query_stats')
+        REQUEST_QUERIES.observe(stats['count'] if stats else 0, route)
+    return response
+
+def metrics_client_address():
+    """The scraper's address, taken from X-Forwarded-For behind a trusted proxy"""
+    address = request.remote_addr
+    forwarded = request.headers.get('X-Forwarded-For')
+    if forwarded and address in app.config['METRICS_TRUSTED_PROXIES']:
+        # The proxy appends the peer it saw; earlier entries are client supplied
+        address = forwarded.split(',')[-1].strip()
+    return address
+
+def metrics_access_allowed():
+    token = app.config['METRICS_TOKEN']
+    auth_header = request.headers.get('Authorization', '')
+    if token and auth_header.startswith('Bearer '):
+        return hmac.compare_digest(auth_header[len('Bearer '):], token)
+    allowed = app.config['METRICS_ALLOWED_ADDRESSES']
+    return allowed is None or metrics_client_address() in allowed
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Expose the metrics in the Prometheus text format"""
+    if not metrics_access_allowed():
+        return jsonify({'message': 'Forbidden'}), 403
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.collect())
+    lines.extend([
+        "# HELP log_records_dropped_total Log records dropped because the log queue was full",
+        "# TYPE log_records_dropped_total counter",
+        f"log_records_dropped_total {DroppingQueueHandler.dropped}"
+    ])
+    return Response("\n".join(lines) + "\n", mimetype='text/plain; version=0.0.4')
+
+# Query instrumentation: every statement run through execute_query or
+# execute_many is counted per request, with its duration and normalized
+# text. A request over QUERY_BUDGET, or running one statement more than
+# QUERY_REPEAT_LIMIT times (an N+1 pattern), logs a warning when it ends.
+query_capture = threading.local()
+SQL_LITERALS = re.compile(r"'(?:[^'\\]|\\.|'')*'|\b\d+(?:\.\d+)?\b")
+SQL_PLACEHOLDER_LISTS = re.compile(r"\(\s*(?:%s|\?)(?:\s*,\s*(?:%s|\?))*\s*\)")
+
+def normalize_sql(query):
+    """Collapse whitespace, literals and IN lists so repeats of a statement match"""
+    query = SQL_LITERALS.sub('?', ' '.join(query.split()))
+    return SQL_PLACEHOLDER_LISTS.sub('(...)', query)
+
+# Slow queries: statements slower than SLOW_QUERY_THRESHOLD are logged with
+# their normalized text, parameter types (never values), duration and route.
+# The first time a statement is slow its EXPLAIN plan is captured; the most
+# recent SLOW_QUERY_BUFFER_SIZE distinct statements are kept for
+# /admin/slow-queries.
+slow_queries = OrderedDict()
+slow_queries_lock = threading.Lock()
+
+def params_shape(params, many=False):
+    if many:
+        rows = params if isinstance(params, (list, tuple)) else []
+        return f"{len(rows)} x {params_shape(rows[0]) if rows else '()'}"
+    if isinstance(params, dict):
+        return '{' + ', '.join(f"{key}: {type(value).__name__}" for key, value in params.items()) + '}'
+    return '(' + ', '.join(type(value).__name__ for value in (params or ())) + ')'
+
+def explain_query(query, params):
+    """Get the EXPLAIN plan of a statement, or None if it cannot be explained"""
+    try:
+        return execute_query("EXPLAIN " + query, params, fetch_all=True)
+    except Exception as e:
+        db_logger.warning(f"Could not EXPLAIN slow query: {str(e)}")
+        return None
+
+def record_slow_query(query, duration, params, many, statement):
+    if has_request_context():
+        route = f"{request.method} {request.url_rule.rule if request.url_rule else request.path}"
+    else:
+        route = threading.current_thread().name
+    shape = params_shape(params, many)
+    fingerprint = hashlib.sha1(statement.encode('utf-8')).hexdigest()[:12]
+    db_logger.warning(
+        f"Slow query {fingerprint} ({duration * 1000:.1f} ms) in {route}: {statement[:500]} params={shape}"
+    )
+
+    now = datetime.now(timezone.utc)
+    with slow_queries_lock:
+        entry = slow_queries.pop(fingerprint, None)
+        first_occurrence = entry is None
+        if first_occurrence:
+            entry = {
+                'fingerprint': fingerprint,
+                'statement': statement,
+                'params_shape': shape,
+                'first_route': route,
+                'first_seen': now,
+                'count': 0,
+                'max_ms': 0.0,
+                'total_ms': 0.0,
+                'explain': None
+            }
+        entry['count'] += 1
+        entry['max_ms'] = max(entry['max_ms'], duration * 1000)
+        entry['total_ms'] += duration * 1000
+        entry['last_route'] = route
+        entry['last_seen'] = now
+        slow_queries[fingerprint] = entry
+        while len(slow_queries) > app.config['SLOW_QUERY_BUFFER_SIZE']:
+            slow_queries.popitem(last=False)
+
+    explainable = query.lstrip()[:6].lower() in ('select', 'update', 'delete')
+    if first_occurrence and explainable and not many and app.config['SLOW_QUERY_EXPLAIN']:
+        entry['explain'] = explain_query(query, params)
+
+def record_query(query, duration, params=None, many=False):
+    operation = query.lstrip()[:6].lower()
+    if operation not in ('select', 'insert', 'update', 'delete'):
+        operation = 'other'
+    DB_QUERY_LATENCY.observe(duration, operation)
+    statement = None
+    threshold = app.config['SLOW_QUERY_THRESHOLD']
+    if threshold is not None and duration >= threshold and not query.startswith('EXPLAIN '):
+        statement = normalize_sql(query)
+        record_slow_query(query, duration, params, many, statement)
+    if has_request_context():
+        stats = g.get('query_stats')
+        if stats is None:
+            stats = g.query_stats = {'count': 0, 'time': 0.0, 'statements': Counter()}
+        statement = statement or normalize_sql(query)
+        stats['count'] += 1
+        stats['time'] += duration
+        stats['statements'][statement] += 1
+    captured = getattr(query_capture, 'statements', None)
+    if captured is not None:
+        captured.append(statement or normalize_sql(query))
+
+@contextmanager
+def count_queries():
+    """Collect the normalized statements executed by this thread, e.g.
+
+        with count_queries() as statements:
+            client.get('/modules', headers=headers)
+        assert len(statements) <= 3
+    """
+    previous = getattr(query_capture, 'statements', None)
+    query_capture.statements = statements = []
+    try:
+        yield statements
+    finally:
+        query_capture.statements = previous
+
+@contextmanager
+def assert_max_queries(limit):
+    """Fail with the executed statements if the block runs more than limit queries"""
+    with count_queries() as statements:
+        yield statements
+    if len(statements) > limit:
+        raise AssertionError(
+            f"{len(statements)} queries executed, expected at most {limit}:\n" +
+            "\n".join(statements)
+        )
+
+def timed_execute(cursor, query, params=(), fetch_one=False):
+    """Run a statement on a caller-managed cursor and record it like execute_query"""
+    started = time.perf_counter()
+    try:
+        cursor.execute(query, params)
+        return cursor.fetchone() if fetch_one else None
+    finally:
+        record_query(query, time.perf_counter() - started, params)
+
+@app.after_request
+def report_query_stats(response):
+    stats = g.get('query_stats')
+    if not stats:
+        return response
+    repeated = [
+        (statement, times) for statement, times in stats['statements'].most_common(3)
+        if times > app.config['QUERY_REPEAT_LIMIT']
+    ]
+    if repeated:
+        db_logger.warning(
+            f"Possible N+1 in {request.method} {request.path}: " +
+            "; ".join(f"{times}x {statement[:200]}" for statement, times in repeated)
+        )
+    if stats['count'] > app.config['QUERY_BUDGET']:
+        db_logger.warning(
+            f"{request.method} {request.path} ran {stats['count']} queries "
+            f"({stats['time'] * 1000:.1f} ms), budget is {app.config['QUERY_BUDGET']}"
+        )
+    if app.config['QUERY_STATS_HEADERS']:
+        response.headers['X-Query-Count'] = str(stats['count'])
+        response.headers['X-Query-Time'] = f"{stats['time'] * 1000:.1f}"
+    return response
+
 def execute_query(query, params=None, fetch_one=False, fetch_all=False, lastrowid=False):
     conn = None
     cursor = None
+    # Only the statement itself is timed; connecting and committing are not
+    started = None
+    duration = None
     try:
         conn = get_db_connection()
         if conn is None:
             raise Exception("Database connection could not be established")
         cursor = conn.cursor()
+        started = time.perf_counter()
         cursor.execute(query, params or ())
 
         if lastrowid:
+            duration = time.perf_counter() - started
             conn.commit()
             result = cursor.lastrowid
         elif fetch_one:
             result = cursor.fetchone()
+            duration = time.perf_counter() - started
             # Consume any remaining results
         elif fetch_all:
             result = cursor.fetchall()
+            duration = time.perf_counter() - started
         else:
+            duration = time.perf_counter() - started
             result = None
             conn.commit()
 
@@ -169,6 +884,425 @@ def execute_query(query, params=None, fetch_one=False, fetch_all=False, lastrowi
             cursor.close()
         if conn:
             conn.close()
+        if started is not None:
+            record_query(query, duration if duration is not None else time.perf_counter() - started, params)
+def execute_many(query, seq_params):
+    """Execute a write for every parameter tuple in one batch and commit"""
+    conn = None
+    cursor = None
+    started = None
+    duration = None
+    try:
+        conn = get_db_connection()
+        if conn is None:
+            raise Exception("Database connection could not be established")
+        cursor = conn.cursor()
+        started = time.perf_counter()
+        cursor.executemany(query, seq_params)
+        duration = time.perf_counter() - started
+        conn.commit()
+        return cursor.rowcount
+    except Exception as e:
+        app.logger.error(f"Database error: {str(e)}")
+        if conn:
+            conn.rollback()
+        raise
+    finally:
+        if cursor:
+            cursor.close()
+        if conn:
+            conn.close()
+        if started is not None:
+            record_query(
+                query, duration if duration is not None else time.perf_counter() - started,
+                seq_params, many=True
+            )
+# Tables maintained by the application itself, created on first request
+SCHEMA_STATEMENTS = [
+    """
+    CREATE TABLE IF NOT EXISTS user_module_progress (
+        user_id INT NOT NULL,
+        module_id INT NOT NULL,
+        completed_count INT NOT NULL DEFAULT 0,
+        total_count INT NOT NULL DEFAULT 0,
+        quiz_passed BOOLEAN NOT NULL DEFAULT FALSE,
+        completed_at DATETIME NULL,
+        updated_at DATETIME NOT NULL,
+        PRIMARY KEY (user_id, module_id),
+        KEY idx_user_module_progress_module (module_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS module_prerequisites (
+        module_id INT NOT NULL,
+        prerequisite_module_id INT NOT NULL,
+        PRIMARY KEY (module_id, prerequisite_module_id),
+        KEY idx_module_prerequisites_prerequisite (prerequisite_module_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS catalogue_versions (
+        module_id INT NOT NULL PRIMARY KEY,
+        version BIGINT NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS user_state_versions (
+        user_id INT NOT NULL PRIMARY KEY,
+        version BIGINT NOT NULL DEFAULT 0
+    )
+    """,
+    "CREATE INDEX idx_notifications_user_feed ON notifications (user_id, is_read, created_at, id)",
+    """
+    CREATE TABLE IF NOT EXISTS offline_items (
+        user_id INT NOT NULL,
+        content_id INT NOT NULL,
+        size BIGINT NOT NULL,
+        checksum CHAR(64) NOT NULL,
+        stored_at DATETIME NOT NULL,
+        PRIMARY KEY (user_id, content_id),
+        KEY idx_offline_items_checksum (checksum)
+    )
+    """,
+    "ALTER TABLE offline_items ADD COLUMN last_accessed_at DATETIME NULL",
+    "CREATE INDEX idx_offline_items_user_access ON offline_items (user_id, last_accessed_at)",
+    "ALTER TABLE youtube_videos ADD COLUMN is_embeddable BOOLEAN NULL",
+    "ALTER TABLE youtube_videos ADD COLUMN checked_at DATETIME NULL",
+    "CREATE INDEX idx_youtube_videos_video_id ON youtube_videos (youtube_video_id)",
+    """
+    CREATE TABLE IF NOT EXISTS notification_counters (
+        user_id INT NOT NULL PRIMARY KEY,
+        unread_count INT NOT NULL DEFAULT 0
+    )
+    """,
+    "CREATE INDEX idx_user_certificates_history ON user_certificates (user_id, generated_at, id)",
+    "CREATE INDEX idx_assignments_due ON assignments (due_date, id)",
+]
+schema_ready = False
+schema_lock = threading.Lock()
+
+def ensure_schema():
+    """Create missing application tables, indexes and columns"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        for statement in SCHEMA_STATEMENTS:
+            try:
+                cursor.execute(statement)
+            except mysql.connector.Error as e:
+                # Duplicate column (1060) or index (1061): already applied
+                if e.errno not in (1060, 1061):
+                    raise
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+
+@app.before_request
+def prepare_schema():
+    global schema_ready
+    if schema_ready:
+        return
+    with schema_lock:
+        if schema_ready:
+            return
+        try:
+            ensure_schema()
+            schema_ready = True
+            start_youtube_refresher()
+        except Exception as e:
+            app.logger.error(f"Failed to prepare database schema: {str(e)}")
+
+# Per-user state version: bumped whenever a user's progress, quiz results,
+# badges, certificates, notifications or offline copies change. Together with
+# the catalogue versions it identifies what a learner endpoint would return.
+def bump_user_state_version(*user_ids):
+    """Mark the state of the given users as changed"""
+    user_ids = sorted(set(user_ids))
+    if not user_ids:
+        return
+    execute_many(
+        "INSERT INTO user_state_versions (user_id, version) VALUES (%s, 1) "
+        "ON DUPLICATE KEY UPDATE version = version + 1",
+        [(user_id,) for user_id in user_ids]
+    )
+
+def get_user_state_version(user_id):
+    result = execute_query(
+        "SELECT version FROM user_state_versions WHERE user_id = %s",
+        (user_id,),
+        fetch_one=True
+    )
+    return result['version'] if result else 0
+
+def get_dashboard_counters(trainer=None):
+    """Get user and module counters for the dashboards in a single round trip.
+
+    Without a trainer the counters cover the whole platform; for a trainer,
+    users are scoped to their employer and modules to the ones they created.
+    """
+    user_filter = ""
+    module_filter = ""
+    params = ()
+    if trainer is not None:
+        user_filter = "WHERE employer_id = %s"
+        module_filter = "WHERE created_by = %s"
+        params = (trainer.get('employer_id'), trainer['id'])
+
+    result = execute_query(
+        "SELECT u.total_users, u.active_users, m.total_modules, m.active_modules "
+        "FROM (SELECT COUNT(*) as total_users, "
+        "COALESCE(SUM(CASE WHEN is_active = TRUE THEN 1 ELSE 0 END), 0) as active_users "
+        f"FROM users {user_filter}) u "
+        "CROSS JOIN (SELECT COUNT(*) as total_modules, "
+        "COALESCE(SUM(CASE WHEN is_active = TRUE THEN 1 ELSE 0 END), 0) as active_modules "
+        f"FROM modules {module_filter}) m",
+        params,
+        fetch_one=True
+    )
+
+    counters = {
+        'total_users': 0,
+        'active_users': 0,
+        'total_modules': 0,
+        'active_modules': 0
+    }
+    if result:
+        counters = {key: int(result[key] or 0) for key in counters}
+    return counters
+
+def get_recent_activity(trainer=None, limit=10):
+    """Get the latest learner progress events, scoped to a trainer's employer if given"""
+    query = (
+        "SELECT u.first_name, u.last_name, m.title as module_title, "
+        "up.status, up.last_accessed "
+        "FROM user_progress up "
+        "JOIN users u ON up.user_id = u.id "
+        "JOIN module_content mc ON up.content_id = mc.id "
+        "JOIN modules m ON mc.module_id = m.id "
+    )
+    params = ()
+    if trainer is not None:
+        query += "WHERE u.employer_id = %s "
+        params = (trainer.get('employer_id'),)
+    query += "ORDER BY up.last_accessed DESC LIMIT %s"
+
+    return execute_query(query, params + (limit,), fetch_all=True) or []
+
+# In-process event bus behind /notifications/stream. Every open stream owns a
+# bounded queue; publishers never block, and a stream that falls behind drops
+# events (the client catches up through GET /notifications on reconnect).
+event_subscribers = {}
+event_subscribers_lock = threading.Lock()
+event_ids = itertools.count(1)
+
+def subscribe_events(user_id):
+    events = queue.Queue(maxsize=app.config['EVENT_QUEUE_SIZE'])
+    with event_subscribers_lock:
+        event_subscribers.setdefault(user_id, set()).add(events)
+    return events
+
+def unsubscribe_events(user_id, events):
+    with event_subscribers_lock:
+        streams = event_subscribers.get(user_id)
+        if streams:
+            streams.discard(events)
+            if not streams:
+                del event_subscribers[user_id]
+
+def get_subscribed_user_ids():
+    with event_subscribers_lock:
+        return set(event_subscribers)
+
+def publish_event(user_id, event_type, data):
+    """Push an event to every open stream of a user"""
+    with event_subscribers_lock:
+        streams = list(event_subscribers.get(user_id, ()))
+    if not streams:
+        return
+    event = (next(event_ids), event_type, data)
+    for events in streams:
+        try:
+            events.put_nowait(event)
+        except queue.Full:
+            app.logger.warning(f"Event stream for user {user_id} is full, dropping {event_type} event")
+
+def create_notification(user_id, title, message, notification_type):
+    """Store a notification and push it to the user's open streams"""
+    conn = None
+    cursor = None
+    try:
+        conn = get_db_connection()
+        if conn is None:
+            raise Exception("Database connection could not be established")
+        cursor = conn.cursor()
+        # The row and the counter increment commit together, so the counter
+        # cannot miss a notification or count one that was rolled back
+        timed_execute(
+            cursor,
+            "INSERT INTO notifications (user_id, title, message, notification_type, is_read) "
+            "VALUES (%s, %s, %s, %s, FALSE)",
+            (user_id, title, message, notification_type)
+        )
+        notification_id = cursor.lastrowid
+        # A missing counter is initialised from the rows, which include this one
+        timed_execute(
+            cursor,
+            "INSERT INTO notification_counters (user_id, unread_count) "
+            "SELECT %s, COUNT(*) FROM notifications WHERE user_id = %s AND is_read = FALSE "
+            "ON DUPLICATE KEY UPDATE unread_count = unread_count + 1",
+            (user_id, user_id)
+        )
+        conn.commit()
+    except Exception as e:
+        app.logger.error(f"Database error: {str(e)}")
+        if conn:
+            conn.rollback()
+        raise
+    finally:
+        if cursor:
+            cursor.close()
+        if conn:
+            conn.close()
+    bump_user_state_version(user_id)
+    publish_event(user_id, 'notification', {
+        'id': notification_id,
+        'title': title,
+        'message': message,
+        'notification_type': notification_type,
+        'is_read': False,
+        'created_at': datetime.now(timezone.utc)
+    })
+    return notification_id
+
+def get_unread_notification_count(user_id):
+    """Get the user's unread notification count from notification_counters"""
+    result = execute_query(
+        "SELECT unread_count FROM notification_counters WHERE user_id = %s",
+        (user_id,),
+        fetch_one=True
+    )
+    if result:
+        return result['unread_count']
+
+    execute_query(
+        "INSERT IGNORE INTO notification_counters (user_id, unread_count) "
+        "SELECT %s, COUNT(*) FROM notifications WHERE user_id = %s AND is_read = FALSE",
+        (user_id, user_id)
+    )
+    result = execute_query(
+        "SELECT unread_count FROM notification_counters WHERE user_id = %s",
+        (user_id,),
+        fetch_one=True
+    )
+    return result['unread_count'] if result else 0
+
+def mark_notifications_as_read(user_id, notification_ids=None, until=None):
+    """Mark unread notifications as read and return how many changed.
+
+    Limited to notification_ids and/or notifications created up to until
+    (a naive UTC datetime); all unread notifications when neither is given. Already read rows are
+    not touched, and the counter is decremented in the same transaction.
+    """
+    query = "UPDATE notifications SET is_read = TRUE WHERE user_id = %s AND is_read = FALSE"
+    params = [user_id]
+    if notification_ids is not None:
+        if not notification_ids:
+            return 0
+        query += f" AND id IN ({', '.join(['%s'] * len(notification_ids))})"
+        params.extend(notification_ids)
+    if until is not None:
+        # until is naive UTC; created_at is filled by CURRENT_TIMESTAMP in
+        # the session time zone
+        query += " AND created_at <= CONVERT_TZ(%s, '+00:00', @@session.time_zone)"
+        params.append(until)
+
+    conn = None
+    cursor = None
+    try:
+        conn = get_db_connection()
+        if conn is None:
+            raise Exception("Database connection could not be established")
+        cursor = conn.cursor()
+        timed_execute(cursor, query, tuple(params))
+        marked = cursor.rowcount
+        if marked:
+            timed_execute(
+                cursor,
+                "UPDATE notification_counters SET unread_count = GREATEST(unread_count - %s, 0) "
+                "WHERE user_id = %s",
+                (marked, user_id)
+            )
+        conn.commit()
+    except Exception as e:
+        app.logger.error(f"Database error: {str(e)}")
+        if conn:
+            conn.rollback()
+        raise
+    finally:
+        if cursor:
+            cursor.close()
+        if conn:
+            conn.close()
+
+    if marked:
+        bump_user_state_version(user_id)
+    return marked
+
+def publish_badge_awarded(user_id, badge_id):
+    """Push a badge_awarded event for the achievement popup"""
+    if user_id not in get_subscribed_user_ids():
+        return
+    badge = execute_query(
+        "SELECT * FROM badges WHERE id = %s",
+        (badge_id,),
+        fetch_one=True
+    )
+    publish_event(user_id, 'badge_awarded', badge or {'id': badge_id})
+
+def publish_rank_changes(user_id, previous_points, total_points):
+    """Push leaderboard_rank_changed to connected users whose rank moved
+    because user_id's points went from previous_points to total_points"""
+    subscribed = get_subscribed_user_ids()
+    if not subscribed or previous_points == total_points:
+        return
+
+    if user_id in subscribed:
+        result = execute_query(
+            "SELECT COALESCE(SUM(total_points > %s), 0) AS above_before, "
+            "COALESCE(SUM(total_points > %s), 0) AS above_after "
+            "FROM leaderboard WHERE user_id != %s",
+            (previous_points, total_points, user_id),
+            fetch_one=True
+        )
+        if result and result['above_before'] != result['above_after']:
+            publish_event(user_id, 'leaderboard_rank_changed', {
+                'rank': int(result['above_after']) + 1,
+                'previous_rank': int(result['above_before']) + 1,
+                'total_points': int(total_points)
+            })
+
+    # Users between the old and new score moved one place
+    others = subscribed - {user_id}
+    if others:
+        placeholders = ", ".join(["%s"] * len(others))
+        low, high = min(previous_points, total_points), max(previous_points, total_points)
+        moved = execute_query(
+            "SELECT l.user_id, l.total_points, "
+            "(SELECT COUNT(*) FROM leaderboard o WHERE o.total_points > l.total_points) + 1 AS rank "
+            f"FROM leaderboard l WHERE l.user_id IN ({placeholders}) "
+            "AND l.total_points >= %s AND l.total_points < %s",
+            tuple(others) + (low, high),
+            fetch_all=True
+        ) or []
+        step = 1 if total_points > previous_points else -1
+        for row in moved:
+            publish_event(row['user_id'], 'leaderboard_rank_changed', {
+                'rank': row['rank'],
+                'previous_rank': row['rank'] - step,
+                'total_points': int(row['total_points'])
+            })
+
 # Helper functions
 def check_quiz_badges(user_id, quiz_id, quiz_score):
     """Check and award badges based on quiz performance"""
@@ -250,6 +1384,8 @@ def award_badge_direct(user_id, badge_id):
         "VALUES (%s, %s, %s)",
         (user_id, badge_id, datetime.now(timezone.utc))
     )
+    bump_user_state_version(user_id)
+    publish_badge_awarded(user_id, badge_id)
     
     # Log the badge award
     app.logger.info(f"User {user_id} awarded badge {badge_id}")
@@ -265,6 +1401,10 @@ def token_required(f):
                 token = auth_header.split(" ")[1]
         elif 'x-access-token' in request.headers:
             token = request.headers['x-access-token']
+        elif request.endpoint == 'stream_notifications':
+            # EventSource cannot send headers, so the stream takes the token from the URL;
+            # nowhere else, to keep tokens out of logged URLs
+            token = request.args.get('token')
             
         if not token:
             app.logger.warning('Token is missing in request')
@@ -309,7 +1449,45 @@ def trainer_required(f):
         return f(current_user, *args, **kwargs)
     return decorated
 
+def conditional_get(catalogue_scope=None):
+    """Answer GET requests with 304 Not Modified when nothing they read changed.
+
+    The weak ETag combines the user's state version with the catalogue
+    version selected by catalogue_scope: None (user state only), 'global',
+    'module' (the route's module_id) or 'all'. It is checked before the view
+    runs, so unchanged resources cost two small queries. Must be applied
+    below token_required.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(current_user, *args, **kwargs):
+            if catalogue_scope == 'module':
+                catalogue_version = get_catalogue_version(kwargs['module_id'])
+            elif catalogue_scope:
+                catalogue_version = get_catalogue_version(all_modules=catalogue_scope == 'all')
+            else:
+                catalogue_version = ''
+            fingerprint = (
+                f"{request.full_path}|{current_user['id']}|"
+                f"{get_user_state_version(current_user['id'])}|{catalogue_version}"
+            )
+            etag = hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()[:20]
+
+            if request.if_none_match.contains_weak(etag):
+                response = make_response('', 304)
+            else:
+                response = make_response(f(current_user, *args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            # Let the browser keep the body but always revalidate it
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return decorated
+    return decorator
+
 def send_email(to, subject, template):
+    started = time.perf_counter()
     try:
         msg = Message(
             subject,
@@ -321,28 +1499,433 @@ def send_email(to, subject, template):
         app.logger.info(f"Email sent to {to}")
         return True
     except Exception as e:
+        EMAIL_FAILURES.inc()
         app.logger.error(f"Failed to send email to {to}: {str(e)}")
         return False
+    finally:
+        EMAIL_LATENCY.observe(time.perf_counter() - started)
+
+# Offline copies are stored once per distinct file in a content-addressed
+# blob store, OFFLINE_CONTENT_DIR/blobs/<sha256[:2]>/<sha256>. offline_items
+# rows are the per-user references: listings and quotas use each user's
+# logical size, and a blob is deleted when its last reference goes.
+# `flask reconcile-offline` rebuilds the index and collects orphaned blobs.
+source_checksums = OrderedDict()
+source_checksums_lock = threading.Lock()
+
+@contextmanager
+def database_lock(name, timeout=0):
+    """Hold a MySQL named lock, shared by every worker process, for the
+    duration of the block. Yields whether it was acquired within timeout
+    seconds; the lock is released with the connection that took it."""
+    conn = get_db_connection()
+    if conn is None:
+        raise Exception("Database connection could not be established")
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT GET_LOCK(%s, %s)", (name, timeout))
+        row = cursor.fetchone()
+        acquired = bool(row and row[0])
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                cursor.execute("SELECT RELEASE_LOCK(%s)", (name,))
+                cursor.fetchone()
+    finally:
+        cursor.close()
+        conn.close()
+
+@contextmanager
+def offline_blob_lock():
+    """Serialize adding and deleting blob references across workers"""
+    with database_lock('offline_blobs', app.config['OFFLINE_LOCK_TIMEOUT']) as acquired:
+        if not acquired:
+            raise OSError("Timed out waiting for the offline blob store lock")
+        yield
+
+def offline_root():
+    """Absolute OFFLINE_CONTENT_DIR; send_file would resolve a relative
+    path against the app root instead of the working directory"""
+    return os.path.realpath(app.config['OFFLINE_CONTENT_DIR'])
+
+def offline_blob_path(checksum):
+    return os.path.join(offline_root(), 'blobs', checksum[:2], checksum)
+
+def file_checksum(path):
+    """SHA-256 of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def source_checksum(path):
+    """SHA-256 of a content file, remembered until the file changes"""
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    with source_checksums_lock:
+        checksum = source_checksums.get(key)
+        if checksum is not None:
+            source_checksums.move_to_end(key)
+            return checksum
+    checksum = file_checksum(path)
+    with source_checksums_lock:
+        source_checksums[key] = checksum
+        while len(source_checksums) > app.config['SOURCE_CHECKSUM_CACHE_SIZE']:
+            source_checksums.popitem(last=False)
+    return checksum
+
+def store_offline_blob(source, checksum):
+    """Copy source into the blob store unless the blob already exists"""
+    target = offline_blob_path(checksum)
+    if os.path.exists(target):
+        return
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    temp_path = f"{target}.{threading.get_ident()}.part"
+    try:
+        digest = hashlib.sha256()
+        with open(source, 'rb') as src, open(temp_path, 'wb') as dst:
+            for chunk in iter(lambda: src.read(1024 * 1024), b''):
+                digest.update(chunk)
+                dst.write(chunk)
+        if digest.hexdigest() != checksum:
+            raise OSError(f"{source} changed while it was being copied")
+        os.replace(temp_path, target)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def serve_file(path, directory_key, etag, download_name, as_attachment=False, max_age=None):
+    """Send a file with a strong ETag and Range/If-Range support.
+
+    Python never copies the bytes: behind nginx the file is handed off with
+    X-Accel-Redirect, otherwise send_file passes the open file to the WSGI
+    server's file wrapper (sendfile under gunicorn), or emits X-Sendfile
+    when USE_X_SENDFILE is enabled.
+    """
+    path = os.path.realpath(path)
+    mimetype = mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+    location = app.config['X_ACCEL_REDIRECT_LOCATIONS'].get(directory_key)
+    if location:
+        if request.if_none_match.contains(etag):
+            response = make_response('', 304)
+        else:
+            relative = os.path.relpath(path, os.path.realpath(app.config[directory_key]))
+            response = make_response('')
+            response.headers['X-Accel-Redirect'] = location.rstrip('/') + '/' + relative.replace(os.sep, '/')
+            response.mimetype = mimetype
+            disposition = 'attachment' if as_attachment else 'inline'
+            response.headers.set('Content-Disposition', disposition, filename=download_name)
+        response.set_etag(etag)
+    else:
+        response = send_file(
+            path,
+            mimetype=mimetype,
+            as_attachment=as_attachment,
+            download_name=download_name,
+            conditional=True,
+            etag=etag,
+            max_age=max_age
+        )
+    if max_age is not None:
+        response.cache_control.no_cache = None
+        response.cache_control.max_age = max_age
+    # Files are only served to authenticated users
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+def release_offline_blob(checksum):
+    """Delete a blob once no offline_items row references it.
+
+    If the blob store lock cannot be taken the blob is left for
+    `flask reconcile-offline` to collect.
+    """
+    with database_lock('offline_blobs', app.config['OFFLINE_LOCK_TIMEOUT']) as acquired:
+        if not acquired:
+            app.logger.warning(f"Timed out waiting to release offline blob {checksum}; leaving it for reconcile")
+            return
+        referenced = execute_query(
+            "SELECT 1 FROM offline_items WHERE checksum = %s LIMIT 1",
+            (checksum,),
+            fetch_one=True
+        )
+        path = offline_blob_path(checksum)
+        if not referenced and os.path.exists(path):
+            os.remove(path)
+
+def record_offline_item(user_id, content_id, size, checksum):
+    now = datetime.now(timezone.utc)
+    execute_query(
+        "INSERT INTO offline_items (user_id, content_id, size, checksum, stored_at, last_accessed_at) "
+        "VALUES (%s, %s, %s, %s, %s, %s) "
+        "ON DUPLICATE KEY UPDATE size = VALUES(size), checksum = VALUES(checksum), "
+        "stored_at = VALUES(stored_at), last_accessed_at = VALUES(last_accessed_at)",
+        (user_id, content_id, size, checksum, now, now)
+    )
+
+def touch_offline_item(user_id, content_id):
+    """Record an access to an offline copy, at most once per OFFLINE_ACCESS_RESOLUTION"""
+    now = datetime.now(timezone.utc)
+    execute_query(
+        "UPDATE offline_items SET last_accessed_at = %s "
+        "WHERE user_id = %s AND content_id = %s "
+        "AND (last_accessed_at IS NULL OR last_accessed_at < %s)",
+        (now, user_id, content_id,
+         now - timedelta(seconds=app.config['OFFLINE_ACCESS_RESOLUTION']))
+    )
+
+def evict_user_offline_items(user_id, required, keep_content_id=None):
+    """Remove the user's least recently accessed copies until at least
+    `required` bytes are freed. Returns the evicted content ids, or None
+    (evicting nothing) if that much cannot be freed."""
+    rows = execute_query(
+        "SELECT content_id, size, checksum FROM offline_items WHERE user_id = %s "
+        "ORDER BY COALESCE(last_accessed_at, stored_at) ASC, content_id ASC",
+        (user_id,),
+        fetch_all=True
+    ) or []
+    victims = []
+    freed = 0
+    for row in rows:
+        if freed >= required:
+            break
+        if row['content_id'] == keep_content_id:
+            continue
+        victims.append(row)
+        freed += row['size']
+    if freed < required:
+        return None
+    if victims:
+        content_ids = [row['content_id'] for row in victims]
+        placeholders = ", ".join(["%s"] * len(content_ids))
+        execute_query(
+            f"DELETE FROM offline_items WHERE user_id = %s AND content_id IN ({placeholders})",
+            (user_id, *content_ids)
+        )
+        for checksum in {row['checksum'] for row in victims}:
+            release_offline_blob(checksum)
+        app.logger.info(f"Evicted offline content {content_ids} of user {user_id} to free {freed} bytes")
+    return [row['content_id'] for row in victims]
+
+def get_offline_disk_usage():
+    """Bytes held by the blob store, counting each shared blob once"""
+    result = execute_query(
+        "SELECT COALESCE(SUM(size), 0) AS total_size FROM "
+        "(SELECT MAX(size) AS size FROM offline_items GROUP BY checksum) blobs",
+        fetch_one=True
+    )
+    return int(result['total_size']) if result else 0
+
+offline_reclaimer = None
+offline_reclaimer_lock = threading.Lock()
+
+def reclaim_offline_disk(force=False):
+    """Evict least recently accessed blobs, with every reference to them,
+    while blob storage is over the high-water mark. Returns bytes freed."""
+    high_water = app.config['OFFLINE_DISK_HIGH_WATER']
+    if high_water is None:
+        return 0
+    # One reclaim at a time across all workers; unless forced, a concurrent
+    # caller has nothing left to do
+    timeout = app.config['OFFLINE_LOCK_TIMEOUT'] if force else 0
+    with database_lock('offline_reclaim', timeout) as acquired:
+        if not acquired:
+            return 0
+        return reclaim_offline_disk_locked(high_water)
+
+def reclaim_offline_disk_locked(high_water):
+    usage = get_offline_disk_usage()
+    if usage <= high_water:
+        return 0
+    low_water = app.config['OFFLINE_DISK_LOW_WATER']
+    if low_water is None:
+        low_water = int(high_water * 0.9)
+
+    blobs = execute_query(
+        "SELECT checksum, MAX(size) AS size, "
+        "MAX(COALESCE(last_accessed_at, stored_at)) AS last_access "
+        "FROM offline_items GROUP BY checksum ORDER BY last_access ASC",
+        fetch_all=True
+    ) or []
+    freed = 0
+    changed_users = set()
+    for blob in blobs:
+        if usage - freed <= low_water:
+            break
+        users = execute_query(
+            "SELECT user_id FROM offline_items WHERE checksum = %s",
+            (blob['checksum'],),
+            fetch_all=True
+        ) or []
+        execute_query("DELETE FROM offline_items WHERE checksum = %s", (blob['checksum'],))
+        release_offline_blob(blob['checksum'])
+        changed_users.update(user['user_id'] for user in users)
+        freed += blob['size']
+
+    bump_user_state_version(*changed_users)
+    app.logger.info(
+        f"Reclaimed {freed} bytes of offline storage from {len(changed_users)} users "
+        f"(usage was {usage}, high-water mark {high_water})"
+    )
+    return freed
+
+def run_offline_reclaim():
+    try:
+        reclaim_offline_disk()
+    except Exception as e:
+        app.logger.error(f"Error reclaiming offline storage: {str(e)}")
+
+def schedule_offline_reclaim():
+    """Reclaim blob storage in the background, one thread per process"""
+    global offline_reclaimer
+    if app.config['OFFLINE_DISK_HIGH_WATER'] is None:
+        return
+    with offline_reclaimer_lock:
+        if offline_reclaimer is None or not offline_reclaimer.is_alive():
+            offline_reclaimer = threading.Thread(
+                target=run_offline_reclaim,
+                name='offline-reclaim',
+                daemon=True
+            )
+            offline_reclaimer.start()
 
 def calculate_offline_size(user_id):
     """Calculate the total size of offline content for a user"""
-    total_size = 0
-    offline_dir = os.path.join(app.config['OFFLINE_CONTENT_DIR'], str(user_id))
-    if os.path.exists(offline_dir):
-        for dirpath, _, filenames in os.walk(offline_dir):
-            for f in filenames:
-                fp = os.path.join(dirpath, f)
-                total_size += os.path.getsize(fp)
-    return total_size
+    result = execute_query(
+        "SELECT COALESCE(SUM(size), 0) AS total_size FROM offline_items WHERE user_id = %s",
+        (user_id,),
+        fetch_one=True
+    )
+    return int(result['total_size']) if result else 0
+
+def get_offline_content_ids(user_id):
+    """Get the ids of the content the user has stored offline"""
+    rows = execute_query(
+        "SELECT content_id FROM offline_items WHERE user_id = %s",
+        (user_id,),
+        fetch_all=True
+    ) or []
+    return {row['content_id'] for row in rows}
 
 def check_offline_access(user_id, content_id):
     """Check if content is available offline for a user"""
-    offline_path = os.path.join(
-        app.config['OFFLINE_CONTENT_DIR'],
-        str(user_id),
-        str(content_id)
+    result = execute_query(
+        "SELECT 1 FROM offline_items WHERE user_id = %s AND content_id = %s",
+        (user_id, content_id),
+        fetch_one=True
     )
-    return os.path.exists(offline_path)
+    return bool(result)
+
+def resolve_content_file(file_path):
+    """Resolve a module_content.file_path inside CONTENT_FILES_DIR, or None"""
+    if not file_path:
+        return None
+    base = os.path.realpath(app.config['CONTENT_FILES_DIR'])
+    path = os.path.realpath(os.path.join(base, file_path))
+    if os.path.commonpath([base, path]) != base or not os.path.isfile(path):
+        return None
+    return path
+
+@app.cli.command('reconcile-offline')
+@click.option('--user-id', type=int, default=None, help='Only reconcile this user.')
+def reconcile_offline_command(user_id):
+    """Rebuild the offline_items index and collect unreferenced blobs.
+
+    Per-user copies left from the OFFLINE_CONTENT_DIR/<user_id>/<content_id>
+    layout are moved into the blob store. With --user-id only that user's
+    copies and references are reconciled, and no blobs are collected.
+    """
+    root = offline_root()
+    migrated = dropped = collected = 0
+    changed_users = set()
+
+    # 1. Move legacy per-user copies into the blob store
+    if user_id is not None:
+        user_dirs = [str(user_id)]
+    else:
+        user_dirs = os.listdir(root) if os.path.isdir(root) else []
+    for user_dir in user_dirs:
+        directory = os.path.join(root, user_dir)
+        if not user_dir.isdigit() or not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if not name.isdigit() or not os.path.isfile(path):
+                continue
+            checksum = file_checksum(path)
+            size = os.path.getsize(path)
+            target = offline_blob_path(checksum)
+            if os.path.exists(target):
+                os.remove(path)
+            else:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(path, target)
+            record_offline_item(int(user_dir), int(name), size, checksum)
+            changed_users.add(int(user_dir))
+            migrated += 1
+        if not os.listdir(directory):
+            os.rmdir(directory)
+
+    # 2. Drop references to blobs that are missing
+    user_filter = " WHERE user_id = %s" if user_id is not None else ""
+    user_params = (user_id,) if user_id is not None else ()
+    rows = execute_query(
+        "SELECT DISTINCT checksum FROM offline_items" + user_filter,
+        user_params,
+        fetch_all=True
+    ) or []
+    referenced = set()
+    for row in rows:
+        if os.path.exists(offline_blob_path(row['checksum'])):
+            referenced.add(row['checksum'])
+            continue
+        checksum_filter = (" AND" if user_filter else " WHERE") + " checksum = %s"
+        users = execute_query(
+            "SELECT user_id FROM offline_items" + user_filter + checksum_filter,
+            user_params + (row['checksum'],),
+            fetch_all=True
+        ) or []
+        execute_query(
+            "DELETE FROM offline_items" + user_filter + checksum_filter,
+            user_params + (row['checksum'],)
+        )
+        changed_users.update(user['user_id'] for user in users)
+        dropped += len(users)
+
+    # 3. Collect blobs nothing references, and partial copies; the blob
+    # store is shared, so this only runs for a full reconcile
+    blob_root = os.path.join(root, 'blobs')
+    if user_id is None:
+        with offline_blob_lock():
+            for dirpath, _, filenames in os.walk(blob_root):
+                for name in filenames:
+                    if name in referenced:
+                        continue
+                    # Re-check: a reference may have been added since step 2
+                    if not name.endswith('.part') and execute_query(
+                            "SELECT 1 FROM offline_items WHERE checksum = %s LIMIT 1",
+                            (name,), fetch_one=True):
+                        continue
+                    os.remove(os.path.join(dirpath, name))
+                    collected += 1
+
+    bump_user_state_version(*changed_users)
+    click.echo(
+        f"Migrated {migrated} legacy copies, dropped {dropped} references to missing blobs, "
+        f"collected {collected} unreferenced blobs"
+    )
+
+@app.cli.command('evict-offline')
+def evict_offline_command():
+    """Evict least recently accessed offline copies above OFFLINE_DISK_HIGH_WATER"""
+    if app.config['OFFLINE_DISK_HIGH_WATER'] is None:
+        click.echo("OFFLINE_DISK_HIGH_WATER is not set")
+        return
+    freed = reclaim_offline_disk(force=True)
+    click.echo(f"Freed {freed} bytes; blob storage now holds {get_offline_disk_usage()} bytes")
+
 def award_points(user_id, points, reason):
     """Award points to a user and check for badge achievements"""
     try:
@@ -378,6 +1961,10 @@ def award_points(user_id, points, reason):
                         (user_id, badge_level, datetime.now(timezone.utc))
                     )
                     badges_awarded.append(badge_level)
+        if badges_awarded:
+            bump_user_state_version(user_id)
+            for badge_level in badges_awarded:
+                publish_badge_awarded(user_id, badge_level)
 
         # Update leaderboard
         update_leaderboard(user_id)
@@ -391,6 +1978,7 @@ def award_points(user_id, points, reason):
     except Exception as e:
         app.logger.error(f"Error awarding points to user {user_id}: {str(e)}")
         raise
+@observe_duration(PDF_RENDER_LATENCY, 'certificate')
 def generate_certificate_pdf(certificate_data, preview=False):
     """Generate a PDF certificate based on the certificate data"""
     buffer = BytesIO()
@@ -481,10 +2069,287 @@ def extract_youtube_id(url):
             return match.group(1)
     return None
 
+# YouTube metadata: oEmbed answers are cached in process and in the
+# youtube_videos row (title, is_embeddable, checked_at). Available videos
+# are trusted for YOUTUBE_CACHE_TTL, missing or unembeddable ones for
+# YOUTUBE_NEGATIVE_CACHE_TTL. Requests share one pooled session and always
+# time out; if YouTube cannot be reached the last known answer is used.
+youtube_session = requests.Session()
+youtube_session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=10))
+youtube_cache = {}
+youtube_cache_lock = threading.Lock()
+
+def fetch_youtube_oembed(video_id):
+    """Ask YouTube's oEmbed endpoint about a video.
+
+    Raises requests.RequestException when YouTube gives no usable answer.
+    """
+    started = time.perf_counter()
+    try:
+        response = youtube_session.get(
+            app.config['YOUTUBE_OEMBED_URL'],
+            params={'url': f"https://www.youtube.com/watch?v={video_id}", 'format': 'json'},
+            timeout=app.config['YOUTUBE_TIMEOUT']
+        )
+    except requests.RequestException:
+        YOUTUBE_LATENCY.observe(time.perf_counter() - started, 'error')
+        raise
+    YOUTUBE_LATENCY.observe(time.perf_counter() - started, str(response.status_code))
+    if response.status_code == 200:
+        data = response.json()
+        return {
+            'embeddable': True,
+            'title': data.get('title'),
+            'author_name': data.get('author_name'),
+            'thumbnail_url': data.get('thumbnail_url')
+        }
+    # 401/403: embedding disabled; 400/404: private, removed or invalid
+    if response.status_code in (400, 401, 403, 404):
+        return {'embeddable': False, 'title': None}
+    response.raise_for_status()
+    raise requests.RequestException(f"Unexpected oEmbed status {response.status_code}")
+
+def youtube_cache_ttl(metadata):
+    if metadata['embeddable']:
+        return app.config['YOUTUBE_CACHE_TTL']
+    return app.config['YOUTUBE_NEGATIVE_CACHE_TTL']
+
+def cache_youtube_metadata(video_id, metadata, checked_at, ttl=None):
+    expires = checked_at.timestamp() + (youtube_cache_ttl(metadata) if ttl is None else ttl)
+    with youtube_cache_lock:
+        youtube_cache.pop(video_id, None)
+        youtube_cache[video_id] = (expires, metadata)
+        # Drop the oldest entries once the cache is full
+        while len(youtube_cache) > app.config['YOUTUBE_CACHE_SIZE']:
+            del youtube_cache[next(iter(youtube_cache))]
+
+def youtube_metadata_changed(before, metadata):
+    """Whether fetched metadata differs from a youtube_videos row in what modules show"""
+    was_embeddable = None if before['is_embeddable'] is None else bool(before['is_embeddable'])
+    return was_embeddable != metadata['embeddable'] or bool(
+        metadata.get('title') and metadata['title'] != before['title'])
+
+def store_youtube_metadata(video_id, metadata, checked_at, before=None):
+    """Save fetched metadata; modules showing the video get a new catalogue
+    version when it differs from before, the row as last read"""
+    execute_query(
+        "UPDATE youtube_videos SET title = COALESCE(%s, title), is_embeddable = %s, checked_at = %s "
+        "WHERE youtube_video_id = %s",
+        (metadata.get('title'), metadata['embeddable'], checked_at, video_id)
+    )
+    if before is None or not youtube_metadata_changed(before, metadata):
+        return
+    modules = execute_query(
+        "SELECT DISTINCT mc.module_id FROM youtube_videos yv "
+        "JOIN module_content mc ON yv.content_id = mc.id "
+        "WHERE yv.youtube_video_id = %s",
+        (video_id,),
+        fetch_all=True
+    ) or []
+    for module in modules:
+        bump_catalogue_version(module['module_id'])
+
+def get_youtube_metadata(video_id, known=None, refresh=False):
+    """Get {'embeddable', 'title', ...} for a YouTube video.
+
+    known is the video's youtube_videos row (title, is_embeddable,
+    checked_at) when the caller already has it. Raises
+    requests.RequestException if YouTube cannot be reached and nothing is
+    known about the video.
+    """
+    now = datetime.now(timezone.utc)
+    if not refresh:
+        with youtube_cache_lock:
+            cached = youtube_cache.get(video_id)
+        if cached and cached[0] > now.timestamp():
+            return dict(cached[1])
+
+    if known is None:
+        known = execute_query(
+            "SELECT title, is_embeddable, checked_at FROM youtube_videos "
+            "WHERE youtube_video_id = %s LIMIT 1",
+            (video_id,),
+            fetch_one=True
+        )
+    stored = None
+    if known and known.get('is_embeddable') is not None and known.get('checked_at'):
+        checked_at = known['checked_at']
+        if checked_at.tzinfo is None:
+            checked_at = checked_at.replace(tzinfo=timezone.utc)
+        stored = {'embeddable': bool(known['is_embeddable']), 'title': known.get('title')}
+        if not refresh and (now - checked_at).total_seconds() < youtube_cache_ttl(stored):
+            cache_youtube_metadata(video_id, stored, checked_at)
+            return dict(stored)
+
+    fetcher = app.config['YOUTUBE_METADATA_FETCHER'] or fetch_youtube_oembed
+    try:
+        metadata = fetcher(video_id)
+    except (requests.RequestException, ValueError) as e:
+        if stored is None:
+            raise requests.RequestException(str(e)) from e
+        app.logger.warning(f"YouTube check failed for {video_id}, using last known metadata: {str(e)}")
+        # Retry after the negative TTL rather than on every request
+        stored['stale'] = True
+        cache_youtube_metadata(video_id, stored, now, ttl=app.config['YOUTUBE_NEGATIVE_CACHE_TTL'])
+        return dict(stored)
+
+    store_youtube_metadata(video_id, metadata, now, before=known)
+    cache_youtube_metadata(video_id, metadata, now)
+    return dict(metadata)
+
+def fetch_youtube_metadata_paced(video_ids):
+    """Fetch metadata for many videos on a bounded pool, at most
+    YOUTUBE_REFRESH_RATE requests per second. Failed videos map to None."""
+    fetcher = app.config['YOUTUBE_METADATA_FETCHER'] or fetch_youtube_oembed
+    spacing = 1.0 / app.config['YOUTUBE_REFRESH_RATE']
+    pace_lock = threading.Lock()
+    next_slot = [time.monotonic()]
+
+    def fetch(video_id):
+        with pace_lock:
+            now = time.monotonic()
+            slot = max(next_slot[0], now)
+            next_slot[0] = slot + spacing
+        if slot > now:
+            time.sleep(slot - now)
+        try:
+            return video_id, fetcher(video_id)
+        except (requests.RequestException, ValueError) as e:
+            app.logger.warning(f"YouTube refresh failed for {video_id}: {str(e)}")
+            return video_id, None
+
+    with ThreadPoolExecutor(max_workers=app.config['YOUTUBE_REFRESH_WORKERS'],
+                            thread_name_prefix='youtube-refresh') as pool:
+        return dict(pool.map(fetch, video_ids))
+
+def refresh_youtube_metadata():
+    """Revalidate youtube_videos rows not checked within YOUTUBE_REFRESH_INTERVAL.
+
+    Results are written in one batch; modules whose video titles or
+    availability changed get a new catalogue version, and the creators of
+    modules with newly broken videos are notified. Returns a summary dict,
+    or None if another process is already refreshing.
+    """
+    # One refresher across all worker processes
+    with database_lock('youtube_refresh') as acquired:
+        if not acquired:
+            return None
+        return refresh_youtube_metadata_locked()
+
+def refresh_youtube_metadata_locked():
+    now = datetime.now(timezone.utc)
+    max_age = app.config['YOUTUBE_REFRESH_INTERVAL'] or 0
+    videos = execute_query(
+        "SELECT youtube_video_id, MAX(title) AS title, MAX(is_embeddable) AS is_embeddable "
+        "FROM youtube_videos WHERE youtube_video_id IS NOT NULL "
+        "AND (checked_at IS NULL OR checked_at < %s) "
+        "GROUP BY youtube_video_id",
+        (now - timedelta(seconds=max_age),),
+        fetch_all=True
+    ) or []
+    previous = {video['youtube_video_id']: video for video in videos}
+    results = fetch_youtube_metadata_paced(list(previous))
+
+    checked_at = datetime.now(timezone.utc)
+    rows = []
+    changed = []
+    broken = []
+    for video_id, metadata in results.items():
+        if metadata is None:
+            continue
+        rows.append((metadata.get('title'), metadata['embeddable'], checked_at, video_id))
+        cache_youtube_metadata(video_id, metadata, checked_at)
+        before = previous[video_id]
+        was_embeddable = None if before['is_embeddable'] is None else bool(before['is_embeddable'])
+        if youtube_metadata_changed(before, metadata):
+            changed.append(video_id)
+        if not metadata['embeddable'] and was_embeddable is not False:
+            broken.append(video_id)
+    if rows:
+        execute_many(
+            "UPDATE youtube_videos SET title = COALESCE(%s, title), is_embeddable = %s, checked_at = %s "
+            "WHERE youtube_video_id = %s",
+            rows
+        )
+
+    if changed:
+        placeholders = ", ".join(["%s"] * len(changed))
+        contents = execute_query(
+            "SELECT mc.id, mc.title, mc.module_id, m.title AS module_title, m.created_by, "
+            "yv.youtube_video_id FROM youtube_videos yv "
+            "JOIN module_content mc ON yv.content_id = mc.id "
+            "JOIN modules m ON mc.module_id = m.id "
+            f"WHERE yv.youtube_video_id IN ({placeholders})",
+            tuple(changed),
+            fetch_all=True
+        ) or []
+        for module_id in sorted({content['module_id'] for content in contents}):
+            bump_catalogue_version(module_id)
+        for content in contents:
+            if content['youtube_video_id'] not in broken or not content['created_by']:
+                continue
+            try:
+                create_notification(
+                    content['created_by'],
+                    "YouTube video unavailable",
+                    f"The video in \"{content['title']}\" ({content['module_title']}) "
+                    f"can no longer be embedded. Please replace it.",
+                    'system'
+                )
+            except Exception as e:
+                app.logger.error(f"Failed to notify trainer {content['created_by']} about video "
+                                 f"{content['youtube_video_id']}: {str(e)}")
+
+    summary = {
+        'checked': len(rows),
+        'failed': len(results) - len(rows),
+        'changed': len(changed),
+        'broken': len(broken)
+    }
+    app.logger.info(f"YouTube metadata refresh: {summary}")
+    return summary
+
+youtube_refresher = None
+youtube_refresher_lock = threading.Lock()
+
+def run_youtube_refresher():
+    while True:
+        try:
+            refresh_youtube_metadata()
+        except Exception as e:
+            app.logger.error(f"Error refreshing YouTube metadata: {str(e)}")
+        time.sleep(app.config['YOUTUBE_REFRESH_INTERVAL'])
+
+def start_youtube_refresher():
+    """Start the background refresh thread once per process"""
+    global youtube_refresher
+    if youtube_refresher is not None or not app.config['YOUTUBE_REFRESH_INTERVAL']:
+        return
+    with youtube_refresher_lock:
+        if youtube_refresher is None:
+            youtube_refresher = threading.Thread(
+                target=run_youtube_refresher,
+                name='youtube-refresher',
+                daemon=True
+            )
+            youtube_refresher.start()
+
+@app.cli.command('refresh-youtube')
+def refresh_youtube_command():
+    """Revalidate YouTube metadata now"""
+    summary = refresh_youtube_metadata()
+    if summary is None:
+        click.echo("Another process is already refreshing YouTube metadata")
+    else:
+        click.echo(
+            f"Checked {summary['checked']} videos ({summary['failed']} failed), "
+            f"{summary['changed']} changed, {summary['broken']} newly broken"
+        )
+
 def update_leaderboard(user_id):
     """Debug-friendly leaderboard updater with comprehensive logging"""
     try:
-        app.logger.info(f"Starting leaderboard update for user {user_id}")
+        leaderboard_logger.info(f"Starting leaderboard update for user {user_id}")
         
         # 1. Get total points (with debug logging)
         points_query = """
@@ -494,7 +2359,7 @@ def update_leaderboard(user_id):
         """
         points_result = execute_query(points_query, (user_id,), fetch_one=True)
         total_points = points_result['total_points'] if points_result else 0
-        app.logger.info(f"User {user_id} points: {total_points}")
+        leaderboard_logger.info(f"User {user_id} points: {total_points}")
 
         # 2. Count badges (with debug logging)
         badges_query = """
@@ -504,24 +2369,17 @@ def update_leaderboard(user_id):
         """
         badges_result = execute_query(badges_query, (user_id,), fetch_one=True)
         badges_count = badges_result['badges_count'] if badges_result else 0
-        app.logger.info(f"User {user_id} badges: {badges_count}")
+        leaderboard_logger.info(f"User {user_id} badges: {badges_count}")
 
         # 3. Count completed modules (optimized query)
         modules_query = """
-            SELECT COUNT(DISTINCT m.id) as count
-            FROM modules m
-            JOIN module_content mc ON m.id = mc.module_id
-            LEFT JOIN user_progress up ON (
-                mc.id = up.content_id 
-                AND up.user_id = %s 
-                AND up.status = 'completed'
-            )
-            GROUP BY m.id
-            HAVING COUNT(mc.id) = SUM(CASE WHEN up.status = 'completed' THEN 1 ELSE 0 END)
+            SELECT COUNT(*) as count
+            FROM user_module_progress
+            WHERE user_id = %s AND total_count > 0 AND completed_count >= total_count
         """
-        modules_result = execute_query(modules_query, (user_id,), fetch_all=True)
-        modules_completed = len(modules_result) if modules_result else 0
-        app.logger.info(f"User {user_id} completed modules: {modules_completed}")
+        modules_result = execute_query(modules_query, (user_id,), fetch_one=True)
+        modules_completed = modules_result['count'] if modules_result else 0
+        leaderboard_logger.info(f"User {user_id} completed modules: {modules_completed}")
 
         # 4. Get quiz statistics (simplified)
         quizzes_query = """
@@ -537,7 +2395,17 @@ def update_leaderboard(user_id):
             'quizzes_passed': 0,
             'avg_quiz_score': 0
         }
-        app.logger.info(f"User {user_id} quiz stats: {quiz_stats}")
+        leaderboard_logger.info(f"User {user_id} quiz stats: {quiz_stats}")
+
+        # Previous score, only needed to tell connected users about rank changes
+        previous_points = None
+        if get_subscribed_user_ids():
+            previous = execute_query(
+                "SELECT total_points FROM leaderboard WHERE user_id = %s",
+                (user_id,),
+                fetch_one=True
+            )
+            previous_points = previous['total_points'] if previous else 0
 
         # 5. UPSERT with transaction handling
         upsert_query = """
@@ -573,10 +2441,9 @@ def update_leaderboard(user_id):
                 raise Exception("Database connection failed")
             cursor = conn.cursor()
             try:
-                cursor.execute(upsert_query, params)
+                timed_execute(cursor, upsert_query, params)
                 conn.commit()
-                app.logger.info(f"Successfully updated leaderboard for user {user_id}")
-                return True
+                leaderboard_logger.info(f"Successfully updated leaderboard for user {user_id}")
             finally:
                 cursor.close()
         except Exception as e:
@@ -587,8 +2454,12 @@ def update_leaderboard(user_id):
             if conn:
                 conn.close()
 
+        if previous_points is not None:
+            publish_rank_changes(user_id, previous_points, total_points)
+        return True
+
     except Exception as e:
-        app.logger.error(f"CRITICAL ERROR updating leaderboard for user {user_id}: {str(e)}", exc_info=True)
+        leaderboard_logger.error(f"CRITICAL ERROR updating leaderboard for user {user_id}: {str(e)}", exc_info=True)
         return False
 @app.route('/debug/user/<int:user_id>/stats', methods=['GET'])
 def debug_user_stats(user_id):
@@ -611,7 +2482,7 @@ def debug_user_stats(user_id):
             FROM quiz_results WHERE user_id = %s
         """, (user_id,), fetch_one=True)
     }
-    return jsonify(dict_to_json_serializable(stats))
+    return jsonify(stats)
 
 @app.route('/debug/leaderboard/force-update/<int:user_id>', methods=['POST'])
 def debug_force_update(user_id):
@@ -808,15 +2679,12 @@ def award_badge_with_notification(user_id, badge_id):
         return False
 
     # Create notification
-    execute_query(
-        "INSERT INTO notifications (user_id, title, message, notification_type, is_read) "
-        "VALUES (%s, %s, %s, %s, FALSE)",
-        (
-            user_id,
-            f"New Badge: {badge['name']}",
-            f"You earned the {badge['name']} badge! {badge['description']}",
-            'badge'
-        )
+    publish_badge_awarded(user_id, badge_id)
+    create_notification(
+        user_id,
+        f"New Badge: {badge['name']}",
+        f"You earned the {badge['name']} badge! {badge['description']}",
+        'badge'
     )
 
     # Send email notification
@@ -958,56 +2826,8 @@ def login():
 def get_admin_dashboard_stats(current_user):
     """Get admin dashboard statistics"""
     try:
-        stats = {
-            'total_users': 0,
-            'active_users': 0,
-            'total_modules': 0,
-            'active_modules': 0,
-            'recent_activity': []
-        }
-
-        # Get user counts
-        result = execute_query(
-            "SELECT COUNT(*) as count FROM users",
-            fetch_one=True
-        )
-        if result:
-            stats['total_users'] = result['count']
-
-        result = execute_query(
-            "SELECT COUNT(*) as count FROM users WHERE is_active = TRUE",
-            fetch_one=True
-        )
-        if result:
-            stats['active_users'] = result['count']
-
-        # Get module counts
-        result = execute_query(
-            "SELECT COUNT(*) as count FROM modules",
-            fetch_one=True
-        )
-        if result:
-            stats['total_modules'] = result['count']
-
-        result = execute_query(
-            "SELECT COUNT(*) as count FROM modules WHERE is_active = TRUE",
-            fetch_one=True
-        )
-        if result:
-            stats['active_modules'] = result['count']
-
-        # Get recent activity
-        stats['recent_activity'] = execute_query(
-            "SELECT u.first_name, u.last_name, m.title as module_title, "
-            "up.status, up.last_accessed "
-            "FROM user_progress up "
-            "JOIN users u ON up.user_id = u.id "
-            "JOIN module_content mc ON up.content_id = mc.id "
-            "JOIN modules m ON mc.module_id = m.id "
-            "ORDER BY up.last_accessed DESC "
-            "LIMIT 10",
-            fetch_all=True
-        )
+        stats = get_dashboard_counters()
+        stats['recent_activity'] = get_recent_activity()
 
         return jsonify(stats)
 
@@ -1041,7 +2861,7 @@ def get_user_certificates(current_user, user_id):
         fetch_all=True
     )
 
-    return jsonify(dict_to_json_serializable(certificates))
+    return jsonify(certificates)
 
 @app.route('/refresh-token', methods=['POST'])
 def refresh_token():
@@ -1067,7 +2887,7 @@ def refresh_token():
 
         return jsonify({
             'token': new_token,
-            'user': dict_to_json_serializable(user)
+            'user': user
         })
     except jwt.ExpiredSignatureError:
         return jsonify({'message': 'Refresh token has expired'}), 401
@@ -1150,7 +2970,7 @@ def reset_password(token):
 @app.route('/profile', methods=['GET'])
 @token_required
 def profile(current_user):
-    return jsonify(dict_to_json_serializable(current_user))
+    return jsonify(current_user)
 
 @app.route('/profile', methods=['PUT'])
 @token_required
@@ -1226,11 +3046,20 @@ def change_password(current_user):
 @token_required
 @admin_required
 def get_all_users(current_user):
+    try:
+        limit, after = get_page_args()
+        where, params = keyset_after(['id'], after) if after else ("TRUE", [])
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
     users = execute_query(
-        "SELECT id, email, first_name, last_name, role, employer_id, is_active FROM users",
+        "SELECT id, email, first_name, last_name, role, employer_id, is_active FROM users "
+        f"WHERE {where} ORDER BY id ASC LIMIT %s",
+        tuple(params) + (page_fetch_limit(limit),),
         fetch_all=True
     )
-    return jsonify(dict_to_json_serializable(users))
+    users, next_cursor = split_page(users, limit, lambda user: [user['id']])
+    return page_response(users, next_cursor)
 
 @app.route('/users/<int:user_id>', methods=['GET'])
 @token_required
@@ -1239,7 +3068,7 @@ def get_user(current_user, user_id):
     user = get_user_by_id(user_id)
     if not user:
         return jsonify({'message': 'User not found'}), 404
-    return jsonify(dict_to_json_serializable(user))
+    return jsonify(user)
 
 @app.route('/users/<int:user_id>/role', methods=['PUT'])
 @token_required
@@ -1327,46 +3156,293 @@ def contact():
     else:
         return jsonify({'message': 'Failed to send your message'}), 500
 
+# Module catalogue: active modules, their active quiz and their ordered
+# content are cached per process. catalogue_versions holds one counter per
+# module for its content (and questions) plus a global counter (module_id 0)
+# for module metadata, activation, quizzes and prerequisites. Each process
+# compares the counters at most every CATALOGUE_CHECK_INTERVAL seconds and
+# drops only the entries whose counter moved; everything is reloaded after
+# CATALOGUE_MAX_AGE. Loads run outside catalogue_lock and are only stored
+# if no entry was dropped in the meantime (the generation is unchanged).
+CATALOGUE_GLOBAL = 0
+catalogue_cache = {
+    'versions': None,
+    'checked_at': 0,
+    'loaded_at': 0,
+    'generation': 0,
+    'modules': None,
+    'quizzes': None,
+    'contents': {}
+}
+catalogue_lock = threading.Lock()
+
+def bump_catalogue_version(module_id=CATALOGUE_GLOBAL):
+    """Mark the global catalogue or one module's content as changed"""
+    execute_query(
+        "INSERT INTO catalogue_versions (module_id, version) VALUES (%s, 1) "
+        "ON DUPLICATE KEY UPDATE version = version + 1",
+        (module_id,)
+    )
+    with catalogue_lock:
+        catalogue_cache['checked_at'] = 0
+
+@app.cli.command('bump-catalogue')
+@click.option('--module-id', type=int, default=None, help="Only bump this module's content version.")
+def bump_catalogue_command(module_id):
+    """Invalidate cached catalogue responses after editing it with SQL.
+
+    Badge definitions have no endpoint, so run this after changing them.
+    """
+    bump_catalogue_version(CATALOGUE_GLOBAL if module_id is None else module_id)
+    click.echo("Catalogue version bumped")
+
+def sync_catalogue():
+    """Drop cached catalogue entries whose version changed since they were loaded"""
+    now = time.monotonic()
+    with catalogue_lock:
+        if (catalogue_cache['versions'] is not None and
+                now - catalogue_cache['checked_at'] < app.config['CATALOGUE_CHECK_INTERVAL']):
+            return
+
+    rows = execute_query(
+        "SELECT module_id, version FROM catalogue_versions",
+        fetch_all=True
+    ) or []
+    versions = {row['module_id']: row['version'] for row in rows}
+
+    with catalogue_lock:
+        previous = catalogue_cache['versions'] or {}
+        expired = now - catalogue_cache['loaded_at'] >= app.config['CATALOGUE_MAX_AGE']
+        global_changed = (catalogue_cache['versions'] is None or expired or
+                          previous.get(CATALOGUE_GLOBAL) != versions.get(CATALOGUE_GLOBAL))
+        dropped = global_changed
+        if global_changed:
+            catalogue_cache['modules'] = None
+            catalogue_cache['quizzes'] = None
+        for module_id in list(catalogue_cache['contents']):
+            if expired or previous.get(module_id) != versions.get(module_id):
+                del catalogue_cache['contents'][module_id]
+                dropped = True
+        if expired:
+            catalogue_cache['loaded_at'] = now
+        if dropped:
+            catalogue_cache['generation'] += 1
+        catalogue_cache['versions'] = versions
+        catalogue_cache['checked_at'] = now
+
+    # Outside catalogue_lock: compiling the graph reads the catalogue
+    if global_changed:
+        invalidate_module_graph()
+
+def get_catalogue_version(module_id=None, all_modules=False):
+    """Get a token that changes with the global catalogue version, plus
+    module_id's version or every module's version when requested"""
+    sync_catalogue()
+    versions = catalogue_cache['versions'] or {}
+    if all_modules:
+        return ",".join(f"{key}:{value}" for key, value in sorted(versions.items()))
+    token = f"{CATALOGUE_GLOBAL}:{versions.get(CATALOGUE_GLOBAL, 0)}"
+    if module_id is not None:
+        token += f",{module_id}:{versions.get(module_id, 0)}"
+    return token
+
+def store_catalogue_entry(generation, store):
+    """Store a loaded entry unless the catalogue changed while it was loading"""
+    with catalogue_lock:
+        if catalogue_cache['generation'] == generation:
+            store(catalogue_cache)
+
+def get_catalogue_module_map(sync=True):
+    if sync:
+        sync_catalogue()
+    modules = catalogue_cache['modules']
+    if modules is None:
+        generation = catalogue_cache['generation']
+        rows = execute_query(
+            "SELECT * FROM modules WHERE is_active = TRUE ORDER BY id ASC",
+            fetch_all=True
+        ) or []
+        modules = {row['id']: row for row in rows}
+        store_catalogue_entry(generation, lambda cache: cache.update(modules=modules))
+    return modules
+
+def get_catalogue_modules():
+    """Get all active modules ordered by id"""
+    return [dict(module) for module in get_catalogue_module_map().values()]
+
+def get_catalogue_module(module_id):
+    """Get an active module by id, or None"""
+    module = get_catalogue_module_map().get(module_id)
+    return dict(module) if module else None
+
+def get_catalogue_quizzes():
+    sync_catalogue()
+    quizzes = catalogue_cache['quizzes']
+    if quizzes is None:
+        generation = catalogue_cache['generation']
+        rows = execute_query(
+            "SELECT * FROM quizzes WHERE is_active = TRUE ORDER BY id ASC",
+            fetch_all=True
+        ) or []
+        quizzes = {}
+        for row in rows:
+            quizzes.setdefault(row['module_id'], row)
+        store_catalogue_entry(generation, lambda cache: cache.update(quizzes=quizzes))
+    return quizzes
+
+def get_module_quiz(module_id):
+    """Get the active quiz of a module, or None"""
+    quiz = get_catalogue_quizzes().get(module_id)
+    return dict(quiz) if quiz else None
+
+def get_quiz_module_ids():
+    """Get the ids of modules that have an active quiz"""
+    return set(get_catalogue_quizzes())
+
+def get_module_contents(module_id):
+    """Get a module's content ordered by display order, with youtube video info"""
+    sync_catalogue()
+    contents = catalogue_cache['contents'].get(module_id)
+    if contents is None:
+        generation = catalogue_cache['generation']
+        contents = execute_query(
+            """SELECT mc.*, 
+                      yv.youtube_url, 
+                      yv.youtube_video_id,
+                      yv.title as video_title,
+                      yv.duration as video_duration
+               FROM module_content mc
+               LEFT JOIN youtube_videos yv ON mc.id = yv.content_id
+               WHERE mc.module_id = %s
+               ORDER BY mc.display_order""",
+            (module_id,),
+            fetch_all=True
+        ) or []
+        store_catalogue_entry(
+            generation,
+            lambda cache: cache['contents'].__setitem__(module_id, contents)
+        )
+    return [dict(content) for content in contents]
+
+# Module sequence: active modules are ordered topologically over their
+# explicit prerequisites (ties broken by id). A module without explicit
+# prerequisites depends on the module before it in that order. The compiled graph is cached
+# per process and dropped together with the global catalogue entries; a
+# graph compiled while it was dropped is not stored.
+module_graph = None
+module_graph_generation = 0
+module_graph_lock = threading.Lock()
+
+def compile_module_graph():
+    """Build the module order, next-module and prerequisite lookups.
+
+    Reads the catalogue without syncing it, so compiling never invalidates
+    the graph being compiled; get_module_graph syncs beforehand.
+    """
+    modules = [dict(module) for module in get_catalogue_module_map(sync=False).values()]
+    edges = execute_query(
+        "SELECT mp.module_id, mp.prerequisite_module_id FROM module_prerequisites mp "
+        "JOIN modules m ON mp.prerequisite_module_id = m.id AND m.is_active = TRUE",
+        fetch_all=True
+    ) or []
+
+    ids = [module['id'] for module in modules]
+    titles = {module['id']: module['title'] for module in modules}
+    explicit = {}
+    for edge in edges:
+        if edge['module_id'] in titles:
+            explicit.setdefault(edge['module_id'], []).append(edge['prerequisite_module_id'])
+
+    # Kahn's algorithm over the explicit edges, always taking the lowest available id next
+    dependents = {module_id: [] for module_id in ids}
+    remaining = {module_id: len(explicit.get(module_id, [])) for module_id in ids}
+    for module_id, prerequisite_ids in explicit.items():
+        for prerequisite_id in prerequisite_ids:
+            dependents[prerequisite_id].append(module_id)
+    ready = [module_id for module_id in ids if remaining[module_id] == 0]
+    heapq.heapify(ready)
+    order = []
+    while ready:
+        module_id = heapq.heappop(ready)
+        order.append(module_id)
+        for dependent_id in dependents[module_id]:
+            remaining[dependent_id] -= 1
+            if remaining[dependent_id] == 0:
+                heapq.heappush(ready, dependent_id)
+
+    if len(order) < len(ids):
+        # Should not happen as cycles are rejected on write; keep the rest in id order
+        cyclic = [module_id for module_id in ids if module_id not in set(order)]
+        app.logger.warning(f"Module prerequisites contain a cycle between modules {cyclic}")
+        order.extend(cyclic)
+
+    # Modules without explicit prerequisites depend on the module before them
+    prerequisites = {}
+    for index, module_id in enumerate(order):
+        if module_id in explicit:
+            prerequisites[module_id] = sorted(explicit[module_id])
+        else:
+            prerequisites[module_id] = [order[index - 1]] if index > 0 else []
+
+    return {
+        'order': order,
+        'titles': titles,
+        'prerequisites': prerequisites,
+        'next': {module_id: (order[i + 1] if i + 1 < len(order) else None) for i, module_id in enumerate(order)}
+    }
+
+def get_module_graph():
+    """Get the compiled module graph, compiling it on first use"""
+    global module_graph
+    sync_catalogue()
+    graph = module_graph
+    if graph is None:
+        with module_graph_lock:
+            generation = module_graph_generation
+        # Compiled without holding the lock; concurrent callers may compile too
+        graph = compile_module_graph()
+        with module_graph_lock:
+            if module_graph_generation == generation:
+                module_graph = graph
+    return graph
+
+def invalidate_module_graph():
+    global module_graph, module_graph_generation
+    with module_graph_lock:
+        module_graph = None
+        module_graph_generation += 1
+
+def get_next_module_id(module_id):
+    """Get the module that follows module_id in the learning sequence"""
+    return get_module_graph()['next'].get(module_id)
+
+def get_module_prerequisites(module_id):
+    """Get the ids of the modules that must be completed before module_id"""
+    return get_module_graph()['prerequisites'].get(module_id, [])
+
 @app.route('/modules/<int:module_id>', methods=['GET'])
 @token_required
+@conditional_get('module')
 def get_module(current_user, module_id):
     """Get module details with content, youtube video info, quiz requirements, and user progress"""
     # Get module basic info
-    module = execute_query(
-        "SELECT * FROM modules WHERE id = %s AND is_active = TRUE",
-        (module_id,),
-        fetch_one=True
-    )
+    module = get_catalogue_module(module_id)
 
     if not module:
-        app.logger.warning(f"Module {module_id} not found or inactive")
+        content_logger.warning(f"Module {module_id} not found or inactive")
         return jsonify({'message': 'Module not found'}), 404
 
-    app.logger.info(f"Found module: {module['title']}")
+    content_logger.info(f"Found module: {module['title']}")
 
 
     # Get all content for this module with youtube video info if available
-    contents = execute_query(
-        """SELECT mc.*, 
-                  yv.youtube_url, 
-                  yv.youtube_video_id,
-                  yv.title as video_title,
-                  yv.duration as video_duration
-           FROM module_content mc
-           LEFT JOIN youtube_videos yv ON mc.id = yv.content_id
-           WHERE mc.module_id = %s
-           ORDER BY mc.display_order""",
-        (module_id,),
-        fetch_all=True
-    )
-    app.logger.info(f"Found {len(contents)} content items for module {module_id}")
+    contents = get_module_contents(module_id)
+    content_logger.info(f"Found {len(contents)} content items for module {module_id}")
 
     # Get the module's quiz
-    quiz = execute_query(
-        "SELECT * FROM quizzes WHERE module_id = %s AND is_active = TRUE LIMIT 1",
-        (module_id,),
-        fetch_one=True
-    )
+    quiz = get_module_quiz(module_id)
+
+    offline_content_ids = get_offline_content_ids(current_user['id'])
 
     # Format contents and add user progress info
     formatted_contents = []
@@ -1385,7 +3461,7 @@ def get_module(current_user, module_id):
                 'status': 'not_started',
                 'progress': 0
             },
-            'offline_available': check_offline_access(current_user['id'], content['id']),
+            'offline_available': content['id'] in offline_content_ids,
             'youtube_video': {
                 'url': content['youtube_url'],
                 'id': content['youtube_video_id'],
@@ -1415,11 +3491,7 @@ def get_module(current_user, module_id):
     module_completed = all_content_completed and (not quiz or quiz_completed)
 
     # Get next module ID if available
-    next_module = execute_query(
-        "SELECT id FROM modules WHERE is_active = TRUE AND id > %s ORDER BY id ASC LIMIT 1",
-        (module_id,),
-        fetch_one=True
-    )
+    next_module_id = get_next_module_id(module_id)
 
     return jsonify({
         'module': module,
@@ -1428,7 +3500,7 @@ def get_module(current_user, module_id):
         'module_completed': module_completed,
         'quiz_completed': quiz_completed,
         'all_content_completed': all_content_completed,
-        'next_module_id': next_module['id'] if next_module else None
+        'next_module_id': next_module_id
     })
 
 @app.route('/content/<int:content_id>/complete', methods=['POST'])
@@ -1447,33 +3519,14 @@ def complete_content(current_user, content_id):
         if not content:
             return jsonify({'message': 'Content not found'}), 404
 
-        # Check if user has already completed this content
-        existing_progress = execute_query(
-            "SELECT * FROM user_progress WHERE user_id = %s AND content_id = %s",
-            (current_user['id'], content_id),
-            fetch_one=True
-        )
+        # Persist the last buffered playback position before completing
+        flush_progress_heartbeats(current_user['id'], content_id)
 
-        if existing_progress and existing_progress['status'] == 'completed':
+        # Mark as completed and learn whether it already was in one round trip
+        previous_status = save_progress(current_user['id'], content_id, 'completed')
+        if previous_status == 'completed':
             return jsonify({'message': 'Content already completed', 'already_completed': True}), 200
 
-        # Update or create progress record
-        if existing_progress:
-            execute_query(
-                "UPDATE user_progress SET status = 'completed', completed_at = %s "
-                "WHERE user_id = %s AND content_id = %s",
-                (datetime.now(timezone.utc), current_user['id'], content_id)
-            )
-        else:
-            execute_query(
-                "INSERT INTO user_progress (user_id, content_id, status, started_at, completed_at) "
-                "VALUES (%s, %s, %s, %s, %s)",
-                (
-                    current_user['id'], content_id, 'completed',
-                    datetime.now(timezone.utc), datetime.now(timezone.utc)
-                )
-            )
-
         # Award points for completion
         points_result = award_points(
             current_user['id'],
@@ -1482,28 +3535,11 @@ def complete_content(current_user, content_id):
         )
 
         # Check if all content in module is completed
-        all_content = execute_query(
-            "SELECT id FROM module_content WHERE module_id = %s",
-            (content['module_id'],),
-            fetch_all=True
-        )
-        
-        completed_content = execute_query(
-            "SELECT COUNT(DISTINCT content_id) as count FROM user_progress "
-            "WHERE user_id = %s AND status = 'completed' "
-            "AND content_id IN (SELECT id FROM module_content WHERE module_id = %s)",
-            (current_user['id'], content['module_id']),
-            fetch_one=True
-        )['count']
-
-        all_content_completed = completed_content >= len(all_content)
+        module_progress = get_user_module_progress(current_user['id'], content['module_id'])
+        all_content_completed = module_content_completed(module_progress)
 
         # Check if module has a quiz
-        quiz = execute_query(
-            "SELECT id FROM quizzes WHERE module_id = %s AND is_active = TRUE LIMIT 1",
-            (content['module_id'],),
-            fetch_one=True
-        )
+        quiz = get_module_quiz(content['module_id'])
 
         response = {
             'message': 'Content marked as completed',
@@ -1520,13 +3556,7 @@ def complete_content(current_user, content_id):
 
         # If there's a quiz and all content is completed, check quiz status
         if quiz and all_content_completed:
-            quiz_result = execute_query(
-                "SELECT passed FROM quiz_results WHERE user_id = %s AND quiz_id = %s",
-                (current_user['id'], quiz['id']),
-                fetch_one=True
-            )
-            
-            if quiz_result and quiz_result['passed']:
+            if module_progress['quiz_passed']:
                 response['quiz_completed'] = True
                 response['module_completed'] = True
                 
@@ -1578,42 +3608,21 @@ def attempt_module_quiz(current_user, module_id):
     """Attempt the quiz for a module"""
     try:
         # Verify module exists
-        module = execute_query(
-            "SELECT * FROM modules WHERE id = %s AND is_active = TRUE",
-            (module_id,),
-            fetch_one=True
-        )
+        module = get_catalogue_module(module_id)
         if not module:
             return jsonify({'message': 'Module not found'}), 404
 
         # Check if user has completed all content
-        all_content = execute_query(
-            "SELECT id FROM module_content WHERE module_id = %s",
-            (module_id,),
-            fetch_all=True
-        )
-        
-        completed_content = execute_query(
-            "SELECT COUNT(DISTINCT content_id) as count FROM user_progress "
-            "WHERE user_id = %s AND status = 'completed' "
-            "AND content_id IN (SELECT id FROM module_content WHERE module_id = %s)",
-            (current_user['id'], module_id),
-            fetch_one=True
-        )['count']
-
-        if completed_content < len(all_content):
+        module_progress = get_user_module_progress(current_user['id'], module_id)
+        if not module_content_completed(module_progress):
             return jsonify({
                 'message': 'You must complete all module content before attempting the quiz',
-                'content_completed': completed_content,
-                'content_required': len(all_content)
+                'content_completed': module_progress['completed_count'],
+                'content_required': module_progress['total_count']
             }), 403
 
         # Get the quiz
-        quiz = execute_query(
-            "SELECT * FROM quizzes WHERE module_id = %s AND is_active = TRUE LIMIT 1",
-            (module_id,),
-            fetch_one=True
-        )
+        quiz = get_module_quiz(module_id)
         if not quiz:
             return jsonify({'message': 'No quiz available for this module'}), 404
 
@@ -1674,20 +3683,12 @@ def submit_module_quiz(current_user, module_id):
             return jsonify({'message': 'Answers are required'}), 400
 
         # Verify module exists
-        module = execute_query(
-            "SELECT * FROM modules WHERE id = %s AND is_active = TRUE",
-            (module_id,),
-            fetch_one=True
-        )
+        module = get_catalogue_module(module_id)
         if not module:
             return jsonify({'message': 'Module not found'}), 404
 
         # Get the quiz
-        quiz = execute_query(
-            "SELECT * FROM quizzes WHERE module_id = %s AND is_active = TRUE LIMIT 1",
-            (module_id,),
-            fetch_one=True
-        )
+        quiz = get_module_quiz(module_id)
         if not quiz:
             return jsonify({'message': 'No quiz available for this module'}), 404
 
@@ -1724,6 +3725,7 @@ def submit_module_quiz(current_user, module_id):
                 datetime.now(timezone.utc)
             )
         )
+        bump_user_state_version(current_user['id'])
 
         response = {
             'message': 'Quiz submitted successfully',
@@ -1737,6 +3739,8 @@ def submit_module_quiz(current_user, module_id):
         }
 
         if passed:
+            refresh_user_module_progress(current_user['id'], [module_id])
+
             # Award points for passing the quiz
             points_result = award_points(
                 current_user['id'],
@@ -1770,52 +3774,25 @@ def get_next_module(current_user, module_id):
     """Get the next module if current one is completed"""
     try:
         # Verify current module exists
-        current_module = execute_query(
-            "SELECT * FROM modules WHERE id = %s AND is_active = TRUE",
-            (module_id,),
-            fetch_one=True
-        )
+        current_module = get_catalogue_module(module_id)
         if not current_module:
             return jsonify({'message': 'Current module not found'}), 404
 
         # Check if current module is completed
         # 1. Check all content is completed
-        all_content = execute_query(
-            "SELECT id FROM module_content WHERE module_id = %s",
-            (module_id,),
-            fetch_all=True
-        )
-        
-        completed_content = execute_query(
-            "SELECT COUNT(DISTINCT content_id) as count FROM user_progress "
-            "WHERE user_id = %s AND status = 'completed' "
-            "AND content_id IN (SELECT id FROM module_content WHERE module_id = %s)",
-            (current_user['id'], module_id),
-            fetch_one=True
-        )['count']
-
-        if completed_content < len(all_content):
+        module_progress = get_user_module_progress(current_user['id'], module_id)
+        if not module_content_completed(module_progress):
             return jsonify({
                 'message': 'You must complete all module content first',
-                'content_completed': completed_content,
-                'content_required': len(all_content)
+                'content_completed': module_progress['completed_count'],
+                'content_required': module_progress['total_count']
             }), 403
 
         # 2. Check quiz is passed (if module has quiz)
-        quiz = execute_query(
-            "SELECT id FROM quizzes WHERE module_id = %s AND is_active = TRUE LIMIT 1",
-            (module_id,),
-            fetch_one=True
-        )
+        quiz = get_module_quiz(module_id)
         
         if quiz:
-            quiz_result = execute_query(
-                "SELECT passed FROM quiz_results WHERE user_id = %s AND quiz_id = %s",
-                (current_user['id'], quiz['id']),
-                fetch_one=True
-            )
-            
-            if not quiz_result or not quiz_result['passed']:
+            if not module_progress['quiz_passed']:
                 return jsonify({
                     'message': 'You must pass the module quiz first',
                     'quiz_passed': False,
@@ -1823,15 +3800,9 @@ def get_next_module(current_user, module_id):
                 }), 403
 
         # Get next module in sequence
-        next_module = execute_query(
-            "SELECT id, title FROM modules "
-            "WHERE is_active = TRUE AND id > %s "
-            "ORDER BY id ASC LIMIT 1",
-            (module_id,),
-            fetch_one=True
-        )
+        next_module_id = get_next_module_id(module_id)
 
-        if not next_module:
+        if next_module_id is None:
             return jsonify({
                 'message': 'Current module completed - this is the last module',
                 'next_module': None,
@@ -1840,7 +3811,10 @@ def get_next_module(current_user, module_id):
 
         return jsonify({
             'message': 'Module completed - next module available',
-            'next_module': next_module,
+            'next_module': {
+                'id': next_module_id,
+                'title': get_module_graph()['titles'][next_module_id]
+            },
             'all_modules_completed': False
         })
 
@@ -1883,9 +3857,6 @@ def get_content_questions(current_user, content_id):
                 except json.JSONDecodeError:
                     question['options'] = []
         
-        # Use the existing serialization function to handle any remaining bytes
-        questions = dict_to_json_serializable(questions)
-        
         return jsonify(questions), 200
     except Exception as e:
         app.logger.error(f"Error getting content questions: {str(e)}")
@@ -1923,7 +3894,7 @@ def add_content_question(current_user, content_id):
 
         # Verify content exists and belongs to this trainer
         content = execute_query(
-            "SELECT mc.id FROM module_content mc "
+            "SELECT mc.id, mc.module_id FROM module_content mc "
             "JOIN modules m ON mc.module_id = m.id "
             "WHERE mc.id = %s AND m.created_by = %s",
             (content_id, current_user['id']),
@@ -1947,6 +3918,7 @@ def add_content_question(current_user, content_id):
             ),
             lastrowid=True
         )
+        bump_catalogue_version(content['module_id'])
 
         app.logger.info(f"Question {question_id} added to content {content_id}")
         return jsonify({
@@ -1957,23 +3929,29 @@ def add_content_question(current_user, content_id):
     except Exception as e:
         app.logger.error(f"Error adding question: {str(e)}", exc_info=True)
         return jsonify({'message': 'Error adding question'}), 500
+def get_completed_module(user_id, module_id):
+    """Get a module with the time the user completed all of its content, or None"""
+    progress = get_user_module_progress(user_id, module_id)
+    if not progress['total_count'] or not module_content_completed(progress):
+        return None
+
+    module = execute_query(
+        "SELECT id, title, description FROM modules WHERE id = %s",
+        (module_id,),
+        fetch_one=True
+    )
+    if not module:
+        return None
+    module['completed_at'] = progress['completed_at']
+    return module
+
 @app.route('/user/certificates/preview/<string:cert_type>/<int:item_id>', methods=['GET'])
 @token_required
 def preview_certificate(current_user, cert_type, item_id):
     certificate_data = None
 
     if cert_type == 'module':
-        module_data = execute_query(
-            "SELECT m.id, m.title, m.description, MAX(up.completed_at) as completed_at "
-            "FROM modules m "
-            "JOIN module_content mc ON m.id = mc.module_id "
-            "JOIN user_progress up ON mc.id = up.content_id "
-            "WHERE up.user_id = %s AND up.status = 'completed' AND m.id = %s "
-            "GROUP BY m.id, m.title, m.description "
-            "HAVING COUNT(mc.id) = SUM(CASE WHEN up.status = 'completed' THEN 1 ELSE 0 END)",
-            (current_user['id'], item_id),
-            fetch_one=True
-        )
+        module_data = get_completed_module(current_user['id'], item_id)
 
         if not module_data:
             return jsonify({'message': 'Module not completed'}), 400
@@ -2031,17 +4009,7 @@ def download_certificate(current_user, cert_type, item_id):
     certificate_data = None
 
     if cert_type == 'module':
-        module_data = execute_query(
-            "SELECT m.id, m.title, m.description, MAX(up.completed_at) as completed_at "
-            "FROM modules m "
-            "JOIN module_content mc ON m.id = mc.module_id "
-            "JOIN user_progress up ON mc.id = up.content_id "
-            "WHERE up.user_id = %s AND up.status = 'completed' AND m.id = %s "
-            "GROUP BY m.id, m.title, m.description "
-            "HAVING COUNT(mc.id) = SUM(CASE WHEN up.status = 'completed' THEN 1 ELSE 0 END)",
-            (current_user['id'], item_id),
-            fetch_one=True
-        )
+        module_data = get_completed_module(current_user['id'], item_id)
 
         if not module_data:
             return jsonify({'message': 'Module not completed'}), 400
@@ -2097,6 +4065,7 @@ def download_certificate(current_user, cert_type, item_id):
             datetime.now(timezone.utc)
         )
     )
+    bump_user_state_version(current_user['id'])
 
     return send_file(
         pdf_buffer,
@@ -2107,7 +4076,14 @@ def download_certificate(current_user, cert_type, item_id):
 
 @app.route('/user/certificates/history', methods=['GET'])
 @token_required
+@conditional_get()
 def get_certificate_history(current_user):
+    try:
+        limit, after = get_page_args()
+        where, params = keyset_after(['uc.generated_at', 'uc.id'], after, descending=True) if after else ("TRUE", [])
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
     certificates = execute_query(
         "SELECT uc.id, uc.certificate_type, uc.item_id, uc.certificate_id, "
         "uc.generated_at, "
@@ -2118,13 +4094,446 @@ def get_certificate_history(current_user):
         "FROM user_certificates uc "
         "LEFT JOIN modules m ON uc.certificate_type = 'module' AND uc.item_id = m.id "
         "LEFT JOIN quizzes q ON uc.certificate_type = 'quiz' AND uc.item_id = q.id "
-        "WHERE uc.user_id = %s "
-        "ORDER BY uc.generated_at DESC",
-        (current_user['id'],),
+        f"WHERE uc.user_id = %s AND {where} "
+        "ORDER BY uc.generated_at DESC, uc.id DESC LIMIT %s",
+        (current_user['id'],) + tuple(params) + (page_fetch_limit(limit),),
         fetch_all=True
     )
+    certificates, next_cursor = split_page(
+        certificates, limit,
+        lambda certificate: [certificate['generated_at'], certificate['id']]
+    )
+
+    return page_response(certificates, next_cursor)
+
+# Progress repository: every write to user_progress goes through these helpers
+def save_progress(user_id, content_id, status, current_position=None, attempts=None,
+                  score=None, count_attempt=False):
+    """Upsert a user_progress row atomically and return its previous status.
+
+    Returns None when the row did not exist before. Optional fields left as
+    None keep their stored value, and completing an already completed item
+    keeps its original completed_at. With count_attempt the attempts counter
+    is incremented instead of set.
+    """
+    now = datetime.now(timezone.utc)
+    completed_at = now if status == 'completed' else None
+    if count_attempt:
+        attempts_insert, attempts_update = "1", "attempts = attempts + 1"
+        attempts_params = ()
+    else:
+        attempts_insert, attempts_update = "COALESCE(%s, 0)", "attempts = COALESCE(%s, attempts)"
+        attempts_params = (attempts,)
+
+    # The previous status is captured into a session variable by the same
+    # statement that writes the row, so the check and the write cannot race.
+    # Connections are not reused, so the variable starts out NULL and stays
+    # NULL when the row is inserted.
+    query = (
+        "INSERT INTO user_progress (user_id, content_id, status, started_at, "
+        "completed_at, last_accessed, current_position, attempts, score) "
+        f"VALUES (%s, %s, %s, %s, %s, %s, %s, {attempts_insert}, %s) "
+        "ON DUPLICATE KEY UPDATE "
+        "completed_at = IF((@previous_status := status) = 'completed' "
+        "AND VALUES(status) = 'completed', completed_at, VALUES(completed_at)), "
+        "status = VALUES(status), "
+        "current_position = COALESCE(%s, current_position), "
+        f"{attempts_update}, "
+        "score = COALESCE(%s, score), "
+        "last_accessed = VALUES(last_accessed)"
+    )
+    params = (
+        (user_id, content_id, status, now, completed_at, now, current_position)
+        + attempts_params + (score, current_position) + attempts_params + (score,)
+    )
+
+    conn = None
+    cursor = None
+    try:
+        conn = get_db_connection()
+        if conn is None:
+            raise Exception("Database connection could not be established")
+        cursor = conn.cursor(dictionary=True)
+        timed_execute(cursor, query, params)
+        result = timed_execute(cursor, "SELECT @previous_status AS previous_status", fetch_one=True)
+        conn.commit()
+        previous_status = result['previous_status'] if result else None
+        # User variables can come back as raw bytes
+        if isinstance(previous_status, (bytes, bytearray)):
+            previous_status = previous_status.decode('utf-8')
+    except Exception as e:
+        app.logger.error(f"Database error: {str(e)}")
+        if conn:
+            conn.rollback()
+        raise
+    finally:
+        if cursor:
+            cursor.close()
+        if conn:
+            conn.close()
+
+    # Module completion only changes when an item enters or leaves 'completed'
+    if (status == 'completed') != (previous_status == 'completed'):
+        refresh_user_module_progress(user_id, content_id=content_id)
+    bump_user_state_version(user_id)
+    return previous_status
+
+def save_progress_positions(rows):
+    """Batch-update playback positions.
+
+    rows are (user_id, content_id, reported_at, current_position) tuples; items
+    that were not started yet are moved to in_progress.
+    """
+    count = execute_many(
+        "INSERT INTO user_progress (user_id, content_id, status, started_at, "
+        "last_accessed, current_position) "
+        "VALUES (%s, %s, 'in_progress', %s, %s, %s) "
+        "ON DUPLICATE KEY UPDATE "
+        "current_position = VALUES(current_position), "
+        "last_accessed = VALUES(last_accessed), "
+        "status = IF(status = 'not_started', 'in_progress', status)",
+        [(uid, cid, at, at, position) for uid, cid, at, position in rows]
+    )
+    bump_user_state_version(*(row[0] for row in rows))
+    return count
+
+def save_progress_batch(rows):
+    """Apply timestamped progress rows with one multi-row upsert.
+
+    rows are (user_id, content_id, status, recorded_at, current_position,
+    attempts, score) tuples for a single user. Stored rows with more recent
+    activity keep their position, attempts and score, optional fields left
+    as None keep their stored value, and a completed item is never
+    reopened. Returns {content_id: previous status} for the rows that
+    already existed, captured by the upsert itself as in save_progress.
+    """
+    user_id = rows[0][0]
+    # The "newer" guard must be evaluated before last_accessed is updated,
+    # so last_accessed is assigned last. The first assignment appends the
+    # stored status of each existing row to a session variable before
+    # anything is changed; new rows do not appear in it.
+    newer = "(last_accessed IS NULL OR VALUES(last_accessed) >= last_accessed)"
+    query = (
+        "INSERT INTO user_progress (user_id, content_id, status, started_at, "
+        "completed_at, last_accessed, current_position, attempts, score) VALUES "
+        + ", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s, %s)"] * len(rows)) +
+        " ON DUPLICATE KEY UPDATE "
+        "current_position = IF((@previous_statuses := CONCAT(@previous_statuses, "
+        "content_id, ':', status, ',')) IS NOT NULL AND "
+        f"{newer}, COALESCE(VALUES(current_position), current_position), current_position), "
+        f"attempts = IF({newer}, COALESCE(VALUES(attempts), attempts), attempts), "
+        f"score = IF({newer}, COALESCE(VALUES(score), score), score), "
+        "completed_at = IF(status = 'completed', completed_at, VALUES(completed_at)), "
+        "status = IF(status = 'completed' OR NOT (VALUES(status) = 'completed' OR "
+        f"{newer}), status, VALUES(status)), "
+        "last_accessed = GREATEST(COALESCE(last_accessed, VALUES(last_accessed)), VALUES(last_accessed))"
+    )
+    params = []
+    for row_user_id, content_id, status, recorded_at, current_position, attempts, score in rows:
+        params.extend((
+            row_user_id, content_id, status, recorded_at,
+            recorded_at if status == 'completed' else None,
+            recorded_at, current_position, attempts, score
+        ))
+
+    conn = None
+    cursor = None
+    try:
+        conn = get_db_connection()
+        if conn is None:
+            raise Exception("Database connection could not be established")
+        cursor = conn.cursor(dictionary=True)
+        timed_execute(cursor, "SET @previous_statuses = ''")
+        timed_execute(cursor, query, tuple(params))
+        result = timed_execute(cursor, "SELECT @previous_statuses AS previous_statuses", fetch_one=True)
+        conn.commit()
+    except Exception as e:
+        app.logger.error(f"Database error: {str(e)}")
+        if conn:
+            conn.rollback()
+        raise
+    finally:
+        if cursor:
+            cursor.close()
+        if conn:
+            conn.close()
+
+    captured = result['previous_statuses'] if result else ''
+    # User variables can come back as raw bytes
+    if isinstance(captured, (bytes, bytearray)):
+        captured = captured.decode('utf-8')
+    previous_status = {}
+    for entry in (captured or '').split(','):
+        if entry:
+            content_id, status = entry.split(':', 1)
+            previous_status[int(content_id)] = status
+    bump_user_state_version(user_id)
+    return previous_status
+
+# Per-user module completion, kept in user_module_progress so that read paths
+# fetch one row instead of re-deriving completion from user_progress
+EMPTY_MODULE_PROGRESS = {
+    'completed_count': 0,
+    'total_count': 0,
+    'quiz_passed': False,
+    'completed_at': None
+}
+
+def refresh_user_module_progress(user_id, module_ids=None, content_id=None):
+    """Recompute a user's completion rows.
+
+    Covers the given modules, the module owning content_id, or every module
+    when neither is given. completed_at is set once all content is completed.
+    """
+    params = [datetime.now(timezone.utc), user_id, user_id]
+    where = ""
+    if module_ids:
+        where = f"WHERE m.id IN ({', '.join(['%s'] * len(module_ids))}) "
+        params.extend(module_ids)
+    elif content_id is not None:
+        where = "WHERE m.id = (SELECT module_id FROM module_content WHERE id = %s) "
+        params.append(content_id)
+
+    execute_query(
+        "INSERT INTO user_module_progress (user_id, module_id, completed_count, "
+        "total_count, quiz_passed, completed_at, updated_at) "
+        "SELECT up_user.user_id, m.id, "
+        "COUNT(DISTINCT CASE WHEN up.status = 'completed' THEN mc.id END), "
+        "COUNT(DISTINCT mc.id), "
+        "EXISTS (SELECT 1 FROM quiz_results qr JOIN quizzes q ON qr.quiz_id = q.id "
+        "WHERE qr.user_id = up_user.user_id AND q.module_id = m.id "
+        "AND q.is_active = TRUE AND qr.passed = TRUE), "
+        "CASE WHEN COUNT(DISTINCT mc.id) > 0 AND COUNT(DISTINCT CASE WHEN "
+        "up.status = 'completed' THEN mc.id END) = COUNT(DISTINCT mc.id) "
+        "THEN MAX(up.completed_at) END, "
+        "%s "
+        "FROM modules m "
+        "CROSS JOIN (SELECT %s as user_id) up_user "
+        "LEFT JOIN module_content mc ON mc.module_id = m.id "
+        "LEFT JOIN user_progress up ON up.content_id = mc.id AND up.user_id = %s "
+        f"{where}"
+        "GROUP BY up_user.user_id, m.id "
+        "ON DUPLICATE KEY UPDATE "
+        "completed_count = VALUES(completed_count), "
+        "total_count = VALUES(total_count), "
+        "quiz_passed = VALUES(quiz_passed), "
+        "completed_at = VALUES(completed_at), "
+        "updated_at = VALUES(updated_at)",
+        tuple(params)
+    )
+
+def refresh_module_progress(module_id):
+    """Recompute every user's completion row for one module, after its
+    content or quiz set changed"""
+    execute_query(
+        "INSERT INTO user_module_progress (user_id, module_id, completed_count, "
+        "total_count, quiz_passed, completed_at, updated_at) "
+        "SELECT ump.user_id, ump.module_id, "
+        "COUNT(DISTINCT CASE WHEN up.status = 'completed' THEN mc.id END), "
+        "COUNT(DISTINCT mc.id), "
+        "EXISTS (SELECT 1 FROM quiz_results qr JOIN quizzes q ON qr.quiz_id = q.id "
+        "WHERE qr.user_id = ump.user_id AND q.module_id = ump.module_id "
+        "AND q.is_active = TRUE AND qr.passed = TRUE), "
+        "CASE WHEN COUNT(DISTINCT mc.id) > 0 AND COUNT(DISTINCT CASE WHEN "
+        "up.status = 'completed' THEN mc.id END) = COUNT(DISTINCT mc.id) "
+        "THEN MAX(up.completed_at) END, "
+        "%s "
+        "FROM user_module_progress ump "
+        "LEFT JOIN module_content mc ON mc.module_id = ump.module_id "
+        "LEFT JOIN user_progress up ON up.content_id = mc.id AND up.user_id = ump.user_id "
+        "WHERE ump.module_id = %s "
+        "GROUP BY ump.user_id, ump.module_id "
+        "ON DUPLICATE KEY UPDATE "
+        "completed_count = VALUES(completed_count), "
+        "total_count = VALUES(total_count), "
+        "quiz_passed = VALUES(quiz_passed), "
+        "completed_at = VALUES(completed_at), "
+        "updated_at = VALUES(updated_at)",
+        (datetime.now(timezone.utc), module_id)
+    )
+
+def get_user_module_progress_map(user_id, module_ids):
+    """Get completion rows for several modules, backfilling any that are
+    missing or whose content count no longer matches the catalogue"""
+    module_ids = list(module_ids)
+    if not module_ids:
+        return {}
+
+    def load(ids):
+        rows = execute_query(
+            "SELECT module_id, completed_count, total_count, quiz_passed, completed_at "
+            "FROM user_module_progress "
+            f"WHERE user_id = %s AND module_id IN ({', '.join(['%s'] * len(ids))})",
+            (user_id,) + tuple(ids),
+            fetch_all=True
+        ) or []
+        return {row['module_id']: row for row in rows}
+
+    progress = load(module_ids)
+    # Content added or removed without going through the API (e.g. direct
+    # SQL) shows up in the catalogue after CATALOGUE_MAX_AGE
+    missing = [
+        module_id for module_id in module_ids
+        if module_id not in progress or
+        progress[module_id]['total_count'] != len(get_module_contents(module_id))
+    ]
+    if missing:
+        refresh_user_module_progress(user_id, missing)
+        progress.update(load(missing))
+
+    for row in progress.values():
+        row['quiz_passed'] = bool(row['quiz_passed'])
+    return progress
+
+def get_user_module_progress(user_id, module_id):
+    """Get a user's completion row for one module"""
+    progress = get_user_module_progress_map(user_id, [module_id])
+    return progress.get(module_id, dict(EMPTY_MODULE_PROGRESS))
+
+def module_content_completed(progress):
+    """Whether every content item of the module has been completed"""
+    return progress['completed_count'] >= progress['total_count']
+
+# Progress heartbeats: video players report their position every few seconds,
+# so positions are buffered in memory and written in batches instead.
+# Maps (user_id, content_id) -> (current_position, reported_at)
+progress_heartbeats = {}
+progress_heartbeats_lock = threading.Lock()
+progress_flusher = None
+
+def buffer_progress_heartbeat(user_id, content_id, current_position):
+    """Record the latest reported position, replacing any unflushed one"""
+    with progress_heartbeats_lock:
+        # The last element counts failed writes of this position
+        progress_heartbeats[(user_id, content_id)] = (current_position, datetime.now(timezone.utc), 0)
+    start_progress_flusher()
+
+def flush_progress_heartbeats(user_id=None, content_id=None):
+    """Write buffered positions to user_progress with one batched upsert.
+
+    Without arguments the whole buffer is flushed; otherwise only the entries
+    for the given user (and content item, if provided). Positions that failed
+    before are written one at a time, so a row the database keeps rejecting
+    only fails itself; it is dropped after PROGRESS_FLUSH_MAX_FAILURES.
+    """
+    with progress_heartbeats_lock:
+        if user_id is None:
+            pending = dict(progress_heartbeats)
+            progress_heartbeats.clear()
+        else:
+            pending = {
+                key: value for key, value in progress_heartbeats.items()
+                if key[0] == user_id and (content_id is None or key[1] == content_id)
+            }
+            for key in pending:
+                del progress_heartbeats[key]
 
-    return jsonify(dict_to_json_serializable(certificates))
+    if not pending:
+        return 0
+
+    failed = []
+    written = 0
+    try:
+        # Drop positions reported for content that does not exist
+        content_ids = sorted({key[1] for key in pending})
+        placeholders = ", ".join(["%s"] * len(content_ids))
+        existing = execute_query(
+            f"SELECT id FROM module_content WHERE id IN ({placeholders})",
+            tuple(content_ids),
+            fetch_all=True
+        ) or []
+        existing_ids = {row['id'] for row in existing}
+    except Exception as e:
+        app.logger.error(f"Error flushing progress heartbeats: {str(e)}")
+        requeue_progress_heartbeats(pending)
+        return 0
+
+    fresh = {}
+    retried = {}
+    for key, value in pending.items():
+        if key[1] in existing_ids:
+            (retried if value[2] else fresh)[key] = value
+
+    if fresh:
+        try:
+            save_progress_positions([
+                (uid, cid, reported_at, position)
+                for (uid, cid), (position, reported_at, _) in fresh.items()
+            ])
+            written += len(fresh)
+        except Exception as e:
+            app.logger.error(f"Error flushing progress heartbeats: {str(e)}")
+            failed.extend(fresh.items())
+    for (uid, cid), (position, reported_at, failures) in retried.items():
+        try:
+            save_progress_positions([(uid, cid, reported_at, position)])
+            written += 1
+        except Exception as e:
+            app.logger.error(f"Error flushing progress heartbeat of user {uid} for content {cid}: {str(e)}")
+            failed.append(((uid, cid), (position, reported_at, failures)))
+
+    if failed:
+        requeue_progress_heartbeats(dict(failed))
+    return written
+
+def requeue_progress_heartbeats(entries):
+    """Put positions that could not be written back into the buffer"""
+    max_failures = app.config['PROGRESS_FLUSH_MAX_FAILURES']
+    with progress_heartbeats_lock:
+        for key, (position, reported_at, failures) in entries.items():
+            if failures + 1 >= max_failures:
+                app.logger.warning(
+                    f"Dropping progress heartbeat of user {key[0]} for content {key[1]} "
+                    f"after {failures + 1} failed writes"
+                )
+                continue
+            # Newer positions that arrived in the meantime win
+            progress_heartbeats.setdefault(key, (position, reported_at, failures + 1))
+
+def run_progress_flusher():
+    while True:
+        time.sleep(app.config['PROGRESS_FLUSH_INTERVAL'])
+        flush_progress_heartbeats()
+
+def start_progress_flusher():
+    """Start the background flush thread once per process"""
+    global progress_flusher
+    if progress_flusher is not None:
+        return
+    with progress_heartbeats_lock:
+        if progress_flusher is None:
+            progress_flusher = threading.Thread(
+                target=run_progress_flusher,
+                name='progress-flusher',
+                daemon=True
+            )
+            progress_flusher.start()
+
+# Make sure buffered positions are not lost on shutdown
+atexit.register(flush_progress_heartbeats)
+
+@app.route('/progress/heartbeat', methods=['POST'])
+@token_required
+def progress_heartbeat(current_user):
+    """Report the current playback position of a content item"""
+    data = request.get_json(silent=True) or {}
+    if 'content_id' not in data or 'current_position' not in data:
+        return jsonify({'message': 'Content ID and current position are required'}), 400
+
+    try:
+        content_id = int(data['content_id'])
+        current_position = float(data['current_position'])
+    except (TypeError, ValueError):
+        return jsonify({'message': 'Content ID and current position must be numbers'}), 400
+    if not math.isfinite(current_position) or current_position < 0:
+        return jsonify({'message': 'current_position must be a non-negative number'}), 400
+
+    buffer_progress_heartbeat(current_user['id'], content_id, current_position)
+
+    return jsonify({
+        'message': 'Position recorded',
+        'flush_interval': app.config['PROGRESS_FLUSH_INTERVAL']
+    }), 202
 
 @app.route('/progress', methods=['POST'])
 @token_required
@@ -2134,84 +4543,216 @@ def update_progress(current_user):
     if not all(field in data for field in required_fields):
         return jsonify({'message': 'Content ID and status are required'}), 400
 
+    try:
+        # Heartbeats are buffered under an int key, so "12" must become 12
+        content_id = int(data['content_id'])
+    except (TypeError, ValueError):
+        return jsonify({'message': 'Content ID must be a number'}), 400
+
     result = execute_query(
         "SELECT 1 FROM module_content WHERE id = %s",
-        (data['content_id'],),
+        (content_id,),
         fetch_one=True
     )
     if not result:
         return jsonify({'message': 'Content not found'}), 404
 
-    progress = execute_query(
-        "SELECT * FROM user_progress WHERE user_id = %s AND content_id = %s",
-        (current_user['id'], data['content_id']),
-        fetch_one=True
-    )
+    # Write any buffered heartbeat first so it cannot overwrite this update
+    flush_progress_heartbeats(current_user['id'], content_id)
 
-    if progress:
-        execute_query(
-            "UPDATE user_progress SET status = %s, current_position = %s, "
-            "completed_at = %s, last_accessed = %s, attempts = %s, score = %s "
-            "WHERE user_id = %s AND content_id = %s",
-            (
-                data['status'], data.get('current_position'),
-                datetime.now(timezone.utc) if data['status'] == 'completed' else None,
-                datetime.now(timezone.utc), data.get('attempts', 0),
-                data.get('score'), current_user['id'], data['content_id']
-            )
-        )
-    else:
-        execute_query(
-            "INSERT INTO user_progress (user_id, content_id, status, started_at, "
-            "completed_at, last_accessed, current_position, attempts, score) "
-            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)",
-            (
-                current_user['id'], data['content_id'], data['status'],
-                datetime.now(timezone.utc),
-                datetime.now(timezone.utc) if data['status'] == 'completed' else None,
-                datetime.now(timezone.utc), data.get('current_position'),
-                data.get('attempts', 0), data.get('score')
-            )
-        )
+    previous_status = save_progress(
+        current_user['id'], content_id, data['status'],
+        current_position=data.get('current_position'),
+        attempts=data.get('attempts'),
+        score=data.get('score')
+    )
+    # Only award points the first time an item is completed
+    newly_completed = data['status'] == 'completed' and previous_status != 'completed'
 
-    if data['status'] == 'completed':
+    if newly_completed:
         points_result = award_points(
             current_user['id'],
             app.config['POINTS_FOR_COMPLETION'],
-            f"Completed content {data['content_id']}"
+            f"Completed content {content_id}"
         )
 
         if current_user.get('employer_id'):
             update_leaderboard(current_user['id'], current_user['employer_id'])
 
     response = {'message': 'Progress updated successfully'}
-    if data['status'] == 'completed':
+    if newly_completed:
         response['points_awarded'] = app.config['POINTS_FOR_COMPLETION']
         if points_result.get('badges_awarded'):
             response['badges_awarded'] = points_result['badges_awarded']
 
     return jsonify(response)
 
+PROGRESS_STATUSES = ('not_started', 'in_progress', 'completed')
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def progress_event_error(event):
+    """Describe what is wrong with a progress event's optional fields, or None"""
+    if event['status'] not in PROGRESS_STATUSES:
+        return f"status must be one of {', '.join(PROGRESS_STATUSES)}"
+    attempts = event.get('attempts')
+    if attempts is not None and (not isinstance(attempts, int) or isinstance(attempts, bool) or attempts < 0):
+        return 'attempts must be a non-negative integer'
+    score = event.get('score')
+    if score is not None and not is_number(score):
+        return 'score must be a number'
+    position = event.get('current_position')
+    if position is not None and (not is_number(position) or position < 0):
+        return 'current_position must be a non-negative number'
+    return None
+
+def parse_client_timestamp(value):
+    """Parse an ISO 8601 string or epoch (seconds or milliseconds) into a UTC datetime"""
+    if isinstance(value, bool):
+        raise ValueError("Invalid timestamp")
+    if isinstance(value, (int, float)):
+        # Values this large can only be milliseconds
+        seconds = value / 1000 if value > 1e11 else value
+        return datetime.fromtimestamp(seconds, timezone.utc)
+    if isinstance(value, str):
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=timezone.utc)
+        return parsed.astimezone(timezone.utc)
+    raise ValueError("Invalid timestamp")
+
+@app.route('/progress/batch', methods=['POST'])
+@token_required
+def sync_progress_batch(current_user):
+    """Apply progress recorded while offline.
+
+    Events carry the client timestamp they were recorded at. When several
+    events target the same content item the latest one wins, except that a
+    completion is never undone by a later event. Rows that the server has seen
+    more recent activity for keep their newer position and score.
+    """
+    data = request.get_json(silent=True) or {}
+    events = data.get('events')
+    if not isinstance(events, list) or not events:
+        return jsonify({'message': 'A non-empty list of events is required'}), 400
+    if len(events) > app.config['PROGRESS_BATCH_MAX_EVENTS']:
+        return jsonify({
+            'message': f"At most {app.config['PROGRESS_BATCH_MAX_EVENTS']} events can be synced at once"
+        }), 413
+
+    user_id = current_user['id']
+    now = datetime.now(timezone.utc)
+    rejected = []
+    latest = {}  # content_id -> event
+    completed_ids = set()
+
+    for index, event in enumerate(events):
+        if not isinstance(event, dict) or 'content_id' not in event or 'status' not in event:
+            rejected.append({'index': index, 'reason': 'content_id and status are required'})
+            continue
+        try:
+            content_id = int(event['content_id'])
+            recorded_at = min(parse_client_timestamp(event.get('client_timestamp')), now)
+        except (TypeError, ValueError, OverflowError, OSError):
+            rejected.append({'index': index, 'reason': 'invalid content_id or client_timestamp'})
+            continue
+        error = progress_event_error(event)
+        if error:
+            rejected.append({'index': index, 'reason': error})
+            continue
+
+        if event['status'] == 'completed':
+            completed_ids.add(content_id)
+        current = latest.get(content_id)
+        if current is None or recorded_at >= current['recorded_at']:
+            latest[content_id] = {**event, 'content_id': content_id, 'recorded_at': recorded_at}
+
+    if not latest:
+        return jsonify({'message': 'No valid events to apply', 'applied': 0, 'rejected': rejected}), 400
+
+    try:
+        # Write buffered heartbeats first so they cannot overwrite synced rows
+        flush_progress_heartbeats(user_id)
+
+        content_ids = sorted(latest)
+        placeholders = ", ".join(["%s"] * len(content_ids))
+        contents = execute_query(
+            f"SELECT id, module_id FROM module_content WHERE id IN ({placeholders})",
+            tuple(content_ids),
+            fetch_all=True
+        ) or []
+        module_by_content = {row['id']: row['module_id'] for row in contents}
+
+        rows = []
+        final_status = {}
+        for content_id in content_ids:
+            event = latest[content_id]
+            if content_id not in module_by_content:
+                rejected.append({'content_id': content_id, 'reason': 'content not found'})
+                continue
+
+            status = 'completed' if content_id in completed_ids else event['status']
+            final_status[content_id] = status
+            rows.append((
+                user_id, content_id, status, event['recorded_at'],
+                event.get('current_position'), event.get('attempts'), event.get('score')
+            ))
+
+        newly_completed = []
+        if rows:
+            # Previous statuses come from the upsert itself, so concurrent
+            # syncs of the same events cannot both count a completion
+            previous_status = save_progress_batch(rows)
+            newly_completed = [
+                content_id for content_id, status in final_status.items()
+                if status == 'completed' and previous_status.get(content_id) != 'completed'
+            ]
+
+        response = {
+            'message': 'Progress synced successfully',
+            'applied': len(rows),
+            'completed': newly_completed,
+            'rejected': rejected,
+            'points_awarded': 0,
+            'certificates_awarded': []
+        }
+
+        # Run gamification once for the whole batch
+        if newly_completed:
+            points = app.config['POINTS_FOR_COMPLETION'] * len(newly_completed)
+            points_result = award_points(
+                user_id,
+                points,
+                f"Completed {len(newly_completed)} content items (offline sync)"
+            )
+            response['points_awarded'] = points
+            if points_result.get('badges_awarded'):
+                response['badges_awarded'] = points_result['badges_awarded']
+
+            module_ids = sorted({module_by_content[cid] for cid in newly_completed})
+            refresh_user_module_progress(user_id, module_ids)
+            for module_id in module_ids:
+                if check_module_completion_and_award_certificate(user_id, module_id):
+                    response['certificates_awarded'].append(module_id)
+
+        return jsonify(response)
+
+    except Exception as e:
+        app.logger.error(f"Error syncing progress batch: {str(e)}")
+        return jsonify({'message': 'Error syncing progress'}), 500
+
 @app.route('/progress/summary', methods=['GET'])
 @token_required
 def get_progress_summary(current_user):
-    result = execute_query(
-        "SELECT COUNT(*) as total_modules FROM modules WHERE is_active = TRUE",
-        fetch_one=True
-    )
-    total_modules = result['total_modules']
+    modules = get_catalogue_modules()
+    total_modules = len(modules)
 
-    result = execute_query(
-        "SELECT COUNT(DISTINCT m.id) as completed_modules FROM modules m "
-        "JOIN module_content mc ON m.id = mc.module_id "
-        "JOIN user_progress up ON mc.id = up.content_id "
-        "WHERE up.user_id = %s AND up.status = 'completed' "
-        "GROUP BY m.id "
-        "HAVING COUNT(mc.id) = SUM(CASE WHEN up.status = 'completed' THEN 1 ELSE 0 END)",
-        (current_user['id'],),
-        fetch_all=True
+    module_progress = get_user_module_progress_map(current_user['id'], [m['id'] for m in modules])
+    completed_modules = sum(
+        1 for progress in module_progress.values()
+        if progress['total_count'] > 0 and module_content_completed(progress)
     )
-    completed_modules = len(result)
 
     result = execute_query(
         "SELECT COALESCE(SUM(points), 0) as total_points FROM user_points WHERE user_id = %s",
@@ -2246,7 +4787,7 @@ def get_progress_summary(current_user):
         'completion_percentage': int((completed_modules / total_modules * 100)) if total_modules > 0 else 0,
         'total_points': total_points,
         'badges_count': badges_count,
-        'recent_activity': dict_to_json_serializable(recent_activity)
+        'recent_activity': recent_activity
     })
 @app.route('/trainer/reports', methods=['GET'])
 @token_required
@@ -2454,6 +4995,7 @@ def generate_trainer_reports(current_user):
             'user_role': current_user.get('role')
         }), 500
 
+@observe_duration(PDF_RENDER_LATENCY, 'report')
 def generate_report_pdf(report_data, report_type, current_user):
     """Generate a PDF report from the report data"""
     buffer = BytesIO()
@@ -2673,21 +5215,9 @@ def trainer_dashboard(current_user):
         }
 
         # Get module counts
-        result = execute_query(
-            "SELECT COUNT(*) as count FROM modules WHERE created_by = %s",
-            (current_user['id'],),
-            fetch_one=True
-        )
-        if result:
-            stats['total_modules'] = result['count']
-
-        result = execute_query(
-            "SELECT COUNT(*) as count FROM modules WHERE created_by = %s AND is_active = TRUE",
-            (current_user['id'],),
-            fetch_one=True
-        )
-        if result:
-            stats['active_modules'] = result['count']
+        counters = get_dashboard_counters(current_user)
+        stats['total_modules'] = counters['total_modules']
+        stats['active_modules'] = counters['active_modules']
 
         # Get learner count
         result = execute_query(
@@ -2747,19 +5277,26 @@ def trainer_dashboard(current_user):
 @trainer_required
 def get_trainer_quizzes(current_user):
     """Get all quizzes created by this trainer"""
+    try:
+        limit, after = get_page_args()
+        where, params = keyset_after(['q.created_at', 'q.id'], after, descending=True) if after else ("TRUE", [])
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
     try:
         quizzes = execute_query(
             "SELECT q.id, q.title, q.description, q.passing_score, q.time_limit, "
             "q.is_active, q.created_at, m.title as module_title "
             "FROM quizzes q "
             "JOIN modules m ON q.module_id = m.id "
-            "WHERE m.created_by = %s "
-            "ORDER BY q.created_at DESC",
-            (current_user['id'],),
+            f"WHERE m.created_by = %s AND {where} "
+            "ORDER BY q.created_at DESC, q.id DESC LIMIT %s",
+            (current_user['id'],) + tuple(params) + (page_fetch_limit(limit),),
             fetch_all=True
         )
-        
-        return jsonify(dict_to_json_serializable(quizzes))
+        quizzes, next_cursor = split_page(quizzes, limit, lambda quiz: [quiz['created_at'], quiz['id']])
+
+        return page_response(quizzes, next_cursor)
     except Exception as e:
         app.logger.error(f"Error fetching trainer quizzes: {str(e)}")
         return jsonify({'message': 'Error fetching quizzes'}), 500
@@ -2794,7 +5331,7 @@ def get_quiz_questions(current_user, quiz_id):
         )
         quiz['questions'] = questions
 
-        return jsonify(dict_to_json_serializable(questions))
+        return jsonify(questions)
     except Exception as e:
         app.logger.error(f"Error fetching quiz questions: {str(e)}")
         return jsonify({'message': 'Error fetching questions'}), 500
@@ -2813,7 +5350,7 @@ def add_quiz_question(current_user, quiz_id):
 
         # Verify the trainer owns this quiz
         result = execute_query(
-            "SELECT 1 FROM quizzes q "
+            "SELECT q.module_id FROM quizzes q "
             "JOIN modules m ON q.module_id = m.id "
             "WHERE q.id = %s AND m.created_by = %s",
             (quiz_id, current_user['id']),
@@ -2847,6 +5384,7 @@ def add_quiz_question(current_user, quiz_id):
             ),
             lastrowid=True
         )
+        bump_catalogue_version(result['module_id'])
 
         return jsonify({
             'message': 'Question added successfully',
@@ -2915,10 +5453,29 @@ def trainer_modules(current_user):
             (current_user['id'],),
             fetch_all=True
         )
-        return jsonify(dict_to_json_serializable(modules))
+        return jsonify(modules)
     except Exception as e:
         app.logger.error(f"Error fetching trainer modules: {str(e)}")
         return jsonify({'message': 'Error fetching modules'}), 500
+@app.route('/trainer/videos/unavailable', methods=['GET'])
+@token_required
+@trainer_required
+def trainer_unavailable_videos(current_user):
+    """Get YouTube videos in the trainer's modules that can no longer be embedded"""
+    query = (
+        "SELECT mc.id AS content_id, mc.title, mc.module_id, m.title AS module_title, "
+        "yv.youtube_video_id, yv.youtube_url, yv.checked_at "
+        "FROM youtube_videos yv "
+        "JOIN module_content mc ON yv.content_id = mc.id "
+        "JOIN modules m ON mc.module_id = m.id "
+        "WHERE yv.is_embeddable = FALSE"
+    )
+    params = ()
+    if current_user['role'] != 'admin':
+        query += " AND m.created_by = %s"
+        params = (current_user['id'],)
+    videos = execute_query(query + " ORDER BY m.id, mc.display_order", params, fetch_all=True) or []
+    return jsonify(videos)
 @app.route('/trainer/modules/<int:module_id>/stats', methods=['GET'])
 @token_required
 @trainer_required
@@ -2978,18 +5535,28 @@ def module_stats(current_user, module_id):
 def trainer_learners(current_user):
     """Get learners assigned to this trainer's modules"""
     try:
+        limit, after = get_page_args()
+        where, params = keyset_after(['u.id'], after) if after else ("TRUE", [])
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
+    try:
+        # EXISTS instead of DISTINCT over the join, so users are read in id order
         learners = execute_query(
-            "SELECT DISTINCT u.id, u.email, u.first_name, u.last_name, u.role, "
+            "SELECT u.id, u.email, u.first_name, u.last_name, u.role, "
             "u.employer_id, u.department_id, u.phone, u.profile_picture "
             "FROM users u "
-            "JOIN user_progress up ON u.id = up.user_id "
+            f"WHERE {where} AND EXISTS ("
+            "SELECT 1 FROM user_progress up "
             "JOIN module_content mc ON up.content_id = mc.id "
             "JOIN modules m ON mc.module_id = m.id "
-            "WHERE m.created_by = %s",
-            (current_user['id'],),
+            "WHERE up.user_id = u.id AND m.created_by = %s) "
+            "ORDER BY u.id ASC LIMIT %s",
+            tuple(params) + (current_user['id'], page_fetch_limit(limit)),
             fetch_all=True
         )
-        return jsonify(dict_to_json_serializable(learners))
+        learners, next_cursor = split_page(learners, limit, lambda learner: [learner['id']])
+        return page_response(learners, next_cursor)
     except Exception as e:
         app.logger.error(f"Error fetching trainer learners: {str(e)}")
         return jsonify({'message': 'Error fetching learners'}), 500
@@ -3100,38 +5667,50 @@ def create_assignment(current_user):
 @app.route('/assignments', methods=['GET'])
 @token_required
 def get_assignments(current_user):
+    # Assignments without a due date sort first, as before: MySQL puts NULLs
+    # first in ascending order, so the sort can use the (due_date, id) index.
+    # Cursors are [id] inside the NULL group and [due_date, id] after it.
+    try:
+        limit, after = get_page_args()
+        if not after:
+            where, params = "TRUE", []
+        elif len(after) == 1:
+            where, params = "((a.due_date IS NULL AND a.id > %s) OR a.due_date IS NOT NULL)", after
+        else:
+            where, params = keyset_after(['a.due_date', 'a.id'], after)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
     assignments = execute_query(
         "SELECT a.*, m.title as module_title FROM assignments a "
         "JOIN modules m ON a.module_id = m.id "
-        "WHERE (a.assignment_type = 'individual' AND a.individual_id = %s) "
+        "WHERE ((a.assignment_type = 'individual' AND a.individual_id = %s) "
         "OR (a.assignment_type = 'department' AND a.department_id = %s) "
-        "OR (a.assignment_type = 'all' AND a.employer_id = %s) "
-        "ORDER BY a.due_date",
-        (current_user['id'], current_user.get('department_id'), current_user.get('employer_id')),
+        "OR (a.assignment_type = 'all' AND a.employer_id = %s)) "
+        f"AND {where} ORDER BY a.due_date, a.id LIMIT %s",
+        (current_user['id'], current_user.get('department_id'), current_user.get('employer_id'))
+        + tuple(params) + (page_fetch_limit(limit),),
         fetch_all=True
     )
-
-    for assignment in assignments:
-        result = execute_query(
-            "SELECT COUNT(*) as total_contents FROM module_content WHERE module_id = %s",
-            (assignment['module_id'],),
-            fetch_one=True
+    assignments, next_cursor = split_page(
+        assignments, limit,
+        lambda assignment: (
+            [assignment['id']] if assignment['due_date'] is None
+            else [assignment['due_date'], assignment['id']]
         )
-        total_contents = result['total_contents']
+    )
 
-        if total_contents > 0:
-            result = execute_query(
-                "SELECT COUNT(*) as completed_contents FROM user_progress WHERE user_id = %s AND status = 'completed' "
-                "AND content_id IN (SELECT id FROM module_content WHERE module_id = %s)",
-                (current_user['id'], assignment['module_id']),
-                fetch_one=True
-            )
-            completed_contents = result['completed_contents']
-            assignment['completion_percentage'] = int((completed_contents / total_contents) * 100)
+    module_progress = get_user_module_progress_map(
+        current_user['id'], {assignment['module_id'] for assignment in assignments}
+    )
+    for assignment in assignments:
+        progress = module_progress.get(assignment['module_id'], EMPTY_MODULE_PROGRESS)
+        if progress['total_count'] > 0:
+            assignment['completion_percentage'] = int((progress['completed_count'] / progress['total_count']) * 100)
         else:
             assignment['completion_percentage'] = 0
 
-    return jsonify(dict_to_json_serializable(assignments))
+    return page_response(assignments, next_cursor)
 
 @app.route('/assignments/<int:assignment_id>', methods=['DELETE'])
 @token_required
@@ -3155,6 +5734,7 @@ def delete_assignment(current_user, assignment_id):
 
 @app.route('/badges', methods=['GET'])
 @token_required
+@conditional_get('global')
 def get_all_badges(current_user):
     badges = execute_query(
         "SELECT * FROM badges",
@@ -3169,10 +5749,11 @@ def get_all_badges(current_user):
         )
         badge['earned'] = bool(result)
 
-    return jsonify(dict_to_json_serializable(badges))
+    return jsonify(badges)
 
 @app.route('/badges/earned', methods=['GET'])
 @token_required
+@conditional_get()
 def get_earned_badges(current_user):
     badges = execute_query(
         "SELECT b.*, ub.earned_at FROM badges b "
@@ -3183,7 +5764,7 @@ def get_earned_badges(current_user):
         fetch_all=True
     )
 
-    return jsonify(dict_to_json_serializable(badges))
+    return jsonify(badges)
 @app.route('/badges/award', methods=['POST'])
 @token_required
 @trainer_required
@@ -3219,6 +5800,8 @@ def award_badge(current_user):
             "VALUES (%s, %s, %s)",
             (data['user_id'], data['badge_id'], datetime.now(timezone.utc))
         )
+        bump_user_state_version(data['user_id'])
+        publish_badge_awarded(data['user_id'], data['badge_id'])
         
         # Update leaderboard
         update_leaderboard(data['user_id'])
@@ -3310,8 +5893,8 @@ def get_leaderboard(current_user):
                 user_stats = stats
 
         response_data = {
-            'leaderboard': dict_to_json_serializable(leaderboard),
-            'user_stats': dict_to_json_serializable(user_stats) if user_stats else None
+            'leaderboard': leaderboard,
+            'user_stats': user_stats or None
         }
         return jsonify(response_data), 200
     except Exception as e:
@@ -3335,6 +5918,7 @@ def activate_module(current_user, module_id):
         "UPDATE modules SET is_active = TRUE WHERE id = %s",
         (module_id,)
     )
+    bump_catalogue_version()
 
     return jsonify({'message': 'Module activated successfully'})
 @app.route('/modules/<int:module_id>', methods=['PUT'])
@@ -3364,6 +5948,7 @@ def update_module(current_user, module_id):
             data.get('is_active', True), module_id
         )
     )
+    bump_catalogue_version()
 
     return jsonify({'message': 'Module updated successfully'})
 @app.route('/modules/<int:module_id>/deactivate', methods=['PUT'])
@@ -3379,12 +5964,77 @@ def deactivate_module(current_user, module_id):
         if not result:
             return jsonify({'message': 'Module not found or unauthorized'}), 404
 
-    execute_query(
-        "UPDATE modules SET is_active = FALSE WHERE id = %s",
-        (module_id,)
-    )
+    execute_query(
+        "UPDATE modules SET is_active = FALSE WHERE id = %s",
+        (module_id,)
+    )
+    bump_catalogue_version()
+
+    return jsonify({'message': 'Module deactivated successfully'})
+
+@app.route('/modules/<int:module_id>/prerequisites', methods=['PUT'])
+@token_required
+@trainer_required
+def update_module_prerequisites(current_user, module_id):
+    """Replace the modules that must be completed before this one"""
+    data = request.get_json(silent=True) or {}
+    prerequisite_ids = data.get('prerequisite_ids')
+    if not isinstance(prerequisite_ids, list) or not all(isinstance(i, int) for i in prerequisite_ids):
+        return jsonify({'message': 'prerequisite_ids must be a list of module IDs'}), 400
+    prerequisite_ids = sorted(set(prerequisite_ids))
+    if module_id in prerequisite_ids:
+        return jsonify({'message': 'A module cannot be its own prerequisite'}), 400
+
+    if current_user['role'] == 'trainer':
+        result = execute_query(
+            "SELECT 1 FROM modules WHERE id = %s AND created_by = %s",
+            (module_id, current_user['id']),
+            fetch_one=True
+        )
+        if not result:
+            return jsonify({'message': 'Module not found or unauthorized'}), 404
+
+    if prerequisite_ids:
+        placeholders = ", ".join(["%s"] * len(prerequisite_ids))
+        found = execute_query(
+            f"SELECT id FROM modules WHERE id IN ({placeholders})",
+            tuple(prerequisite_ids),
+            fetch_all=True
+        ) or []
+        if len(found) != len(prerequisite_ids):
+            return jsonify({'message': 'One or more prerequisite modules do not exist'}), 404
 
-    return jsonify({'message': 'Module deactivated successfully'})
+    # Reject cycles: none of the new prerequisites may (transitively) depend on this module
+    edges = execute_query(
+        "SELECT module_id, prerequisite_module_id FROM module_prerequisites",
+        fetch_all=True
+    ) or []
+    depends_on = {}
+    for edge in edges:
+        if edge['module_id'] != module_id:
+            depends_on.setdefault(edge['module_id'], set()).add(edge['prerequisite_module_id'])
+    stack, seen = list(prerequisite_ids), set()
+    while stack:
+        current = stack.pop()
+        if current == module_id:
+            return jsonify({'message': 'These prerequisites would create a cycle'}), 400
+        if current not in seen:
+            seen.add(current)
+            stack.extend(depends_on.get(current, ()))
+
+    execute_query("DELETE FROM module_prerequisites WHERE module_id = %s", (module_id,))
+    if prerequisite_ids:
+        execute_many(
+            "INSERT INTO module_prerequisites (module_id, prerequisite_module_id) VALUES (%s, %s)",
+            [(module_id, prerequisite_id) for prerequisite_id in prerequisite_ids]
+        )
+    bump_catalogue_version()
+
+    return jsonify({
+        'message': 'Module prerequisites updated successfully',
+        'module_id': module_id,
+        'prerequisite_ids': prerequisite_ids
+    })
 
 @app.route('/quizzes', methods=['POST'])
 @token_required
@@ -3434,6 +6084,9 @@ def create_quiz(current_user):
                 question.get('points', 1)
             )
         )
+    bump_catalogue_version()
+    # Learners who completed the module now also need this quiz
+    refresh_module_progress(data['module_id'])
 
     return jsonify({
         'message': 'Quiz created successfully',
@@ -3462,13 +6115,13 @@ def get_module_quizzes(current_user, module_id):
         else:
             quiz['user_result'] = None
 
-    return jsonify(dict_to_json_serializable(quizzes))
+    return jsonify(quizzes)
 @app.route('/content/<int:content_id>/quiz', methods=['GET'])
 @token_required
 def get_content_quiz(current_user, content_id):
     """Get quiz for a specific content item"""
     try:
-        app.logger.info(f"Fetching quiz for content {content_id}")
+        content_logger.info(f"Fetching quiz for content {content_id}")
         
         # First, check if this content is a quiz content type
         content = execute_query(
@@ -3479,14 +6132,14 @@ def get_content_quiz(current_user, content_id):
             fetch_one=True
         )
         if not content:
-            app.logger.warning(f"Content {content_id} not found")
+            content_logger.warning(f"Content {content_id} not found")
             return jsonify({'message': 'Content not found'}), 404
 
-        app.logger.info(f"Content {content_id} is type: {content.get('content_type')}")
+        content_logger.info(f"Content {content_id} is type: {content.get('content_type')}")
 
         # If this is a quiz content, get questions directly from content_questions
         if content.get('content_type') == 'quiz':
-            app.logger.info(f"Content {content_id} is a quiz, getting questions directly")
+            content_logger.info(f"Content {content_id} is a quiz, getting questions directly")
             
             # Get questions for this content
             questions = execute_query(
@@ -3540,12 +6193,12 @@ def get_content_quiz(current_user, content_id):
                 'user_result': user_result
             }
 
-            app.logger.info(f"Successfully returning quiz data for content {content_id}")
+            content_logger.info(f"Successfully returning quiz data for content {content_id}")
             return jsonify(quiz_data)
 
         else:
             # This is not a quiz content, try to get module quiz
-            app.logger.info(f"Content {content_id} is not a quiz, looking for module quiz")
+            content_logger.info(f"Content {content_id} is not a quiz, looking for module quiz")
             
             # Get quiz for this module
             quiz = execute_query(
@@ -3557,10 +6210,10 @@ def get_content_quiz(current_user, content_id):
             )
 
             if not quiz:
-                app.logger.warning(f"No active quiz found for module {content['module_id']}")
+                content_logger.warning(f"No active quiz found for module {content['module_id']}")
                 return jsonify({'message': 'No quiz available for this content'}), 404
 
-            app.logger.info(f"Found quiz {quiz['id']} for module {content['module_id']}")
+            content_logger.info(f"Found quiz {quiz['id']} for module {content['module_id']}")
 
             # Get questions for this quiz (without correct answers)
             questions = execute_query(
@@ -3570,7 +6223,7 @@ def get_content_quiz(current_user, content_id):
                 fetch_all=True
             )
 
-            app.logger.info(f"Found {len(questions)} questions for quiz {quiz['id']}")
+            content_logger.info(f"Found {len(questions)} questions for quiz {quiz['id']}")
 
                     # Get user's previous result if exists
         user_result = execute_query(
@@ -3591,14 +6244,15 @@ def get_content_quiz(current_user, content_id):
                 'user_result': user_result
             }
 
-            app.logger.info(f"Successfully returning quiz data for content {content_id}")
+            content_logger.info(f"Successfully returning quiz data for content {content_id}")
             return jsonify(response)
 
     except Exception as e:
-        app.logger.error(f"Error fetching content quiz: {str(e)}")
+        content_logger.error(f"Error fetching content quiz: {str(e)}")
         return jsonify({'message': 'Error fetching quiz'}), 500
 @app.route('/quizzes/<int:quiz_id>', methods=['GET'])
 @token_required
+@conditional_get('all')
 def get_quiz(current_user, quiz_id):
     quiz = execute_query(
         "SELECT * FROM quizzes WHERE id = %s AND is_active = TRUE",
@@ -3633,7 +6287,7 @@ def get_quiz(current_user, quiz_id):
     else:
         quiz['user_result'] = None
 
-    return jsonify(dict_to_json_serializable(quiz))
+    return jsonify(quiz)
 @app.route('/quizzes/<int:quiz_id>/submit', methods=['POST'])
 @token_required
 def submit_quiz(current_user, quiz_id):
@@ -3685,6 +6339,7 @@ def submit_quiz(current_user, quiz_id):
                 datetime.now(timezone.utc)
             )
         )
+        bump_user_state_version(current_user['id'])
 
         response = {
             'message': 'Quiz submitted successfully',
@@ -3698,6 +6353,8 @@ def submit_quiz(current_user, quiz_id):
         }
 
         if passed:
+            refresh_user_module_progress(current_user['id'], [quiz['module_id']])
+
             # Award points for passing the quiz
             points_result = award_points(
                 current_user['id'],
@@ -3726,13 +6383,25 @@ def submit_quiz(current_user, quiz_id):
         return jsonify({'message': 'Error submitting quiz'}), 500
 @app.route('/notifications', methods=['GET'])
 @token_required
+@conditional_get()
 def get_notifications(current_user):
+    """Get a page of unread notifications and the 10 most recent read ones"""
+    try:
+        limit, after = get_page_args()
+        where, params = keyset_after(['created_at', 'id'], after, descending=True) if after else ("TRUE", [])
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
     unread_notifications = execute_query(
         "SELECT * FROM notifications WHERE user_id = %s AND is_read = FALSE "
-        "ORDER BY created_at DESC",
-        (current_user['id'],),
+        f"AND {where} ORDER BY created_at DESC, id DESC LIMIT %s",
+        (current_user['id'],) + tuple(params) + (page_fetch_limit(limit),),
         fetch_all=True
     )
+    unread_notifications, next_cursor = split_page(
+        unread_notifications, limit,
+        lambda notification: [notification['created_at'], notification['id']]
+    )
 
     read_notifications = execute_query(
         "SELECT * FROM notifications WHERE user_id = %s AND is_read = TRUE "
@@ -3741,141 +6410,199 @@ def get_notifications(current_user):
         fetch_all=True
     )
 
-    return jsonify({
-        'unread': dict_to_json_serializable(unread_notifications),
-        'read': dict_to_json_serializable(read_notifications)
-    })
+    return page_response({
+        'unread': unread_notifications,
+        'read': read_notifications
+    }, next_cursor)
+
+@app.route('/notifications/count', methods=['GET'])
+@token_required
+@conditional_get()
+def get_notification_count(current_user):
+    return jsonify({'unread': get_unread_notification_count(current_user['id'])})
 
 @app.route('/notifications/mark-read', methods=['POST'])
+@app.route('/notifications/mark-all-read', methods=['POST'])
 @token_required
 def mark_notifications_read(current_user):
-    execute_query(
-        "UPDATE notifications SET is_read = TRUE WHERE user_id = %s",
-        (current_user['id'],)
-    )
-    return jsonify({'message': 'Notifications marked as read'})
+    """Mark the given notification_ids, or everything created up to until, as read.
 
-@app.route('/dashboard/stats', methods=['GET'])
-@token_required
-@trainer_required
-def get_dashboard_stats(current_user):
-    stats = {}
+    Without either (and on /notifications/mark-all-read) every unread
+    notification is marked.
+    """
+    data = request.get_json(silent=True) or {}
+    notification_ids = None
+    until = None
+    if request.path.endswith('/mark-read'):
+        notification_ids = data.get('notification_ids')
+        if notification_ids is not None and (
+                not isinstance(notification_ids, list) or
+                not all(isinstance(i, int) and not isinstance(i, bool) for i in notification_ids)):
+            return jsonify({'message': 'notification_ids must be a list of notification IDs'}), 400
+        if data.get('until') is not None:
+            try:
+                until = parse_client_timestamp(data['until']).replace(tzinfo=None)
+            except (ValueError, OverflowError, OSError):
+                return jsonify({'message': 'Invalid until timestamp'}), 400
 
-    if current_user['role'] == 'admin':
-        result = execute_query("SELECT COUNT(*) as total_users FROM users", fetch_one=True)
-    else:
-        result = execute_query(
-            "SELECT COUNT(*) as total_users FROM users WHERE employer_id = %s",
-            (current_user.get('employer_id'),),
-            fetch_one=True
-        )
-    stats['total_users'] = result['total_users']
+    marked = mark_notifications_as_read(current_user['id'], notification_ids, until)
+    return jsonify({
+        'message': 'Notifications marked as read',
+        'marked': marked,
+        'unread': get_unread_notification_count(current_user['id'])
+    })
 
-    if current_user['role'] == 'admin':
-        result = execute_query(
-            "SELECT COUNT(*) as active_users FROM users WHERE is_active = TRUE",
-            fetch_one=True
-        )
-    else:
-        result = execute_query(
-            "SELECT COUNT(*) as active_users FROM users WHERE is_active = TRUE AND employer_id = %s",
-            (current_user.get('employer_id'),),
-            fetch_one=True
-        )
-    stats['active_users'] = result['active_users']
+@app.route('/notifications/stream', methods=['GET'])
+@token_required
+def stream_notifications(current_user):
+    """Push notification, badge_awarded and leaderboard_rank_changed events as Server-Sent Events.
 
-    if current_user['role'] == 'admin':
-        result = execute_query("SELECT COUNT(*) as total_modules FROM modules", fetch_one=True)
-    else:
-        result = execute_query(
-            "SELECT COUNT(*) as total_modules FROM modules WHERE created_by = %s",
-            (current_user['id'],),
-            fetch_one=True
-        )
-    stats['total_modules'] = result['total_modules']
+    Browsers connect with EventSource('/notifications/stream?token=...').
+    """
+    user_id = current_user['id']
+    events = subscribe_events(user_id)
 
-    if current_user['role'] == 'admin':
-        result = execute_query(
-            "SELECT COUNT(*) as active_modules FROM modules WHERE is_active = TRUE",
-            fetch_one=True
-        )
-    else:
-        result = execute_query(
-            "SELECT COUNT(*) as active_modules FROM modules WHERE is_active = TRUE AND created_by = %s",
-            (current_user['id'],),
-            fetch_one=True
-        )
-    stats['active_modules'] = result['active_modules']
+    def generate():
+        try:
+            yield f"retry: {app.config['EVENT_STREAM_RETRY']}\n\n"
+            while True:
+                try:
+                    event_id, event_type, data = events.get(timeout=app.config['EVENT_STREAM_HEARTBEAT'])
+                except queue.Empty:
+                    # Keeps proxies from closing an idle connection
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"id: {event_id}\nevent: {event_type}\ndata: {app.json.dumps(data)}\n\n"
+        finally:
+            unsubscribe_events(user_id, events)
 
-    if current_user['role'] == 'admin':
-        recent_activity = execute_query(
-            "SELECT u.first_name, u.last_name, m.title as module_title, "
-            "up.status, up.last_accessed "
-            "FROM user_progress up "
-            "JOIN users u ON up.user_id = u.id "
-            "JOIN module_content mc ON up.content_id = mc.id "
-            "JOIN modules m ON mc.module_id = m.id "
-            "ORDER BY up.last_accessed DESC LIMIT 10",
-            fetch_all=True
-        )
-    else:
-        recent_activity = execute_query(
-            "SELECT u.first_name, u.last_name, m.title as module_title, "
-            "up.status, up.last_accessed "
-            "FROM user_progress up "
-            "JOIN users u ON up.user_id = u.id "
-            "JOIN module_content mc ON up.content_id = mc.id "
-            "JOIN modules m ON mc.module_id = m.id "
-            "WHERE u.employer_id = %s "
-            "ORDER BY up.last_accessed DESC LIMIT 10",
-            (current_user.get('employer_id'),),
-            fetch_all=True
-        )
-    stats['recent_activity'] = dict_to_json_serializable(recent_activity)
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache, no-transform'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/dashboard/stats', methods=['GET'])
+@token_required
+@trainer_required
+def get_dashboard_stats(current_user):
+    # Admins see the whole platform, trainers their employer and own modules
+    trainer = None if current_user['role'] == 'admin' else current_user
+    stats = get_dashboard_counters(trainer)
+    stats['recent_activity'] = get_recent_activity(trainer)
 
     return jsonify(stats)
 @app.route('/offline-content', methods=['GET'])
 @token_required
 def get_offline_content(current_user):
-    user_offline_dir = os.path.join(app.config['OFFLINE_CONTENT_DIR'], str(current_user['id']))
-    if not os.path.exists(user_offline_dir):
-        return jsonify({'offline_content': [], 'total_size': 0})
+    offline_content = execute_query(
+        "SELECT mc.id, mc.title, mc.content_type, oi.size, oi.stored_at, oi.last_accessed_at "
+        "FROM offline_items oi "
+        "JOIN module_content mc ON oi.content_id = mc.id "
+        "WHERE oi.user_id = %s ORDER BY oi.stored_at DESC",
+        (current_user['id'],),
+        fetch_all=True
+    ) or []
+
+    return jsonify({
+        'offline_content': offline_content,
+        'total_size': calculate_offline_size(current_user['id']),
+        'max_size': app.config['MAX_OFFLINE_CONTENT_SIZE']
+    })
+
+def offline_quota_exceeded(used, size):
+    return jsonify({
+        'message': 'Offline storage limit exceeded',
+        'total_size': used,
+        'required_size': size,
+        'max_size': app.config['MAX_OFFLINE_CONTENT_SIZE']
+    }), 413
 
-    offline_content = []
-    total_size = 0
+@app.route('/offline-content/<int:content_id>', methods=['POST'])
+@app.route('/content/<int:content_id>/download', methods=['POST'])
+@token_required
+def store_offline_content(current_user, content_id):
+    """Copy a downloadable content file into the user's offline storage"""
+    content = execute_query(
+        "SELECT id, title, file_path, is_downloadable FROM module_content WHERE id = %s",
+        (content_id,),
+        fetch_one=True
+    )
+    if not content:
+        return jsonify({'message': 'Content not found'}), 404
+    if not content.get('is_downloadable'):
+        return jsonify({'message': 'Content is not available for offline use'}), 403
 
-    for content_id in os.listdir(user_offline_dir):
-        content_path = os.path.join(user_offline_dir, content_id)
-        if os.path.isfile(content_path):
-            total_size += os.path.getsize(content_path)
+    source = resolve_content_file(content.get('file_path'))
+    if not source:
+        return jsonify({'message': 'Content file not found'}), 404
 
-            content_info = execute_query(
-                "SELECT id, title, content_type FROM module_content WHERE id = %s",
-                (int(content_id),),
-                fetch_one=True
+    size = os.path.getsize(source)
+    existing = execute_query(
+        "SELECT size, checksum FROM offline_items WHERE user_id = %s AND content_id = %s",
+        (current_user['id'], content_id),
+        fetch_one=True
+    )
+    used = calculate_offline_size(current_user['id']) - (existing['size'] if existing else 0)
+    over_quota = used + size - app.config['MAX_OFFLINE_CONTENT_SIZE']
+    if over_quota > 0:
+        evict = request.args.get('evict', str(app.config['OFFLINE_EVICT_LRU'])).lower() in ('1', 'true', 'yes')
+        # Every other copy can be evicted, so this fits as long as the file alone does
+        if not evict or size > app.config['MAX_OFFLINE_CONTENT_SIZE']:
+            return offline_quota_exceeded(used, size)
+
+    try:
+        checksum = source_checksum(source)
+        # Learners storing the same file share one blob
+        store_offline_blob(source, checksum)
+        with offline_blob_lock():
+            # No-op unless the blob was collected since the copy above
+            store_offline_blob(source, checksum)
+            record_offline_item(current_user['id'], content_id, size, checksum)
+    except OSError as e:
+        app.logger.error(f"Failed to store offline content {content_id}: {str(e)}")
+        return jsonify({'message': 'Failed to store content offline'}), 500
+
+    # Evict only once the new copy is safely stored, so a failed copy
+    # does not cost the user the copies it was meant to replace
+    evicted = []
+    if over_quota > 0:
+        # Measured again, as other downloads may have changed it since
+        over_quota = calculate_offline_size(current_user['id']) - app.config['MAX_OFFLINE_CONTENT_SIZE']
+    if over_quota > 0:
+        evicted = evict_user_offline_items(current_user['id'], over_quota, keep_content_id=content_id)
+        if evicted is None:
+            # Undo rather than leave the user over the quota
+            execute_query(
+                "DELETE FROM offline_items WHERE user_id = %s AND content_id = %s",
+                (current_user['id'], content_id)
             )
+            release_offline_blob(checksum)
+            if existing and existing['checksum'] != checksum:
+                release_offline_blob(existing['checksum'])
+            bump_user_state_version(current_user['id'])
+            return offline_quota_exceeded(calculate_offline_size(current_user['id']), size)
 
-            if content_info:
-                offline_content.append({
-                    'id': content_info['id'],
-                    'title': content_info['title'],
-                    'content_type': content_info['content_type'],
-                    'size': os.path.getsize(content_path)
-                })
+    if existing and existing['checksum'] != checksum:
+        release_offline_blob(existing['checksum'])
+    bump_user_state_version(current_user['id'])
+    schedule_offline_reclaim()
 
     return jsonify({
-        'offline_content': offline_content,
-        'total_size': total_size,
-        'max_size': app.config['MAX_OFFLINE_CONTENT_SIZE']
-    })
+        'message': 'Content stored for offline use',
+        'content_id': content_id,
+        'size': size,
+        'checksum': checksum,
+        'evicted': evicted
+    }), 201
 
 @app.route('/content/<int:content_id>/download', methods=['GET'])
 @token_required
 def download_content(current_user, content_id):
-    """Return content URL (or YouTube embed URL if video)"""
+    """Serve the content file (or return the YouTube embed URL if video)"""
     content = execute_query(
         """
-        SELECT mc.*, yv.youtube_url, yv.youtube_video_id
+        SELECT mc.*, yv.youtube_url, yv.youtube_video_id,
+               yv.title AS video_title, yv.is_embeddable, yv.checked_at
         FROM module_content mc
         LEFT JOIN youtube_videos yv ON mc.id = yv.content_id
         WHERE mc.id = %s
@@ -3886,14 +6613,28 @@ def download_content(current_user, content_id):
     if not content:
         return jsonify({'message': 'Content not found'}), 404
 
+    # Serve local files directly
+    if not (content.get('content_type') == 'video' and content.get('youtube_video_id')):
+        source = resolve_content_file(content.get('file_path'))
+        if not source:
+            return jsonify({'message': 'Content file not found'}), 404
+        try:
+            checksum = source_checksum(source)
+        except OSError as e:
+            app.logger.error(f"Failed to read content file {content_id}: {str(e)}")
+            return jsonify({'message': 'Content file not found'}), 404
+        return serve_file(source, 'CONTENT_FILES_DIR', checksum, os.path.basename(source))
+
     # Handle YouTube videos
     if content.get('content_type') == 'video' and content.get('youtube_video_id'):
         # Verify the video is embeddable
         try:
-            video_info = requests.get(
-                f"https://www.youtube.com/oembed?url=https://www.youtube.com/watch?v={content['youtube_video_id']}&format=json"
-            )
-            if video_info.status_code != 200:
+            video_info = get_youtube_metadata(content['youtube_video_id'], known={
+                'title': content['video_title'],
+                'is_embeddable': content['is_embeddable'],
+                'checked_at': content['checked_at']
+            })
+            if not video_info['embeddable']:
                 return jsonify({
                     'message': 'YouTube video cannot be embedded or is not available',
                     'error': 'video_not_embeddable'
@@ -3906,7 +6647,7 @@ def download_content(current_user, content_id):
                 'youtube_video_id': content['youtube_video_id'],
                 'youtube_url': content['youtube_url'],
                 'type': 'youtube_embed',
-                'title': video_info.json().get('title', 'YouTube Video')
+                'title': video_info.get('title') or 'YouTube Video'
             })
         except Exception as e:
             app.logger.error(f"Error checking YouTube video: {str(e)}")
@@ -3915,16 +6656,280 @@ def download_content(current_user, content_id):
                 'error': str(e)
             }), 500
 
+@app.route('/offline-content/<int:content_id>/file', methods=['GET'])
+@token_required
+def get_offline_file(current_user, content_id):
+    """Serve the user's offline copy; interrupted downloads resume with Range"""
+    item = execute_query(
+        "SELECT oi.checksum, mc.file_path FROM offline_items oi "
+        "JOIN module_content mc ON oi.content_id = mc.id "
+        "WHERE oi.user_id = %s AND oi.content_id = %s",
+        (current_user['id'], content_id),
+        fetch_one=True
+    )
+    if not item:
+        return jsonify({'message': 'Content not found in offline storage'}), 404
+
+    path = offline_blob_path(item['checksum'])
+    if not os.path.isfile(path):
+        app.logger.error(f"Offline blob {item['checksum']} is missing for content {content_id}")
+        return jsonify({'message': 'Content not found in offline storage'}), 404
+
+    touch_offline_item(current_user['id'], content_id)
+    download_name = os.path.basename(item['file_path'] or '') or str(content_id)
+    # Blobs are content-addressed, so a given copy never changes
+    return serve_file(
+        path, 'OFFLINE_CONTENT_DIR', item['checksum'], download_name,
+        as_attachment=True, max_age=31536000
+    )
+
+# Offline manifests describe an active module as learners store it: the
+# module, its content items and its quiz without answers. Every item carries
+# a hash of its metadata and file checksum, and the manifest version is a
+# hash over all of them, so clients can sync by comparing hashes.
+#
+# Module bundles are one zip per manifest version with manifest.json, the
+# downloadable files and the quiz, cached under
+# OFFLINE_CONTENT_DIR/bundles/<module_id>-<version>.zip.
+bundle_locks = {}
+bundle_locks_guard = threading.Lock()
+
+def get_bundle_lock(module_id):
+    with bundle_locks_guard:
+        return bundle_locks.setdefault(module_id, threading.Lock())
+
+def bundle_path(module_id, version):
+    return os.path.join(offline_root(), 'bundles', f"{module_id}-{version}.zip")
+
+def manifest_hash(value):
+    return hashlib.sha256(app.json.dumps(value, sort_keys=True).encode('utf-8')).hexdigest()[:32]
+
+def get_bundle_quiz(module_id):
+    """Get the module's quiz definition with its questions, without answers"""
+    quiz = get_module_quiz(module_id)
+    if not quiz:
+        return None
+    questions = execute_query(
+        "SELECT id, question_text, options, points "
+        "FROM quiz_questions WHERE quiz_id = %s ORDER BY id",
+        (quiz['id'],),
+        fetch_all=True
+    ) or []
+    for question in questions:
+        options = question.get('options')
+        if isinstance(options, bytes):
+            options = options.decode('utf-8', errors='replace')
+        if isinstance(options, str):
+            try:
+                options = json.loads(options)
+            except json.JSONDecodeError:
+                options = []
+        question['options'] = options or []
+    quiz['questions'] = questions
+    return quiz
+
+def get_module_manifest(module_id):
+    """Build the offline manifest of an active module.
+
+    Returns (manifest, files) where files lists (path, name in bundle), or
+    (None, []) if the module is not active. Raises OSError if a content file
+    cannot be read.
+    """
+    module = get_catalogue_module(module_id)
+    if not module:
+        return None, []
+
+    items = []
+    files = []
+    for content in get_module_contents(module_id):
+        item = {
+            'id': content['id'],
+            'title': content['title'],
+            'content_type': content['content_type'],
+            'display_order': content['display_order'],
+            'description': content.get('description'),
+            'duration': content.get('duration'),
+            'file': None,
+            'size': None,
+            'checksum': None
+        }
+        if content.get('youtube_video_id'):
+            # Videos hosted on YouTube stay online
+            item['youtube_video_id'] = content['youtube_video_id']
+            item['youtube_url'] = content.get('youtube_url')
+        source = resolve_content_file(content.get('file_path')) if content.get('is_downloadable') else None
+        if source:
+            item['file'] = f"content/{content['id']}-{os.path.basename(source)}"
+            item['size'] = os.path.getsize(source)
+            item['checksum'] = source_checksum(source)
+            files.append((source, item['file']))
+        item['hash'] = manifest_hash(item)
+        items.append(item)
+
+    quiz = get_bundle_quiz(module_id)
+    if quiz:
+        quiz['hash'] = manifest_hash(quiz)
+    module_info = {
+        'id': module['id'],
+        'title': module['title'],
+        'description': module.get('description')
+    }
+    manifest = {
+        'module': module_info,
+        'contents': items,
+        'quiz': quiz,
+        'version': manifest_hash([
+            module_info,
+            [item['hash'] for item in items],
+            quiz['hash'] if quiz else None
+        ])
+    }
+    return manifest, files
+
+def build_module_bundle(path, manifest, files):
+    """Write the bundle to a temporary file and move it into place"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{threading.get_ident()}.part"
+    try:
+        with zipfile.ZipFile(temp_path, 'w', allowZip64=True) as bundle:
+            bundle.writestr('manifest.json', app.json.dumps(manifest), zipfile.ZIP_DEFLATED)
+            for source, name in files:
+                mimetype = mimetypes.guess_type(name)[0] or ''
+                # Video, audio, PDFs and images are already compressed
+                if mimetype.startswith('text/') or mimetype in app.config['COMPRESS_MIMETYPES']:
+                    compression = zipfile.ZIP_DEFLATED
+                else:
+                    compression = zipfile.ZIP_STORED
+                bundle.write(source, name, compression)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    # Drop bundles of earlier versions of the module
+    directory = os.path.dirname(path)
+    prefix = f"{manifest['module']['id']}-"
+    for name in os.listdir(directory):
+        stale = os.path.join(directory, name)
+        if name.startswith(prefix) and name.endswith('.zip') and stale != path:
+            try:
+                os.remove(stale)
+            except OSError:
+                pass
+
+@app.route('/modules/<int:module_id>/offline-manifest', methods=['GET'])
+@token_required
+def get_offline_manifest(current_user, module_id):
+    """Get the offline manifest of a module"""
+    try:
+        manifest, _ = get_module_manifest(module_id)
+    except OSError as e:
+        app.logger.error(f"Failed to read content files for module {module_id}: {str(e)}")
+        return jsonify({'message': 'Failed to build offline manifest'}), 500
+    if not manifest:
+        return jsonify({'message': 'Module not found'}), 404
+
+    response = jsonify(manifest)
+    response.set_etag(manifest['version'])
+    return response.make_conditional(request)
+
+@app.route('/offline-content/sync', methods=['POST'])
+@token_required
+def sync_offline_content(current_user):
+    """Compare the client's manifests with the current ones.
+
+    Expects {"modules": [{"module_id": 1, "version": "...",
+    "items": [{"id": 1, "hash": "..."}], "quiz": "<hash>"}]} and returns, per
+    module, only the items that changed or were removed, plus the quiz when
+    it changed.
+    """
+    data = request.get_json(silent=True) or {}
+    client_modules = data.get('modules')
+    if not isinstance(client_modules, list):
+        return jsonify({'message': 'modules must be a list'}), 400
+
+    results = []
+    removed_modules = []
+    for client in client_modules:
+        if not isinstance(client, dict) or not isinstance(client.get('module_id'), int):
+            return jsonify({'message': 'Each module needs an integer module_id'}), 400
+        module_id = client['module_id']
+        try:
+            manifest, _ = get_module_manifest(module_id)
+        except OSError as e:
+            app.logger.error(f"Failed to read content files for module {module_id}: {str(e)}")
+            return jsonify({'message': 'Failed to build offline manifest'}), 500
+        if not manifest:
+            removed_modules.append(module_id)
+            continue
+
+        result = {
+            'module_id': module_id,
+            'version': manifest['version'],
+            'up_to_date': client.get('version') == manifest['version'],
+            'module': manifest['module'],
+            'changed': [],
+            'removed': [],
+            'quiz': None,
+            'quiz_removed': False
+        }
+        if not result['up_to_date']:
+            known = {}
+            for item in client.get('items') or []:
+                if isinstance(item, dict) and 'id' in item:
+                    known[item['id']] = item.get('hash')
+            current_ids = set()
+            for item in manifest['contents']:
+                current_ids.add(item['id'])
+                if known.get(item['id']) != item['hash']:
+                    if item['file']:
+                        item['download_url'] = url_for('download_content', content_id=item['id'])
+                    result['changed'].append(item)
+            result['removed'] = sorted(content_id for content_id in known if content_id not in current_ids)
+
+            quiz = manifest['quiz']
+            if quiz and client.get('quiz') != quiz['hash']:
+                result['quiz'] = quiz
+            result['quiz_removed'] = quiz is None and bool(client.get('quiz'))
+        results.append(result)
+
+    return jsonify({'modules': results, 'removed_modules': removed_modules})
+
+@app.route('/modules/<int:module_id>/offline-bundle', methods=['GET'])
+@token_required
+def get_module_bundle(current_user, module_id):
+    """Serve a module's downloadable content, quiz and manifest as one zip"""
+    try:
+        manifest, files = get_module_manifest(module_id)
+    except OSError as e:
+        app.logger.error(f"Failed to read content files for module {module_id}: {str(e)}")
+        return jsonify({'message': 'Failed to build offline bundle'}), 500
+    if not manifest:
+        return jsonify({'message': 'Module not found'}), 404
+
+    version = manifest['version']
+    path = bundle_path(module_id, version)
+    if not os.path.isfile(path):
+        with get_bundle_lock(module_id):
+            if not os.path.isfile(path):
+                manifest['generated_at'] = datetime.now(timezone.utc)
+                try:
+                    build_module_bundle(path, manifest, files)
+                except (OSError, zipfile.BadZipFile) as e:
+                    app.logger.error(f"Failed to build offline bundle for module {module_id}: {str(e)}")
+                    return jsonify({'message': 'Failed to build offline bundle'}), 500
+                app.logger.info(f"Built offline bundle {version} for module {module_id}")
+
+    # A bundle file never changes once built; a new version gets a new name
+    return serve_file(
+        path, 'OFFLINE_CONTENT_DIR', version, f"module-{module_id}.zip",
+        as_attachment=True
+    )
+
 @app.route('/offline-content/check/<int:content_id>', methods=['GET'])
 @token_required
 def check_offline_content(current_user, content_id):
     """Check if content is available offline"""
-    offline_path = os.path.join(
-        app.config['OFFLINE_CONTENT_DIR'],
-        str(current_user['id']),
-        str(content_id)
-    )
-    
     content = execute_query(
         "SELECT * FROM module_content WHERE id = %s",
         (content_id,),
@@ -3932,22 +6937,27 @@ def check_offline_content(current_user, content_id):
     )
     
     return jsonify({
-        'isAvailable': os.path.exists(offline_path),
+        'isAvailable': check_offline_access(current_user['id'], content_id),
         'contentId': content_id,
         'estimatedSize': content.get('size', 0) if content else 0
     })
 @app.route('/offline-content/<int:content_id>', methods=['DELETE'])
 @token_required
 def delete_offline_content(current_user, content_id):
-    content_path = os.path.join(
-        app.config['OFFLINE_CONTENT_DIR'],
-        str(current_user['id']),
-        str(content_id)
+    item = execute_query(
+        "SELECT checksum FROM offline_items WHERE user_id = %s AND content_id = %s",
+        (current_user['id'], content_id),
+        fetch_one=True
     )
 
-    if os.path.exists(content_path):
+    if item:
         try:
-            os.remove(content_path)
+            execute_query(
+                "DELETE FROM offline_items WHERE user_id = %s AND content_id = %s",
+                (current_user['id'], content_id)
+            )
+            release_offline_blob(item['checksum'])
+            bump_user_state_version(current_user['id'])
             return jsonify({'message': 'Content removed from offline storage'})
         except Exception as e:
             app.logger.error(f"Failed to delete offline content {content_id}: {str(e)}")
@@ -3958,11 +6968,12 @@ def delete_offline_content(current_user, content_id):
 @token_required
 def get_recent_modules(current_user):
     # Adjust the query as needed (e.g., order by created_at or updated_at)
-    modules = execute_query(
-        "SELECT * FROM modules WHERE is_active = TRUE ORDER BY created_at DESC LIMIT 5",
-        fetch_all=True
-    )
-    return jsonify(dict_to_json_serializable(modules))
+    modules = sorted(
+        get_catalogue_modules(),
+        key=lambda module: module['created_at'] or datetime.min,
+        reverse=True
+    )[:5]
+    return jsonify(modules)
 # Error Handlers
 @app.errorhandler(404)
 def not_found(error):
@@ -3982,6 +6993,70 @@ def after_request(response):
     response.headers.add('Access-Control-Allow-Origin', 'http://localhost:5173')
     response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
     response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
+    response.headers.add('Access-Control-Expose-Headers', 'X-Next-Cursor,X-Query-Count,X-Query-Time')
+    return response
+
+def compress_chunks(chunks, encoding):
+    """Compress a streamed body, flushing after every chunk so the client
+    receives each part as soon as it is produced"""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=app.config['COMPRESS_BROTLI_QUALITY'])
+        for chunk in chunks:
+            data = compressor.process(chunk) + compressor.flush()
+            if data:
+                yield data
+        yield compressor.finish()
+    else:
+        compressor = zlib.compressobj(app.config['COMPRESS_GZIP_LEVEL'], zlib.DEFLATED, 31)
+        for chunk in chunks:
+            data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush()
+
+@app.after_request
+def compress_response(response):
+    """Compress text responses with brotli or gzip, as the client accepts.
+
+    Files served with send_file (PDFs, ZIPs, offline media) are passed
+    through untouched, as are small bodies and other binary types.
+    """
+    if (response.mimetype not in app.config['COMPRESS_MIMETYPES'] or
+            response.direct_passthrough or
+            request.method == 'HEAD' or
+            response.status_code < 200 or response.status_code in (204, 304) or
+            'Content-Encoding' in response.headers or
+            'no-transform' in response.headers.get('Cache-Control', '')):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(['br', 'gzip'] if brotli else ['gzip'])
+    if not encoding:
+        return response
+
+    if response.is_streamed:
+        body = response.response
+        response.response = compress_chunks(response.iter_encoded(), encoding)
+        if hasattr(body, 'close'):
+            response.call_on_close(body.close)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < app.config['COMPRESS_MIN_SIZE']:
+            return response
+        if encoding == 'br':
+            data = brotli.compress(data, quality=app.config['COMPRESS_BROTLI_QUALITY'])
+        else:
+            compressor = zlib.compressobj(app.config['COMPRESS_GZIP_LEVEL'], zlib.DEFLATED, 31)
+            data = compressor.compress(data) + compressor.flush()
+        response.set_data(data)
+
+    response.headers['Content-Encoding'] = encoding
+    # The encoded bytes differ from the identity ones, so a strong ETag no
+    # longer describes them; If-None-Match compares weakly and still matches
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
     return response
 
 @app.route('/leaderboard/initialize', methods=['POST'])
@@ -3996,6 +7071,39 @@ def initialize_leaderboard(current_user):
         update_leaderboard(user['id'])
     return jsonify({'message': f'Leaderboard initialized for {len(users)} users'}), 200
 
+@app.route('/admin/slow-queries', methods=['GET'])
+@token_required
+@admin_required
+def get_slow_queries(current_user):
+    """Get the recorded slow statements, slowest first"""
+    with slow_queries_lock:
+        entries = [dict(entry) for entry in slow_queries.values()]
+    entries.sort(key=lambda entry: entry['max_ms'], reverse=True)
+    return jsonify({
+        'threshold_ms': (app.config['SLOW_QUERY_THRESHOLD'] or 0) * 1000,
+        'slow_queries': entries
+    })
+
+@app.route('/admin/slow-queries', methods=['DELETE'])
+@token_required
+@admin_required
+def clear_slow_queries(current_user):
+    with slow_queries_lock:
+        slow_queries.clear()
+    return jsonify({'message': 'Slow query log cleared'})
+
+@app.route('/progress/modules/rebuild', methods=['POST'])
+@token_required
+@admin_required
+def rebuild_module_progress(current_user):
+    """Rebuild the per-user module completion table from user_progress"""
+    users = execute_query("SELECT DISTINCT user_id FROM user_progress", fetch_all=True)
+    if not users:
+        return jsonify({'message': 'No learner progress found to rebuild.'}), 200
+    for user in users:
+        refresh_user_module_progress(user['user_id'])
+    return jsonify({'message': f'Module progress rebuilt for {len(users)} users'}), 200
+
 
 
 # --- Combined content update route for both trainer editing and learner progress ---
@@ -4010,38 +7118,14 @@ def update_content(current_user, content_id):
     # Check if this is a progress update (has 'status' field)
     if 'status' in data:
         # This is a learner progress update
-        progress = execute_query(
-            "SELECT * FROM user_progress WHERE user_id = %s AND content_id = %s",
-            (current_user['id'], content_id),
-            fetch_one=True
+        flush_progress_heartbeats(current_user['id'], content_id)
+        save_progress(
+            current_user['id'], content_id, data['status'],
+            current_position=data.get('current_position'),
+            attempts=data.get('attempts'),
+            score=data.get('score')
         )
 
-        if progress:
-            execute_query(
-                "UPDATE user_progress SET status = %s, current_position = %s, "
-                "completed_at = %s, last_accessed = %s, attempts = %s, score = %s "
-                "WHERE user_id = %s AND content_id = %s",
-                (
-                    data['status'], data.get('current_position'),
-                    datetime.now(timezone.utc) if data['status'] == 'completed' else None,
-                    datetime.now(timezone.utc), data.get('attempts', 0),
-                    data.get('score'), current_user['id'], content_id
-                )
-            )
-        else:
-            execute_query(
-                "INSERT INTO user_progress (user_id, content_id, status, started_at, "
-                "completed_at, last_accessed, current_position, attempts, score) "
-                "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)",
-                (
-                    current_user['id'], content_id, data['status'],
-                    datetime.now(timezone.utc),
-                    datetime.now(timezone.utc) if data['status'] == 'completed' else None,
-                    datetime.now(timezone.utc), data.get('current_position'),
-                    data.get('attempts', 0), data.get('score')
-                )
-            )
-
         return jsonify({'message': 'Progress updated successfully'})
     
     else:
@@ -4088,6 +7172,7 @@ def update_content(current_user, content_id):
         params = list(update_fields.values()) + [content_id]
         
         execute_query(query, params)
+        bump_catalogue_version(content['module_id'])
 
         return jsonify({'message': 'Content updated successfully'}), 200
 
@@ -4144,16 +7229,10 @@ def submit_content_quiz(current_user, content_id):
         passed = percentage >= passing_score
 
         # Update user progress to mark content as completed
-        execute_query(
-            "INSERT INTO user_progress (user_id, content_id, status, completed_at, score, attempts) "
-            "VALUES (%s, %s, %s, %s, %s, %s) "
-            "ON DUPLICATE KEY UPDATE "
-            "status = VALUES(status), completed_at = VALUES(completed_at), "
-            "score = VALUES(score), attempts = attempts + 1",
-            (
-                current_user['id'], content_id, 'completed',
-                datetime.now(timezone.utc), total_score, 1
-            )
+        save_progress(
+            current_user['id'], content_id, 'completed',
+            score=total_score,
+            count_attempt=True
         )
 
         response = {
@@ -4206,52 +7285,21 @@ def check_module_completion_and_award_certificate(user_id, module_id):
             return False  # Certificate already awarded
         
         # Get module details
-        module = execute_query(
-            "SELECT * FROM modules WHERE id = %s AND is_active = TRUE",
-            (module_id,),
-            fetch_one=True
-        )
+        module = get_catalogue_module(module_id)
         
         if not module:
             return False
         
         # Check if all content is completed
-        all_content = execute_query(
-            "SELECT id FROM module_content WHERE module_id = %s",
-            (module_id,),
-            fetch_all=True
-        )
-        
-        if not all_content:
-            return False
-        
-        completed_content = execute_query(
-            "SELECT COUNT(DISTINCT content_id) as count FROM user_progress "
-            "WHERE user_id = %s AND status = 'completed' "
-            "AND content_id IN (SELECT id FROM module_content WHERE module_id = %s)",
-            (user_id, module_id),
-            fetch_one=True
-        )
-        
-        if not completed_content or completed_content['count'] < len(all_content):
+        module_progress = get_user_module_progress(user_id, module_id)
+        if not module_progress['total_count'] or not module_content_completed(module_progress):
             return False
         
         # Check if quiz is passed (if module has a quiz)
-        quiz = execute_query(
-            "SELECT id FROM quizzes WHERE module_id = %s AND is_active = TRUE LIMIT 1",
-            (module_id,),
-            fetch_one=True
-        )
+        quiz = get_module_quiz(module_id)
         
-        if quiz:
-            quiz_result = execute_query(
-                "SELECT passed FROM quiz_results WHERE user_id = %s AND quiz_id = %s",
-                (user_id, quiz['id']),
-                fetch_one=True
-            )
-            
-            if not quiz_result or not quiz_result['passed']:
-                return False
+        if quiz and not module_progress['quiz_passed']:
+            return False
         
         # Module is completed, award certificate
         certificate_id = f"MOD-{module_id}-{user_id}"
@@ -4260,6 +7308,7 @@ def check_module_completion_and_award_certificate(user_id, module_id):
             "VALUES (%s, %s, %s, %s, %s)",
             (user_id, 'module', module_id, certificate_id, datetime.now(timezone.utc))
         )
+        bump_user_state_version(user_id)
         
         # Award points for module completion
         award_points(user_id, app.config['POINTS_FOR_COMPLETION'] * 3, f"Completed module {module_id}")
@@ -4272,28 +7321,28 @@ def check_module_completion_and_award_certificate(user_id, module_id):
 
 @app.route('/modules', methods=['GET'])
 @token_required
+@conditional_get('all')
 def get_modules(current_user):
-    modules = execute_query(
-        "SELECT * FROM modules WHERE is_active = TRUE ORDER BY id ASC",
-        fetch_all=True
-    )
+    modules = get_catalogue_modules()
 
-    for i, module in enumerate(modules):
-        result = execute_query(
-            "SELECT COUNT(*) as total_contents FROM module_content WHERE module_id = %s",
-            (module['id'],),
-            fetch_one=True
-        )
-        total_contents = result['total_contents']
+    module_progress = get_user_module_progress_map(current_user['id'], [m['id'] for m in modules])
+
+    # Modules with an active quiz, and the modules the user holds a certificate for
+    quiz_modules = get_quiz_module_ids()
+    certified_modules = {
+        row['item_id'] for row in execute_query(
+            "SELECT item_id FROM user_certificates WHERE user_id = %s AND certificate_type = 'module'",
+            (current_user['id'],),
+            fetch_all=True
+        ) or []
+    }
+
+    for module in modules:
+        progress = module_progress.get(module['id'], EMPTY_MODULE_PROGRESS)
+        total_contents = progress['total_count']
 
         if total_contents > 0:
-            result = execute_query(
-                "SELECT COUNT(*) as completed_contents FROM user_progress WHERE user_id = %s AND status = 'completed' "
-                "AND content_id IN (SELECT id FROM module_content WHERE module_id = %s)",
-                (current_user['id'], module['id']),
-                fetch_one=True
-            )
-            completed_contents = result['completed_contents']
+            completed_contents = progress['completed_count']
             module['completion_percentage'] = int((completed_contents / total_contents) * 100)
             module['content_completed'] = completed_contents
             module['content_count'] = total_contents
@@ -4303,19 +7352,8 @@ def get_modules(current_user):
             module['content_count'] = 0
 
         # Check if module has a quiz and if user passed it
-        quiz = execute_query(
-            "SELECT id FROM quizzes WHERE module_id = %s AND is_active = TRUE LIMIT 1",
-            (module['id'],),
-            fetch_one=True
-        )
-        
-        if quiz:
-            quiz_result = execute_query(
-                "SELECT passed FROM quiz_results WHERE user_id = %s AND quiz_id = %s",
-                (current_user['id'], quiz['id']),
-                fetch_one=True
-            )
-            module['quiz_passed'] = bool(quiz_result and quiz_result['passed'])
+        if module['id'] in quiz_modules:
+            module['quiz_passed'] = progress['quiz_passed']
             module['quiz_count'] = 1
         else:
             module['quiz_passed'] = False
@@ -4329,30 +7367,19 @@ def get_modules(current_user):
         module['is_completed'] = module_completed
         
         # Check if user has certificate for this module
-        certificate = execute_query(
-            "SELECT id FROM user_certificates WHERE user_id = %s AND certificate_type = 'module' AND item_id = %s",
-            (current_user['id'], module['id']),
-            fetch_one=True
-        )
-        module['has_certificate'] = bool(certificate)
-
-        # Determine if module is locked
-        if i == 0:
-            # First module is always unlocked
-            module['is_locked'] = False
-            module['prerequisite_module_id'] = None
-        else:
-            previous_module = modules[i - 1]
-            # Check if previous module is completed (all content + quiz if exists)
-            previous_completed = (
-                previous_module['completion_percentage'] == 100 and 
-                (previous_module['quiz_count'] == 0 or previous_module['quiz_passed'])
-            )
-            
-            module['is_locked'] = not previous_completed
-            module['prerequisite_module_id'] = previous_module['id'] if not previous_completed else None
-
-    return jsonify(dict_to_json_serializable(modules))
+        module['has_certificate'] = module['id'] in certified_modules
+
+    # A module is locked until all of its prerequisites are completed
+    completed = {module['id'] for module in modules if module['is_completed']}
+    for module in modules:
+        pending = [
+            prerequisite_id for prerequisite_id in get_module_prerequisites(module['id'])
+            if prerequisite_id not in completed
+        ]
+        module['is_locked'] = bool(pending)
+        module['prerequisite_module_id'] = pending[0] if pending else None
+
+    return jsonify(modules)
 
 if __name__=='__main__':
     app.run(debug=True)
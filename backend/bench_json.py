@@ -0,0 +1,67 @@
+"""Compare response serialization with and without the dict_to_json_serializable pre-pass.
+
+Run from the backend directory:
+
+    python bench_json.py [rows]
+
+Builds a learner-report shaped payload (datetimes, Decimals, bytes) and times
+the old path (recursive copy, then jsonify) against the JSON provider.
+"""
+import sys
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from app import app, dict_to_json_serializable, orjson
+from flask import jsonify
+
+
+def build_payload(rows):
+    started = datetime(2024, 1, 1, 8, 30)
+    return [
+        {
+            'id': i,
+            'email': f'learner{i}@example.com',
+            'first_name': b'Learner',
+            'last_name': f'Number {i}',
+            'role': 'user',
+            'is_active': 1,
+            'created_at': started + timedelta(minutes=i),
+            'last_login': started + timedelta(hours=i),
+            'total_points': Decimal(i * 50),
+            'completion_rate': Decimal('87.50'),
+            'modules': [
+                {'module_id': m, 'completed_at': started + timedelta(days=m), 'score': Decimal('92.0')}
+                for m in range(3)
+            ]
+        }
+        for i in range(rows)
+    ]
+
+
+def best_of(fn, repeat=5):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    payload = build_payload(rows)
+
+    with app.app_context():
+        before = best_of(lambda: jsonify(dict_to_json_serializable(payload)).get_data())
+        after = best_of(lambda: jsonify(payload).get_data())
+
+    encoder = 'orjson' if orjson is not None else 'json'
+    print(f"{rows} rows, encoder: {encoder}")
+    print(f"  pre-pass + jsonify: {before * 1000:8.1f} ms")
+    print(f"  JSON provider:      {after * 1000:8.1f} ms")
+    print(f"  speedup:            {before / after:8.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+import unittest
+from unittest import mock
+
+import app as backend
+
+
+class FakeCursor:
+    rowcount = 0
+    lastrowid = None
+    executed = []
+    # Row returned by fetchone, e.g. a captured session variable
+    next_row = None
+
+    def execute(self, query, params=()):
+        FakeCursor.executed.append((query, params))
+
+    def executemany(self, query, seq_params):
+        self.rowcount = len(seq_params)
+
+    def fetchone(self):
+        return FakeCursor.next_row
+
+    def fetchall(self):
+        return []
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def cursor(self, dictionary=False):
+        return FakeCursor()
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class QueryCounterTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(backend, 'get_db_connection', FakeConnection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_count_queries_collects_normalized_statements(self):
+        with backend.count_queries() as statements:
+            backend.execute_query("SELECT id FROM users WHERE id = %s", (1,), fetch_one=True)
+            backend.execute_many("UPDATE users SET is_active = %s WHERE id = %s", [(1, 1), (1, 2)])
+        self.assertEqual(len(statements), 2)
+        self.assertTrue(statements[0].startswith('SELECT id FROM users'))
+
+    def test_raw_cursor_statements_are_counted(self):
+        with backend.count_queries() as statements:
+            backend.mark_notifications_as_read(1)
+        self.assertEqual(len(statements), 1)
+
+    def test_assert_max_queries_fails_past_the_limit(self):
+        with self.assertRaises(AssertionError):
+            with backend.assert_max_queries(1):
+                backend.execute_query("SELECT 1", fetch_one=True)
+                backend.execute_query("SELECT 2", fetch_one=True)
+
+    def test_connection_failure_is_not_recorded(self):
+        with mock.patch.object(backend, 'get_db_connection', return_value=None):
+            with backend.count_queries() as statements:
+                with self.assertRaises(Exception):
+                    backend.execute_query("SELECT 1", fetch_one=True)
+        self.assertEqual(statements, [])
+
+
+class ProgressBatchTest(unittest.TestCase):
+    def setUp(self):
+        FakeCursor.executed = []
+        FakeCursor.next_row = {'previous_statuses': b'5:in_progress,'}
+        self.addCleanup(setattr, FakeCursor, 'next_row', None)
+        for name, value in (('get_db_connection', FakeConnection),
+                            ('bump_user_state_version', lambda *user_ids: None)):
+            patcher = mock.patch.object(backend, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_partial_event_keeps_stored_attempts_and_position(self):
+        recorded_at = backend.datetime(2026, 1, 1, tzinfo=backend.timezone.utc)
+        previous = backend.save_progress_batch([(1, 5, 'in_progress', recorded_at, None, None, None)])
+        self.assertEqual(previous, {5: 'in_progress'})
+
+        query, params = next(
+            (query, params) for query, params in FakeCursor.executed
+            if query.startswith('INSERT INTO user_progress')
+        )
+        # current_position, attempts and score reach the upsert as NULL...
+        self.assertEqual(params[6:9], (None, None, None))
+        # ...and NULL never overwrites what the existing row holds
+        self.assertIn('COALESCE(VALUES(current_position), current_position)', query)
+        self.assertIn('COALESCE(VALUES(attempts), attempts)', query)
+        self.assertIn('COALESCE(VALUES(score), score)', query)
+
+
+class HeartbeatFlushTest(unittest.TestCase):
+    def setUp(self):
+        self.written = []
+        existing = [{'id': 1}, {'id': 2}, {'id': 3}]
+
+        def save_progress_positions(rows):
+            if any(row[1] == 2 for row in rows):
+                raise ValueError('rejected')
+            self.written.extend(row[1] for row in rows)
+
+        for name, value in (
+                ('execute_query', lambda *args, **kwargs: existing),
+                ('save_progress_positions', save_progress_positions),
+                ('start_progress_flusher', lambda: None)):
+            patcher = mock.patch.object(backend, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        backend.progress_heartbeats.clear()
+        self.addCleanup(backend.progress_heartbeats.clear)
+
+    def test_rejected_row_is_isolated_and_dropped(self):
+        for content_id in (1, 2, 3):
+            backend.buffer_progress_heartbeat(7, content_id, 10.0)
+
+        self.assertEqual(backend.flush_progress_heartbeats(), 0)
+        self.assertEqual(backend.flush_progress_heartbeats(), 2)
+        self.assertEqual(sorted(self.written), [1, 3])
+        self.assertEqual(list(backend.progress_heartbeats), [(7, 2)])
+
+        for _ in range(backend.app.config['PROGRESS_FLUSH_MAX_FAILURES']):
+            backend.flush_progress_heartbeats()
+        self.assertEqual(backend.progress_heartbeats, {})
+
+
+if __name__ == '__main__':
+    unittest.main()